@@ -1,10 +1,11 @@
 import warnings
 import os
-import time
 import gc
 import sys
 import shutil
 import logging
+import multiprocessing
+import threading
 import cv2
 
 # Подавляем DeprecationWarning от PyQt5 (sipPyTypeDict)
@@ -22,6 +23,7 @@ except Exception:
         pass
 import numpy as np
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 # Отключаем Qt auto-scaling и HiDPI
@@ -34,7 +36,7 @@ os.environ["QT_ENABLE_HIGHDPI_SCALING"] = "0"
 # ✅ НАВИГАЦИЯ РАБОТАЕТ: Кнопки ◀▶ для переключения между парами изображений
 
 # flake8: noqa: E402
-from PyQt5.QtCore import Qt, QUrl, QSettings, pyqtSignal, QPoint, QTimer, QPropertyAnimation, QEasingCurve, QMimeData, QRect, QObject, QRunnable, QThreadPool
+from PyQt5.QtCore import Qt, QUrl, QSettings, pyqtSignal, QPoint, QTimer, QPropertyAnimation, QEasingCurve, QMimeData, QRect, QObject
 from PyQt5.QtGui import QPixmap, QDesktopServices, QColor, QImage, QPainter, QKeySequence, QDrag, QPen, QIcon
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
@@ -46,14 +48,15 @@ from PyQt5.QtWidgets import (
 # Дублирующиеся импорты убраны
 
 from core.diff_two_color import diff_two_color
-try:
-    # Быстрое ядро (ROI) из пакета imgdiff
-    from imgdiff.core.diff import diff_mask_fast, coarse_to_fine
-    from imgdiff.core.morph import filter_small_components, dilate_mask
-    from imgdiff.core.io import ResultCache, compute_file_hash, compute_settings_hash
-    FAST_CORE_AVAILABLE = True
-except Exception:
-    FAST_CORE_AVAILABLE = False
+# Пайплайн пары файлов без Qt: его же импортируют процессы-воркеры
+from imgdiff.core.pipeline import (
+    OutlineComparator, analysis_settings, fast_cv2_imread, shutdown_executor, worker_init
+)
+from imgdiff.core.batch import DEFAULT_PREFETCH, BatchJob, BatchPipeline, CacheProbe
+from imgdiff.core.shm import SharedImagePool
+from imgdiff.core.thumbs import ThumbnailCache
+# Кеш результатов из пакета imgdiff
+from imgdiff.core.io import FingerprintIndex, MaskCache, ResultCache, compute_settings_hash
 from core.slider_reveal import SliderReveal
 # Временно отключена функциональность смещения изображений
 from core.image_alignment import ImageAlignmentManager
@@ -72,7 +75,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger("imgdiff.gui")
 
-MAX_PREVIEW_SIZE = 1200
+# Потоков хэширования входов и проверки кэша (стадия probe пакета; упирается в диск)
+PROBE_WORKERS = 4
 
 def natural_sort_key(text):
     """
@@ -92,271 +96,161 @@ def cv2_to_qimage(cv_img):
     bytes_per_line = 3 * width
     return QImage(cv_img.data, width, height, bytes_per_line, QImage.Format_RGB888).rgbSwapped()
 
-def safe_cv2_imread(path):
-    """Безопасное чтение изображения с поддержкой кириллицы"""
-    try:
-        # Пробуем сначала через numpy
-        import numpy as np
-        with open(path, 'rb') as f:
-            img_array = np.asarray(bytearray(f.read()), dtype=np.uint8)
-            img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-            return img
-    except Exception:
-        # Fallback к обычному cv2.imread
-        return cv2.imread(str(path), cv2.IMREAD_COLOR)
-
-def load_pixmap_scaled(path, max_size=MAX_PREVIEW_SIZE):
-    img = fast_cv2_imread(path)
-    if img is None: return QPixmap()
-    h, w = img.shape[:2]
-    if h > max_size or w > max_size:
-        scale = max_size / max(h, w)
-        img = cv2.resize(img, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA)
-    return QPixmap.fromImage(cv2_to_qimage(img))
-
-def quick_diff_ratio(img_a: np.ndarray, img_b: np.ndarray, max_side: int = 256, thr: int = 5) -> float:
-    """Быстрый оценочный процент отличий на даунскейле.
-    Возвращает долю пикселей (0..1) где |A-B| > thr в градациях серого.
-    """
-    try:
-        h, w = img_a.shape[:2]
-        scale = min(1.0, max_side / max(h, w))
-        if scale < 1.0:
-            a = cv2.resize(img_a, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA)
-            b = cv2.resize(img_b, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA)
-        else:
-            a, b = img_a, img_b
-        ag = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY)
-        bg = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY)
-        diff = cv2.absdiff(ag, bg)
-        _, mask = cv2.threshold(diff, thr, 255, cv2.THRESH_BINARY)
-        return float(cv2.countNonZero(mask)) / float(mask.size)
-    except Exception:
-        return 1.0
-
-def fast_cv2_imread(path):
-    """Быстрое чтение изображения: cv2.imread -> fallback на imdecode."""
-    try:
-        img = cv2.imread(str(path), cv2.IMREAD_COLOR)
-        if img is not None:
-            return img
-    except Exception:
-        pass
-    try:
-        with open(path, 'rb') as f:
-            img_array = np.asarray(bytearray(f.read()), dtype=np.uint8)
-            return cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-    except Exception:
-        return None
+_thumbnail_cache = None
 
-class WorkerSignals(QObject):
-    finished = pyqtSignal(str, str, int, str, float)  # out_name, out_path, code, error_message, duration_s
 
+def thumbnail_cache():
+    """Общий кэш миниатюр превью (память + .imgdiff_cache/thumbs)."""
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        _thumbnail_cache = ThumbnailCache(cache_dir=Path(".imgdiff_cache") / "thumbs")
+    return _thumbnail_cache
 
-class CompareWorker(QRunnable):
-    def __init__(self, a, b, out_path, params):
-        super().__init__()
-        self.a = a
-        self.b = b
-        self.out_path = out_path
-        self.params = params
-        self.signals = WorkerSignals()
 
-    def run(self):
-        try:
-            start_t = time.perf_counter()
-            # Пауза/отмена перед стартом
-            cancel_fn = self.params.get('cancel_fn')
-            pause_fn = self.params.get('pause_fn')
-            if callable(cancel_fn) and cancel_fn():
-                self.signals.finished.emit(self.params['out_name'], str(self.out_path), -1, "Cancelled", 0.0)
-                return
-            # Уважать паузу
-            if callable(pause_fn):
-                while pause_fn():
-                    if callable(cancel_fn) and cancel_fn():
-                        self.signals.finished.emit(self.params['out_name'], str(self.out_path), -1, "Cancelled", 0.0)
-                        return
-                    time.sleep(0.05)
-            code = run_outline_core(
-                self.a,
-                self.b,
-                self.out_path,
-                self.params['fuzz'],
-                self.params['thick'],
-                self.params['del_color_bgr'],
-                self.params['add_color_bgr'],
-                self.params['match_tolerance'],
-                self.params['match_color_bgr'],
-                self.params['gamma'],
-                self.params['morph_open'],
-                self.params['min_area'],
-                self.params['debug'],
-                self.params['use_ssim'],
-                self.params['output_dir'],
-                self.params.get('use_fast_core', True),
-                self.params.get('save_only_diffs', True),
-                self.params.get('png_compression', 1),
-                self.params.get('quick_max_side', 256),
-                self.params.get('auto_png', False),
-                self.params.get('auto_align', False),
-                self.params.get('auto_align_max_percent', 1.0),
-                5,
+class BatchRunner(QObject):
+    """Пакетное сравнение на конвейере imgdiff.core.batch в фоновом потоке.
+
+    Чтение файлов идёт на prefetch пар вперёд, декодирование, сравнение и
+    запись — отдельными стадиями с ограниченными очередями. Сравнение
+    выполняется в потоках или в пуле процессов spawn (воркеры импортируют
+    только imgdiff.core, кадры передаются через разделяемую память).
+    Результаты приходят в GUI-поток сигналом finished.
+    """
+    finished = pyqtSignal(str, str, int, str, float, object, bool)  # out_name, out_path, code, error_message, duration_s, timings, cached
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._executor = None
+        self._executor_workers = 0
+        self._pool = SharedImagePool()
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def _process_executor(self, workers: int):
+        """Пул процессов; пересоздаётся при смене числа воркеров или после падения."""
+        with self._lock:
+            stale = self._executor is not None and (
+                getattr(self._executor, '_broken', False)
+                or (self._executor_workers != workers and self._active == 0)
             )
-            duration_s = max(0.0, time.perf_counter() - start_t)
-            self.signals.finished.emit(self.params['out_name'], str(self.out_path), code, "", duration_s)
+            if stale:
+                shutdown_executor(self._executor, wait=False)
+                self._executor = None
+            if self._executor is None:
+                # Один поток OpenCV на процесс: параллелизм даёт сам пул
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=worker_init, initargs=(1, LOGFILE)
+                )
+                self._executor_workers = workers
+            return self._executor
+
+    def start(self, jobs, params, workers: int, use_processes: bool = False,
+              prefetch: int = DEFAULT_PREFETCH, cancel_fn=None, pause_fn=None, probe=None):
+        """Запускает пакет BatchJob с общими параметрами сравнения params.
+
+        probe (batch.CacheProbe) — стадия хэширования и проверки кэша; посчитанные
+        результаты и маски сохраняются им же, в потоке конвейера.
+        """
+        workers = max(1, int(workers))
+        executor = self._process_executor(workers) if use_processes else None
+        pipeline = BatchPipeline(
+            OutlineComparator(params),
+            prefetch=prefetch,
+            compare_workers=workers,
+            executor=executor,
+            pool=self._pool if executor is not None else None,
+            cancel_fn=cancel_fn,
+            pause_fn=pause_fn,
+            probe=probe,
+            probe_workers=PROBE_WORKERS,
+        )
+        with self._lock:
+            self._active += 1
+        threading.Thread(target=self._run, args=(pipeline, list(jobs), probe),
+                         name="batch-runner", daemon=True).start()
+
+    def _run(self, pipeline, jobs, probe=None):
+        try:
+            for job in pipeline.run(jobs):
+                if probe is not None:
+                    try:
+                        probe.store(job)
+                    except Exception as e:
+                        logger.warning(f"Result cache write failed: {e}")
+                self.finished.emit(job.name, job.out_path, job.code, job.error, job.duration, job.timings,
+                                   job.cached)
         except Exception as e:
-            self.signals.finished.emit(self.params['out_name'], str(self.out_path), -1, str(e), 0.0)
-
-def run_outline_core(left, right, out_path, fuzz, thick, del_color_bgr, add_color_bgr,
-                     match_tolerance, match_color_bgr, gamma, morph_open, min_area,
-                     debug, use_ssim, output_dir, use_fast_core: bool = True,
-                     save_only_diffs: bool = True,
-                     png_compression: int = 1,
-                     quick_max_side: int = 256,
-                     auto_png: bool = False,
-                     auto_align: bool = False,
-                     auto_align_max_percent: float = 1.0,
-                     quick_absdiff_thr: int = 5):
-    """Потокобезопасное сравнение пары изображений с сохранением результата.
-    Возвращает 1 если есть отличия, 0 если равны.
+            logger.error(f"Batch pipeline failed: {e}")
+        finally:
+            with self._lock:
+                self._active -= 1
+            if pipeline.executor is not None:
+                logger.debug(f"Shared memory pool: {self._pool.occupancy()}")
+
+    def shutdown(self):
+        """Останавливает пул процессов и освобождает разделяемую память."""
+        if self._executor is not None:
+            shutdown_executor(self._executor, wait=False)
+            self._executor = None
+        self._pool.close()
+
+
+class ThumbnailLoader(QObject):
+    """Миниатюры превью в фоновом потоке (imgdiff.core.thumbs.ThumbnailCache).
+
+    Важен только последний запрос: пока поток занят, новые запросы заменяют
+    ожидающий, а результат устаревшего запроса в GUI не передаётся.
+    Готовая миниатюра приходит сигналом ready(path, image).
     """
-    old = fast_cv2_imread(str(left))
-    new = fast_cv2_imread(str(right))
-    if old is None or new is None:
-        raise FileNotFoundError(f"Не удалось загрузить {left} или {right}")
-
-    # Выравниваем размеры
-    h = max(old.shape[0], new.shape[0])
-    w = max(old.shape[1], new.shape[1])
-    if old.shape[:2] != (h, w):
-        old = cv2.resize(old, (w, h), interpolation=cv2.INTER_LANCZOS4)
-    if new.shape[:2] != (h, w):
-        new = cv2.resize(new, (w, h), interpolation=cv2.INTER_LANCZOS4)
-
-    # REMOVED: Quick pre-check optimization that was causing false negatives
-    # Now all comparisons go through the full comparison algorithm
-    # This ensures files with real differences are properly detected
-
-    if use_fast_core and FAST_CORE_AVAILABLE:
-        # Coarse-to-fine mask с локальным уточнением
-        area = h * w
-        if area >= 20000000:
-            c_scale = 0.15
-        elif area >= 5000000:
-            c_scale = 0.25
-        else:
-            c_scale = 0.33
-        boxes = coarse_to_fine(old, new, fuzz=max(3, int(fuzz)), scale=c_scale, min_area=max(10, int(min_area/2)), use_lab=True)
-        if not boxes:
-            del old, new
-            return 0
-
-        mask_total = np.zeros((h, w), dtype=np.uint8)
-        mask_add_total = np.zeros((h, w), dtype=np.uint8)
-        mask_del_total = np.zeros((h, w), dtype=np.uint8)
-
-        for (x, y, bw, bh) in boxes:
-            roi_a = old[y:y+bh, x:x+bw]
-            roi_b = new[y:y+bh, x:x+bw]
-            roi_mask = diff_mask_fast(roi_a, roi_b, fuzz=fuzz, use_lab=True)
-            if cv2.countNonZero(roi_mask) == 0:
-                continue
-            # Наращиваем общий mask
-            current = mask_total[y:y+bh, x:x+bw]
-            mask_total[y:y+bh, x:x+bw] = cv2.bitwise_or(current, roi_mask)
-
-            # Направление изменений (add/del) внутри ROI
-            old_lab = cv2.cvtColor(roi_a, cv2.COLOR_BGR2LAB)
-            new_lab = cv2.cvtColor(roi_b, cv2.COLOR_BGR2LAB)
-            diff_add = cv2.subtract(new_lab, old_lab)
-            diff_del = cv2.subtract(old_lab, new_lab)
-            gray_add = cv2.cvtColor(diff_add, cv2.COLOR_BGR2GRAY)
-            gray_del = cv2.cvtColor(diff_del, cv2.COLOR_BGR2GRAY)
-            _, add_bin = cv2.threshold(gray_add, max(1, int(fuzz)), 255, cv2.THRESH_BINARY)
-            _, del_bin = cv2.threshold(gray_del, max(1, int(fuzz)), 255, cv2.THRESH_BINARY)
-            add_bin = cv2.bitwise_and(add_bin, roi_mask)
-            del_bin = cv2.bitwise_and(del_bin, roi_mask)
-            # Наращиваем глобальные карты add/del
-            cur_a = mask_add_total[y:y+bh, x:x+bw]
-            cur_d = mask_del_total[y:y+bh, x:x+bw]
-            mask_add_total[y:y+bh, x:x+bw] = cv2.bitwise_or(cur_a, add_bin)
-            mask_del_total[y:y+bh, x:x+bw] = cv2.bitwise_or(cur_d, del_bin)
-
-        # Постобработка
-        mask_total = filter_small_components(mask_total, min_area=min_area)
-        mask_total = dilate_mask(mask_total, thickness=thick)
-        mask_add_total = cv2.bitwise_and(mask_add_total, mask_total)
-        mask_del_total = cv2.bitwise_and(mask_del_total, mask_total)
-
-        diff_pixels = int(cv2.countNonZero(mask_total))
-        if diff_pixels == 0:
-            del old, new
-            return 0
-
-        # Сборка RGBA overlay (как раньше)
-        overlay = np.zeros((h, w, 4), dtype=np.uint8)
-        overlay[..., :3] = new
-        overlay[..., 3] = 0
-        alpha_val = int(255 * 0.6)
-        overlay[mask_add_total > 0, :3] = add_color_bgr
-        overlay[mask_add_total > 0, 3] = alpha_val
-        overlay[mask_del_total > 0, :3] = del_color_bgr
-        overlay[mask_del_total > 0, 3] = alpha_val
-
-        # Запись результата
-        if (diff_pixels > 0) or (not save_only_diffs):
-            comp = int(png_compression)
-            if auto_png:
-                ratio = diff_pixels / float(h * w) if (h > 0 and w > 0) else 0.0
-                if ratio > 0.05:
-                    comp = 1
-                elif ratio > 0.005:
-                    comp = 2
-                else:
-                    comp = 4
-            cv2.imwrite(str(out_path), overlay, [cv2.IMWRITE_PNG_COMPRESSION, comp])
-        del old, new, overlay
-        return 1
-
-    # Fallback: старая двухцветная LAB‑дифференциация на весь кадр
-    debug_dir = Path(output_dir) / 'debug' if debug and output_dir else Path('.')
-    overlay, meta = diff_two_color(
-        old_img=old,
-        new_img=new,
-        sens=fuzz,
-        blur=3,
-        morph_open=morph_open,
-        min_area=min_area,
-        kernel=thick,
-        alpha=0.6,
-        gamma=gamma,
-        del_color=del_color_bgr,
-        add_color=add_color_bgr,
-        debug=debug,
-        debug_dir=debug_dir,
-        use_ssim=use_ssim,
-        match_tolerance=match_tolerance,
-        match_color=match_color_bgr
-    )
-
-    if (meta.get('diff_pixels', 0) > 0) or (not save_only_diffs):
-        comp = int(png_compression)
-        if auto_png and meta.get('total_pixels', 0):
+    ready = pyqtSignal(str, object)  # path, BGR миниатюра или None
+    _loaded = pyqtSignal(int, str, object)
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self._generation = 0
+        self._pending = None
+        self._cond = threading.Condition()
+        self._loaded.connect(self._deliver)
+        threading.Thread(target=self._loop, name="thumbnail-loader", daemon=True).start()
+
+    def request(self, path: str):
+        """Запрашивает миниатюру; из памяти отвечает сразу, иначе — в фоне."""
+        with self._cond:
+            self._generation += 1
+            generation = self._generation
+            thumb = self.cache.get(path, disk=False)
+            self._pending = None if thumb is not None else (generation, path)
+            self._cond.notify()
+        if thumb is not None:
+            self.ready.emit(path, thumb)
+
+    def cancel(self):
+        """Отменяет ожидающий запрос (результат текущего тоже будет отброшен)."""
+        with self._cond:
+            self._generation += 1
+            self._pending = None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                generation, path = self._pending
+                self._pending = None
             try:
-                ratio = float(meta['diff_pixels']) / float(meta['total_pixels'])
-                if ratio > 0.05:
-                    comp = 1
-                elif ratio > 0.005:
-                    comp = 2
-                else:
-                    comp = 4
-            except Exception:
-                pass
-        cv2.imwrite(str(out_path), overlay, [cv2.IMWRITE_PNG_COMPRESSION, comp])
+                thumb = self.cache.load(path)
+            except Exception as e:
+                logger.warning(f"Thumbnail failed for {path}: {e}")
+                thumb = None
+            self._loaded.emit(generation, path, thumb)
+
+    def _deliver(self, generation, path, thumb):
+        # Выбор уже сменился — миниатюра не нужна
+        if generation == self._generation:
+            self.ready.emit(path, thumb)
 
-    del old, new, overlay
-    return 1 if meta.get('diff_pixels', 0) > 0 else 0
 
 class DndTableWidget(QTableWidget):
     directory_dropped = pyqtSignal(str)
@@ -601,6 +495,8 @@ class FilteredTable(QWidget):
         self.sort_order = "asc"  # asc, desc, none
         self.filter_combo.lineEdit().textChanged.connect(self.apply_filter)
         self.table.currentCellChanged.connect(self.show_preview)
+        self.thumbnails = ThumbnailLoader(thumbnail_cache(), self)
+        self.thumbnails.ready.connect(self._set_preview)
         self.load_filter_history()
 
     def update_path_label(self):
@@ -742,11 +638,19 @@ class FilteredTable(QWidget):
         row = self.table.currentRow()
         if row >= 0 and row < len(self.filtered):
             img_path = self.files[self.filtered[row]][1]
-            pix = load_pixmap_scaled(img_path, max_size=400) # Маленькое превью
-            self.preview.setPixmap(pix.scaled(self.preview.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
+            # Маленькое превью из кэша миниатюр; декодирование — в фоне
+            self.thumbnails.request(img_path)
         else:
+            self.thumbnails.cancel()
             self.preview.clear()
 
+    def _set_preview(self, path, thumb):
+        if thumb is None:
+            self.preview.clear()
+            return
+        pix = QPixmap.fromImage(cv2_to_qimage(thumb))
+        self.preview.setPixmap(pix.scaled(self.preview.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
+
     def save_state(self, settings: QSettings):
         settings.setValue(f"{self.settings_key}/dir", self.dir_path)
         settings.setValue(f"{self.settings_key}/filter", self.filter_combo.currentText())
@@ -1097,13 +1001,9 @@ class MainWindow(QMainWindow):
         self.alignment_control_panel = None  # Будет создан при инициализации UI
         
         logger.debug('step 2')
-        # Пул потоков для параллельной обработки
-        self.threadpool = QThreadPool.globalInstance()
-        try:
-            import os as _os
-            self.threadpool.setMaxThreadCount(max(1, min((_os.cpu_count() or 4), 8)))
-        except Exception:
-            pass
+        # Конвейер пакетной обработки (потоки или пул процессов)
+        self.batch_runner = BatchRunner(self)
+        self.batch_runner.finished.connect(self._on_worker_finished)
         self.batch_total = 0
         self.batch_done = 0
         self.batch_ok = 0
@@ -1114,7 +1014,12 @@ class MainWindow(QMainWindow):
         self.paused = False
         # Результаты кеша между запусками
         self.result_cache = ResultCache()
-        self._cache_map = {}
+        # Маски анализа пар: повторное оформление без пересчёта
+        self.mask_cache = MaskCache()
+        # Хэши входов: неизменённые файлы (по stat) не перечитываются
+        self.fingerprints = FingerprintIndex()
+        # Строка таблицы результатов по имени (см. _ensure_result_row)
+        self._result_rows = {}
         # --- 🔘 Радиокнопки сравнения в QGroupBox ---
         self.radio_all = QRadioButton("Сравнить все")
         try:
@@ -1449,8 +1354,28 @@ class MainWindow(QMainWindow):
             self.workers_spin.setValue(max(1, min((_os.cpu_count() or 4), 8)))
         except Exception:
             self.workers_spin.setValue(4)
-        self.workers_spin.setToolTip("Количество параллельных задач")
+        self.workers_spin.setToolTip("Количество параллельных задач (потоков или процессов)")
         self.workers_spin.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Fixed)
+        self.executor_combo = QComboBox()
+        self.executor_combo.addItem("Потоки", "threads")
+        self.executor_combo.addItem("Процессы", "processes")
+        self.executor_combo.setToolTip(
+            "Где выполнять пакет: потоки (быстрый старт) или процессы "
+            "(без GIL, масштабируются на многоядерных машинах)"
+        )
+        self.executor_combo.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Fixed)
+        self.prefetch_spin = QSpinBox()
+        self.prefetch_spin.setRange(1, 64)
+        self.prefetch_spin.setValue(DEFAULT_PREFETCH)
+        self.prefetch_spin.setToolTip("Сколько пар читать с диска заранее, пока идёт сравнение")
+        self.prefetch_spin.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Fixed)
+        self.tile_size_spin = QSpinBox()
+        self.tile_size_spin.setRange(0, 16384)
+        self.tile_size_spin.setSingleStep(256)
+        self.tile_size_spin.setValue(0)
+        self.tile_size_spin.setSpecialValueText("Выкл.")
+        self.tile_size_spin.setToolTip("Потайловая обработка больших изображений: сторона тайла в px (0 = выкл.)")
+        self.tile_size_spin.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Fixed)
         # Append rows
         param_form.addRow("Fast core", self.fast_core_chk)
         param_form.addRow("Save only diffs", self.save_only_diffs_chk)
@@ -1461,6 +1386,9 @@ class MainWindow(QMainWindow):
         param_form.addRow("Auto-align", self.auto_align_chk)
         param_form.addRow("Auto-align up to (%)", self.auto_align_max_spin)
         param_form.addRow("Workers", self.workers_spin)
+        param_form.addRow("Executor", self.executor_combo)
+        param_form.addRow("Read-ahead (pairs)", self.prefetch_spin)
+        param_form.addRow("Tile size", self.tile_size_spin)
         param_group.setMaximumWidth(350)
         # --- 📚 Пояснения отдельным блоком ---
         param_help = QLabel(
@@ -2602,11 +2530,10 @@ class MainWindow(QMainWindow):
         add_color_bgr = (self.add_color.blue(), self.add_color.green(), self.add_color.red())
         match_color_bgr = (self.match_color.blue(), self.match_color.green(), self.match_color.red())
 
-        # Настроить пул потоков
-        try:
-            self.threadpool.setMaxThreadCount(int(self.workers_spin.value()))
-        except Exception:
-            pass
+        # Сравнение в потоках или процессах, чтение на prefetch пар вперёд
+        use_processes = hasattr(self, 'executor_combo') and self.executor_combo.currentData() == "processes"
+        workers = int(self.workers_spin.value())
+        prefetch = DEFAULT_PREFETCH if not hasattr(self, 'prefetch_spin') else int(self.prefetch_spin.value())
         use_fast_core = True if not hasattr(self, 'fast_core_chk') else self.fast_core_chk.isChecked()
         save_only_diffs = True if not hasattr(self, 'save_only_diffs_chk') else self.save_only_diffs_chk.isChecked()
         png_compression = 1 if not hasattr(self, 'png_compression_spin') else int(self.png_compression_spin.value())
@@ -2615,106 +2542,85 @@ class MainWindow(QMainWindow):
         quick_max_side = 256 if not hasattr(self, 'quick_max_side_spin') else int(self.quick_max_side_spin.value())
         auto_align = False if not hasattr(self, 'auto_align_chk') else self.auto_align_chk.isChecked()
         auto_align_max_percent = 1.0 if not hasattr(self, 'auto_align_max_spin') else float(self.auto_align_max_spin.value())
-
-        # Пройти пары: сначала кеш‑хиты, потом запуск задач
+        tile_size = 0 if not hasattr(self, 'tile_size_spin') else int(self.tile_size_spin.value())
+
+        # Хэши входов и проверка кэшей — первая стадия конвейера (CacheProbe),
+        # в его потоках: окно не ждёт чтения файлов, попадания приходят
+        # в таблицу по мере готовности
+        settings = {
+            'fuzz': fuzz,
+            'thick': thick,
+            'min_area': min_area,
+            'gamma': gamma,
+            'morph_open': morph_open,
+            'use_ssim': use_ssim,
+            'match_tolerance': match_tolerance,
+            'del_color_bgr': del_color_bgr,
+            'add_color_bgr': add_color_bgr,
+            'use_fast_core': use_fast_core,
+        }
+        # Без тайлов ключ тот же, что у прежних версий: перенесённый кэш попадает
+        if tile_size:
+            settings['tile_size'] = tile_size
+        settings_hash = compute_settings_hash(settings)
+        # Маски анализа не зависят от цветов и толщины обводки: при их смене
+        # результат собирается из кэша масок без повторного сравнения
+        analysis_hash = compute_settings_hash(analysis_settings({
+            'fuzz': fuzz, 'min_area': min_area, 'use_ssim': use_ssim,
+            'match_tolerance': match_tolerance, 'tile_size': tile_size,
+        })) if use_fast_core else None
+        probe = CacheProbe(self.fingerprints, self.result_cache, settings_hash, self.mask_cache, analysis_hash)
+        jobs = []
         for i, (a, b) in enumerate(zip(files_a, files_b)):
             out_name = f"{Path(a).stem}__vs__{Path(b).stem}_outline.png"
             out_path = Path(self.output_dir) / out_name
             self._ensure_result_row(out_name, str(out_path))
-            self.progress_bar.setFormat(f"��ࠡ�⪠: {Path(a).name} vs {Path(b).name}")
+            jobs.append(BatchJob(i, a, b, out_path, name=out_name))
 
-            # Кеш: вычислить ключ
-            cached = None
-            try:
-                img_a_hash = compute_file_hash(a)
-                img_b_hash = compute_file_hash(b)
-                settings = {
-                    'fuzz': fuzz,
-                    'thick': thick,
-                    'min_area': min_area,
-                    'gamma': gamma,
-                    'morph_open': morph_open,
-                    'use_ssim': use_ssim,
-                    'match_tolerance': match_tolerance,
-                    'del_color_bgr': del_color_bgr,
-                    'add_color_bgr': add_color_bgr,
-                    'use_fast_core': use_fast_core,
-                }
-                settings_hash = compute_settings_hash(settings)
-                cache_key = self.result_cache.get_cache_key(img_a_hash, img_b_hash, settings_hash)
-                cached = self.result_cache.get(cache_key)
-                # сохранить ключ для записи результата по завершении
-                self._cache_map[out_name] = cache_key
-            except Exception:
-                cache_key = None
-
-            if cached and isinstance(cached, dict):
-                code_cached = cached.get('code')
-                if code_cached == 0:
-                    row = self._ensure_result_row(out_name, str(out_path))
-                    self.result_table.setItem(row, 1, QTableWidgetItem("Equal (cached)"))
-                    self.batch_done += 1
-                    self.batch_equal += 1
-                    self.progress_bar.setValue(self.batch_done)
-                    QApplication.processEvents()
-                    continue
-                if code_cached == 1 and out_path.exists():
-                    row = self._ensure_result_row(out_name, str(out_path))
-                    self.result_table.setItem(row, 1, QTableWidgetItem("OK (cached)"))
-                    self.batch_done += 1
-                    self.batch_ok += 1
-                    self.progress_bar.setValue(self.batch_done)
-                    QApplication.processEvents()
-                    continue
-
-            # Параметры воркера
-            params = {
-                'fuzz': fuzz,
-                'thick': thick,
-                'match_tolerance': match_tolerance,
-                'gamma': gamma,
-                'morph_open': morph_open,
-                'min_area': min_area,
-                'debug': debug,
-                'use_ssim': use_ssim,
-                'del_color_bgr': del_color_bgr,
-                'add_color_bgr': add_color_bgr,
-                'match_color_bgr': match_color_bgr,
-                'output_dir': self.output_dir,
-                'out_name': out_name,
-                'use_fast_core': use_fast_core,
-                'save_only_diffs': save_only_diffs,
-                'png_compression': png_compression,
-                'auto_png': auto_png,
-                'quick_max_side': quick_max_side,
-                'auto_align': auto_align,
-                'auto_align_max_percent': auto_align_max_percent,
-                'cancel_fn': (lambda: self.cancel_requested),
-                'pause_fn': (lambda: self.paused),
-                'cache_key': cache_key,
-            }
-            worker = CompareWorker(a, b, out_path, params)
-            worker.signals.finished.connect(self._on_worker_finished)
-            self.threadpool.start(worker)
-        # duplicate launch loop removed to avoid double-running tasks
+        if not jobs:
+            return
+        # Общие параметры сравнения для всех пар пакета
+        params = {
+            'fuzz': fuzz,
+            'thick': thick,
+            'match_tolerance': match_tolerance,
+            'gamma': gamma,
+            'morph_open': morph_open,
+            'min_area': min_area,
+            'debug': debug,
+            'use_ssim': use_ssim,
+            'del_color_bgr': del_color_bgr,
+            'add_color_bgr': add_color_bgr,
+            'match_color_bgr': match_color_bgr,
+            'output_dir': self.output_dir,
+            'use_fast_core': use_fast_core,
+            'save_only_diffs': save_only_diffs,
+            'png_compression': png_compression,
+            'auto_png': auto_png,
+            'quick_max_side': quick_max_side,
+            'auto_align': auto_align,
+            'auto_align_max_percent': auto_align_max_percent,
+            'tile_size': tile_size,
+        }
+        self.batch_runner.start(
+            jobs, params, workers, use_processes=use_processes, prefetch=prefetch,
+            cancel_fn=(lambda: self.cancel_requested),
+            pause_fn=(lambda: self.paused),
+            probe=probe,
+        )
 
-    def _on_worker_finished(self, out_name: str, out_path: str, code: int, error_message: str, duration_s: float = 0.0):
-        # Persist result to cache if key is known
-        try:
-            cache_key = getattr(self, '_cache_map', {}).get(out_name)
-            if cache_key:
-                self.result_cache.put(cache_key, {
-                    'code': int(code),
-                    'duration_s': float(duration_s),
-                    'out_path': str(out_path),
-                })
-        except Exception:
-            pass
+    def _on_worker_finished(self, out_name: str, out_path: str, code: int, error_message: str,
+                            duration_s: float = 0.0, timings=None, cached: bool = False):
+        # Результат уже сохранён в кэш потоком конвейера (BatchRunner)
+        if timings and not cached:
+            logger.debug(
+                f"{out_name}: " + " ".join(f"{k}={v * 1000:.1f}ms" for k, v in timings.items())
+            )
         if code == 1:
-            status = "OK"
+            status = "OK (cached)" if cached else "OK"
             self.batch_ok += 1
         elif code == 0:
-            status = "Equal"
+            status = "Equal (cached)" if cached else "Equal"
             self.batch_equal += 1
         else:
             status = f"Error{(': ' + error_message) if error_message else ''}"
@@ -2730,6 +2636,13 @@ class MainWindow(QMainWindow):
         if self.batch_done >= self.batch_total:
             self.progress_bar.hide()
             self.progress_bar.setFormat("")
+            # Результаты пакета — в кэш на диске одной транзакцией
+            try:
+                self.result_cache.flush()
+                self.mask_cache.flush()
+                self.fingerprints.flush()
+            except Exception as e:
+                logger.warning(f"Result cache flush failed: {e}")
             gc.collect()
             message = (
                 "Сравнение завершено!\n\n"
@@ -2744,17 +2657,30 @@ class MainWindow(QMainWindow):
             self.update_save_button_state()
 
     def _ensure_result_row(self, name: str, path: str) -> int:
-        for r in range(self.result_table.rowCount()):
-            item = self.result_table.item(r, 0)
-            if item and item.text() == name:
-                if not self.result_table.item(r, 2):
-                    self.result_table.setItem(r, 2, QTableWidgetItem(path))
-                return r
-        r = self.result_table.rowCount()
-        self.result_table.insertRow(r)
-        self.result_table.setItem(r, 0, QTableWidgetItem(name))
-        self.result_table.setItem(r, 1, QTableWidgetItem(""))
-        self.result_table.setItem(r, 2, QTableWidgetItem(path))
+        # Индекс строк по имени: без него пакет из тысяч пар — квадратичный
+        # перебор таблицы. Индекс перестраивается, если таблицу очистили
+        # или пересортировали
+        table = self.result_table
+        r = self._result_rows.get(name)
+        item = table.item(r, 0) if r is not None else None
+        stale = (item is None or item.text() != name) if r is not None else len(self._result_rows) != table.rowCount()
+        if stale:
+            self._result_rows = {}
+            for row in range(table.rowCount()):
+                item = table.item(row, 0)
+                if item:
+                    self._result_rows[item.text()] = row
+            r = self._result_rows.get(name)
+        if r is not None:
+            if not table.item(r, 2):
+                table.setItem(r, 2, QTableWidgetItem(path))
+            return r
+        r = table.rowCount()
+        table.insertRow(r)
+        table.setItem(r, 0, QTableWidgetItem(name))
+        table.setItem(r, 1, QTableWidgetItem(""))
+        table.setItem(r, 2, QTableWidgetItem(path))
+        self._result_rows[name] = r
         return r
 
     def run_outline(self, left, right, out_path, fuzz, thick, color_hex, match_tolerance, match_color):
@@ -2893,6 +2819,12 @@ class MainWindow(QMainWindow):
                     self.workers_spin.setValue(max(1, min((_os.cpu_count() or 4), 8)))
                 except Exception:
                     self.workers_spin.setValue(4)
+            if hasattr(self, 'executor_combo'):
+                self.executor_combo.setCurrentIndex(0)
+            if hasattr(self, 'prefetch_spin'):
+                self.prefetch_spin.setValue(DEFAULT_PREFETCH)
+            if hasattr(self, 'tile_size_spin'):
+                self.tile_size_spin.setValue(0)
             self.debug_chk.setChecked(False)
             self.ssim_chk.setChecked(False)
 
@@ -3162,6 +3094,10 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self, event):
         self.save_state()
+        self.batch_runner.shutdown()
+        self.result_cache.close()
+        self.mask_cache.close()
+        self.fingerprints.close()
         super().closeEvent(event)
 
     def save_state(self):
@@ -3198,6 +3134,12 @@ class MainWindow(QMainWindow):
             # REMOVED: quick_ratio_percent setting - control no longer exists
             self.settings.setValue("quick_max_side", int(self.quick_max_side_spin.value()))
             self.settings.setValue("workers", int(self.workers_spin.value()))
+            if hasattr(self, 'executor_combo'):
+                self.settings.setValue("executor", self.executor_combo.currentData())
+            if hasattr(self, 'prefetch_spin'):
+                self.settings.setValue("prefetch", int(self.prefetch_spin.value()))
+            if hasattr(self, 'tile_size_spin'):
+                self.settings.setValue("tile_size", int(self.tile_size_spin.value()))
         except Exception:
             pass
         # Сохраняем размеры сплиттеров
@@ -3293,6 +3235,17 @@ class MainWindow(QMainWindow):
             workers = self.settings.value("workers")
             if workers and hasattr(self, 'workers_spin'):
                 self.workers_spin.setValue(int(workers))
+            executor = self.settings.value("executor")
+            if executor and hasattr(self, 'executor_combo'):
+                idx = self.executor_combo.findData(executor)
+                if idx >= 0:
+                    self.executor_combo.setCurrentIndex(idx)
+            prefetch = self.settings.value("prefetch")
+            if prefetch and hasattr(self, 'prefetch_spin'):
+                self.prefetch_spin.setValue(int(prefetch))
+            tile_size = self.settings.value("tile_size")
+            if tile_size is not None and hasattr(self, 'tile_size_spin'):
+                self.tile_size_spin.setValue(int(tile_size))
         except Exception:
             pass
         # Восстанавливаем размеры сплиттеров
@@ -4852,6 +4805,8 @@ class ExternalResultViewer(QWidget):
 
 
 if __name__ == "__main__":
+    # Процессы-воркеры (spawn) в собранном exe запускают этот же файл
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     app.setStyle("Fusion")
     # Кастомизация Fusion
@@ -1,8 +1,11 @@
 """
 CLI интерфейс для imgdiff
 """
+import os
 import sys
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Optional
 
@@ -17,16 +20,29 @@ except ImportError:
 import cv2
 import numpy as np
 
-from .core.diff import diff_mask_fast, coarse_to_fine
-from .core.overlay import draw_diff_overlay, create_heatmap, draw_contours_on_image
-from .core.io import safe_imread, safe_imwrite
+from .core.diff import diff_mask_fast, coarse_to_fine, rois_to_mask
+from .core.tiled import diff_mask_tiled, TILE_SIZE
+from .core.batch import BatchJob, BatchPipeline, DEFAULT_PREFETCH, in_order
+from .core.check import check_images
+from .core.equality import files_identical
+from .core.workspace import thread_workspace
+from .core.overlay import draw_diff_overlay, create_heatmap, diff_magnitude, draw_contours_on_image
+from .core.encoder import encode_image
+from .core.io import FingerprintIndex, ResultCache, compute_settings_hash, safe_imread, safe_imwrite
 from .core.morph import filter_small_components, dilate_mask
+from .core.components import STRIP_ROWS, Components
+from .core.pipeline import shutdown_executor, worker_init
 
 
 if TYPER_AVAILABLE:
     app = typer.Typer(help="Imgdiff - Быстрое сравнение изображений")
     console = Console()
 
+# Коды выхода режима --check
+EXIT_PASS = 0
+EXIT_DIFFERENT = 1
+EXIT_ERROR = 2
+
 
 def compare_images_core(
     img_a: np.ndarray,
@@ -36,33 +52,254 @@ def compare_images_core(
     use_coarse: bool = True,
     min_area: int = 50,
     thickness: int = 2,
-    color: tuple = (0, 0, 255)
+    color: tuple = (0, 0, 255),
+    tile_size: int = 0
 ):
     """
     Ядро сравнения изображений (используется из CLI и GUI).
+    
+    При tile_size > 0 маска считается потайлово (diff_mask_tiled), а фильтр
+    компонент и расширение идут на месте полосами: результат тот же, что у
+    прямого сравнения, а сверх самой маски (1 Б/px) память — тайл и полоса.
+    Промежуточные буферы берутся из workspace потока и переиспользуются
+    между вызовами (batch не аллоцирует их на каждую пару).
     """
-    if use_coarse:
-        # Многомасштабный подход
-        boxes = coarse_to_fine(img_a, img_b, fuzz=fuzz, use_lab=use_lab, min_area=min_area)
-        
-        # Создаём полную маску из боксов
-        mask = np.zeros(img_a.shape[:2], np.uint8)
-        for x, y, w, h in boxes:
-            roi_a = img_a[y:y+h, x:x+w]
-            roi_b = img_b[y:y+h, x:x+w]
-            roi_mask = diff_mask_fast(roi_a, roi_b, fuzz=fuzz, use_lab=use_lab)
-            mask[y:y+h, x:x+w] = cv2.bitwise_or(mask[y:y+h, x:x+w], roi_mask)
+    ws = thread_workspace()
+    tiled = bool(tile_size and tile_size > 0)
+    if tiled:
+        # Потайловый проход для очень больших изображений
+        mask = diff_mask_tiled(img_a, img_b, fuzz=fuzz, use_lab=use_lab, tile_size=tile_size,
+                               workspace=ws)
+    elif use_coarse:
+        # Многомасштабный подход: маски ROI уже уточнены, собираем без пересчёта
+        rois = coarse_to_fine(img_a, img_b, fuzz=fuzz, use_lab=use_lab, min_area=min_area,
+                              return_masks=True, workspace=ws)
+        mask = rois_to_mask(img_a.shape, rois)
     else:
         # Прямое сравнение
-        mask = diff_mask_fast(img_a, img_b, fuzz=fuzz, use_lab=use_lab)
+        mask = diff_mask_fast(img_a, img_b, fuzz=fuzz, use_lab=use_lab, workspace=ws)
     
-    # Фильтрация и расширение
+    # Фильтрация и расширение; маска потайлового прохода своя — правим на месте
+    if tiled:
+        filter_small_components(mask, min_area=min_area, dst=mask)
+        return dilate_mask(mask, thickness=thickness, strip=STRIP_ROWS, dst=mask)
     mask = filter_small_components(mask, min_area=min_area)
     mask = dilate_mask(mask, thickness=thickness)
     
     return mask
 
 
+class ContourComparator:
+    """
+    Сравнение пары для batch: B приводится к размеру A, отличия обводятся
+    контурами на B. Объект сериализуется и годится для BatchPipeline.
+    """
+
+    # batch пишет результат для каждой пары, в том числе равной
+    quick_equal = False
+
+    def __init__(self, fuzz: int = 10, use_lab: bool = True, tile_size: int = 0):
+        self.fuzz = fuzz
+        self.use_lab = use_lab
+        self.tile_size = tile_size
+
+    def overlay_shape(self, shape_a: tuple, shape_b: tuple) -> tuple:
+        """Форма результата: кадр A, три канала"""
+        return tuple(shape_a[:2]) + (3,)
+
+    def __call__(self, img_a: np.ndarray, img_b: np.ndarray, timer, out: Optional[np.ndarray] = None):
+        """
+        :return: (1, изображение с контурами, параметры imencode); параметры не None —
+                 иначе конвейер в режиме процессов считает, что записывать нечего
+        """
+        with timer.stage('compare'):
+            if img_a.shape != img_b.shape:
+                img_b = cv2.resize(img_b, (img_a.shape[1], img_a.shape[0]))
+            mask = compare_images_core(img_a, img_b, fuzz=self.fuzz, use_lab=self.use_lab,
+                                       tile_size=self.tile_size)
+            result = draw_contours_on_image(img_b, mask, (0, 0, 255), 2)
+        if out is not None:
+            np.copyto(out, result)
+            result = out
+        return 1, result, ()
+
+    def encode(self, result: np.ndarray, out_path, params=None) -> np.ndarray:
+        """Кодирование результата в формат по расширению out_path"""
+        return encode_image(result, Path(out_path).suffix, params)
+
+
+def batch_jobs(dir_a: Path, dir_b: Path, output_dir: Path, pattern: str = "*.png"):
+    """
+    Пары файлов с одинаковыми именами в двух директориях.
+
+    :param dir_a: директория A
+    :param dir_b: директория B
+    :param output_dir: директория результатов
+    :param pattern: glob-паттерн файлов
+    :return: (задачи BatchJob, имена файлов A без пары)
+    """
+    files_b = {f.name: f for f in dir_b.glob(pattern)}
+    jobs = []
+    missing = []
+    for file_a in sorted(dir_a.glob(pattern)):
+        if file_a.name not in files_b:
+            missing.append(file_a.name)
+            continue
+        jobs.append(BatchJob(len(jobs), file_a, files_b[file_a.name], output_dir / file_a.name, name=file_a.name))
+    return jobs, missing
+
+
+def split_cached_jobs(jobs, cache: ResultCache, fingerprints: FingerprintIndex, settings: dict):
+    """
+    Отделяет пары, результат которых уже есть: входы не изменились
+    (хэши из FingerprintIndex), настройки те же и файл результата на месте.
+
+    :param jobs: задачи BatchJob
+    :param cache: кэш результатов
+    :param fingerprints: индекс хэшей файлов
+    :param settings: настройки сравнения, влияющие на результат
+    :return: (задачи к выполнению, готовые задачи с кодом из кэша,
+              ключи кэша по BatchJob.index)
+    """
+    settings_hash = compute_settings_hash(settings)
+    todo, cached, keys = [], [], {}
+    for job in jobs:
+        try:
+            job.file_hashes = (fingerprints.digest(job.left), fingerprints.digest(job.right))
+        except OSError:
+            todo.append(job)
+            continue
+        key = cache.get_cache_key(job.file_hashes[0], job.file_hashes[1], settings_hash)
+        hit = cache.get(key)
+        if hit is not None and hit.get('code', -1) >= 0 and Path(job.out_path).exists():
+            job.code = int(hit['code'])
+            cached.append(job)
+        else:
+            keys[job.index] = key
+            todo.append(job)
+    return todo, cached, keys
+
+
+def batch_executor(jobs: int, threads_per_job: Optional[int] = None,
+                   timeout: Optional[float] = None) -> Optional[ProcessPoolExecutor]:
+    """
+    Пул процессов для сравнения пар batch.
+
+    :param jobs: число процессов
+    :param threads_per_job: потоков OpenCV в каждом процессе (None — 1)
+    :param timeout: таймаут пары; он работает только в пуле, поэтому
+                    с таймаутом пул создаётся и при jobs=1
+    :return: ProcessPoolExecutor или None (одна пара за раз в потоке)
+    """
+    if jobs <= 1 and not timeout:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=max(1, jobs), mp_context=multiprocessing.get_context('spawn'),
+        initializer=worker_init, initargs=(threads_per_job if threads_per_job else 1,)
+    )
+
+
+def stop_executor(executor: ProcessPoolExecutor, kill: bool = False) -> None:
+    """
+    Останавливает пул batch.
+
+    :param executor: пул процессов
+    :param kill: завершить процессы, не дожидаясь зависших задач (после таймаутов)
+    """
+    if not kill:
+        shutdown_executor(executor, wait=True)
+        return
+    terminate = getattr(executor, 'terminate_workers', None)
+    if terminate is not None:
+        # Python 3.14+
+        terminate()
+        return
+    # До 3.14 публичного способа прервать задачу у ProcessPoolExecutor нет
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    shutdown_executor(executor, wait=False)
+    for process in processes:
+        process.terminate()
+
+
+def check_pair(
+    path_a: str,
+    path_b: str,
+    fuzz: int = 10,
+    use_lab: bool = True,
+    max_diff_percent: float = 0.0,
+    tile_size: int = 0
+) -> dict:
+    """
+    Проверка пары файлов для CI: только решение и процент различий.
+    Побайтно одинаковые файлы не декодируются; маска не рендерится.
+    
+    :param path_a: путь к первому изображению
+    :param path_b: путь ко второму изображению
+    :param fuzz: порог различия
+    :param use_lab: использовать Lab пространство
+    :param max_diff_percent: допустимая доля различий в процентах
+    :param tile_size: сторона тайла (0 — по умолчанию)
+    :return: результат check_images (+ ключ 'reason');
+             отсутствующие/нечитаемые файлы — исключение
+    """
+    if files_identical(path_a, path_b):
+        return {'different': False, 'diff_pixels': 0, 'diff_percent': 0.0, 'exact': True,
+                'reason': 'identical bytes'}
+    
+    img_a = safe_imread(path_a)
+    img_b = safe_imread(path_b)
+    if img_a is None or img_b is None:
+        raise IOError(f"Не удалось загрузить {path_a} или {path_b}")
+    if img_a.shape != img_b.shape:
+        return {'different': True, 'diff_pixels': 0, 'diff_percent': 100.0, 'exact': True,
+                'size_mismatch': True, 'reason': f'size mismatch {img_a.shape} vs {img_b.shape}'}
+    
+    result = check_images(img_a, img_b, fuzz=fuzz, use_lab=use_lab,
+                          max_diff_percent=max_diff_percent,
+                          tile_size=tile_size if tile_size > 0 else TILE_SIZE,
+                          workspace=thread_workspace())
+    result['reason'] = 'pixels'
+    return result
+
+
+def format_check(result: dict, max_diff_percent: float) -> str:
+    """Строка отчёта режима --check."""
+    verdict = "FAIL" if result['different'] else "PASS"
+    if result.get('size_mismatch'):
+        return f"{verdict}: размеры не совпадают ({result.get('reason', '')})"
+    sign = ">" if not result.get('exact', True) else ""
+    return (f"{verdict}: различия {sign}{result['diff_percent']:.4f}% "
+            f"(допуск {max_diff_percent}%, {result.get('reason', '')})")
+
+
+def region_report(img_a: np.ndarray, img_b: np.ndarray, mask: np.ndarray,
+                  use_lab: bool = True, limit: int = 10) -> list:
+    """
+    Регионы различий по маске, от крупных к мелким.
+
+    :param img_a: изображение A (BGR)
+    :param img_b: изображение B (BGR) того же размера
+    :param mask: маска различий (как у compare_images_core)
+    :param use_lab: величина различия как ΔE в Lab
+    :param limit: сколько регионов вернуть (0 — все)
+    :return: список словарей Components.regions (bbox, area, centroid, mean_delta, max_delta)
+    """
+    delta = diff_magnitude(img_a, img_b, use_lab=use_lab)
+    regions = Components.from_mask(mask).regions(delta=delta)
+    regions.sort(key=lambda r: r['area'], reverse=True)
+    return regions[:limit] if limit > 0 else regions
+
+
+def format_regions(regions: list) -> str:
+    """Строки отчёта по регионам: рамка, площадь, среднее/максимум различия."""
+    lines = []
+    for i, r in enumerate(regions, 1):
+        x, y, w, h = r['bbox']
+        lines.append(f"{i:3d}. x={x} y={y} {w}x{h}  площадь {r['area']}  "
+                     f"Δ ср. {r['mean_delta']:.1f} / макс. {r['max_delta']:.1f}")
+    return "\n".join(lines)
+
+
 if TYPER_AVAILABLE:
     @app.command()
     def compare(
@@ -78,10 +315,25 @@ if TYPER_AVAILABLE:
         color_r: int = typer.Option(0, "--color-r", help="Красный компонент цвета (0-255)"),
         color_g: int = typer.Option(0, "--color-g", help="Зелёный компонент цвета (0-255)"),
         color_b: int = typer.Option(255, "--color-b", help="Синий компонент цвета (0-255)"),
+        tile_size: int = typer.Option(0, "--tile-size", help="Потайловая обработка тайлами NxN (0 = выкл.)"),
+        check: bool = typer.Option(False, "--check", help="Только проверка: код выхода 0 — в допуске, 1 — различаются, 2 — ошибка"),
+        max_diff_percent: float = typer.Option(0.0, "--max-diff-percent", help="Допуск различий для --check (%)"),
+        regions: int = typer.Option(0, "--regions", help="Вывести N крупнейших регионов различий (0 = не выводить)"),
     ):
         """
         Сравнивает два изображения и сохраняет результат.
         """
+        if check:
+            # Без маски для вывода, рендера и записи PNG
+            try:
+                result = check_pair(str(image_a), str(image_b), fuzz=fuzz, use_lab=use_lab,
+                                    max_diff_percent=max_diff_percent, tile_size=tile_size)
+            except Exception as e:
+                console.print(f"[red]Ошибка: {e}[/red]")
+                raise typer.Exit(EXIT_ERROR) from e
+            console.print(format_check(result, max_diff_percent))
+            raise typer.Exit(EXIT_DIFFERENT if result['different'] else EXIT_PASS)
+        
         # Проверка путей
         if not image_a.exists():
             console.print(f"[red]Ошибка: файл {image_a} не найден[/red]")
@@ -109,7 +361,8 @@ if TYPER_AVAILABLE:
         # Сравнение
         console.print("Сравнение...")
         color_bgr = (color_b, color_g, color_r)  # RGB -> BGR
-        mask = compare_images_core(img_a, img_b, fuzz, use_lab, use_coarse, min_area, thickness, color_bgr)
+        mask = compare_images_core(img_a, img_b, fuzz, use_lab, use_coarse, min_area, thickness, color_bgr,
+                                   tile_size=tile_size)
         
         # Создание результата
         if mode == "contours":
@@ -134,6 +387,11 @@ if TYPER_AVAILABLE:
             
             console.print(f"[green]Готово![/green]")
             console.print(f"Различающихся пикселей: {diff_pixels:,} ({diff_percent:.2f}%)")
+            if regions > 0:
+                found = region_report(img_a, img_b, mask, use_lab=use_lab, limit=0)
+                console.print(f"Регионов различий: {len(found)}")
+                if found:
+                    console.print(format_regions(found[:regions]))
         else:
             console.print(f"[red]Ошибка при сохранении результата[/red]")
             raise typer.Exit(1)
@@ -147,9 +405,29 @@ if TYPER_AVAILABLE:
         fuzz: int = typer.Option(10, "--fuzz", "-f", help="Порог различия"),
         use_lab: bool = typer.Option(True, "--lab/--rgb", help="Использовать Lab пространство"),
         pattern: str = typer.Option("*.png", "--pattern", "-p", help="Паттерн файлов"),
+        tile_size: int = typer.Option(0, "--tile-size", help="Потайловая обработка тайлами NxN (0 = выкл.)"),
+        prefetch: int = typer.Option(DEFAULT_PREFETCH, "--prefetch",
+                                     help="Сколько пар читать заранее, пока идёт сравнение"),
+        cache_dir: Optional[Path] = typer.Option(None, "--cache-dir",
+                                                 help="Кэш результатов: пропускать неизменённые пары"),
+        jobs_count: int = typer.Option(os.cpu_count() or 1, "--jobs", "-j",
+                                       help="Процессов сравнения (1 — без пула процессов)"),
+        threads_per_job: Optional[int] = typer.Option(None, "--threads-per-job",
+                                                      help="Потоков OpenCV на процесс (по умолчанию 1 в пуле)"),
+        timeout: Optional[float] = typer.Option(None, "--timeout",
+                                                help="Предел сравнения одной пары, секунд"),
+        ordered: bool = typer.Option(False, "--ordered/--unordered",
+                                     help="Выводить результаты в порядке пар, а не по готовности"),
+        verbose: bool = typer.Option(False, "--verbose", "-v", help="Строка на каждую пару"),
     ):
         """
         Пакетное сравнение изображений из двух директорий.
+        
+        Чтение, декодирование, сравнение и запись идут конвейером:
+        следующие пары читаются с диска, пока сравнивается текущая.
+        Сравнения выполняются в --jobs процессах (кадры передаются через
+        разделяемую память). С --cache-dir пары с неизменёнными входами
+        (по stat-отпечаткам) и уже записанным результатом не пересчитываются.
         """
         if not dir_a.is_dir() or not dir_b.is_dir():
             console.print("[red]Ошибка: один из путей не является директорией[/red]")
@@ -157,42 +435,61 @@ if TYPER_AVAILABLE:
         
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Получаем списки файлов
-        files_a = sorted(dir_a.glob(pattern))
-        files_b_dict = {f.name: f for f in dir_b.glob(pattern)}
-        
-        console.print(f"Найдено {len(files_a)} файлов в директории A")
+        jobs, missing = batch_jobs(dir_a, dir_b, output_dir, pattern)
+        console.print(f"Найдено {len(jobs) + len(missing)} файлов в директории A")
+        for name in missing:
+            console.print(f"[yellow]Пропуск {name}: нет пары в директории B[/yellow]")
         
         processed = 0
         errors = 0
+        timeouts = 0
+        cache = fingerprints = None
+        keys = {}
+        if cache_dir is not None:
+            cache = ResultCache(cache_dir)
+            fingerprints = FingerprintIndex(cache_dir)
+            settings = {'mode': 'contours', 'fuzz': fuzz, 'use_lab': use_lab, 'tile_size': tile_size}
+            jobs, cached, keys = split_cached_jobs(jobs, cache, fingerprints, settings)
+            if cached:
+                console.print(f"Без изменений (из кэша): {len(cached)}")
         
-        for file_a in track(files_a, description="Обработка..."):
-            if file_a.name not in files_b_dict:
-                console.print(f"[yellow]Пропуск {file_a.name}: нет пары в директории B[/yellow]")
-                continue
-            
-            file_b = files_b_dict[file_a.name]
-            output_file = output_dir / file_a.name
-            
-            try:
-                img_a = safe_imread(str(file_a))
-                img_b = safe_imread(str(file_b))
-                
-                if img_a is None or img_b is None:
-                    raise Exception("Ошибка загрузки")
-                
-                if img_a.shape != img_b.shape:
-                    img_b = cv2.resize(img_b, (img_a.shape[1], img_a.shape[0]))
-                
-                mask = compare_images_core(img_a, img_b, fuzz=fuzz, use_lab=use_lab)
-                result = draw_contours_on_image(img_b, mask, (0, 0, 255), 2)
-                
-                safe_imwrite(str(output_file), result)
-                processed += 1
-                
-            except Exception as e:
-                console.print(f"[red]Ошибка при обработке {file_a.name}: {e}[/red]")
-                errors += 1
+        jobs_count = max(1, jobs_count)
+        if threads_per_job is not None and jobs_count <= 1 and not timeout:
+            cv2.setNumThreads(threads_per_job)
+        executor = batch_executor(jobs_count, threads_per_job, timeout)
+        pipeline = BatchPipeline(
+            ContourComparator(fuzz=fuzz, use_lab=use_lab, tile_size=tile_size),
+            # Чтение и декодирование в главном процессе должны успевать за пулом
+            prefetch=max(prefetch, jobs_count),
+            read_workers=max(2, min(jobs_count, 8)),
+            decode_workers=max(2, jobs_count // 2),
+            compare_workers=jobs_count if executor is not None else 1,
+            executor=executor,
+            timeout=timeout,
+        )
+        results = pipeline.run(jobs)
+        if ordered:
+            # Конвейер выдаёт пары по готовности — вывод ждёт предыдущие
+            results = in_order(results, [job.index for job in jobs])
+        try:
+            for job in track(results, total=len(jobs), description="Обработка..."):
+                if job.code < 0:
+                    console.print(f"[red]Ошибка при обработке {job.name}: {job.error}[/red]")
+                    errors += 1
+                    timeouts += job.error.startswith("Timeout")
+                else:
+                    processed += 1
+                    if verbose:
+                        console.print(f"{job.name} → {job.out_path} ({job.duration:.2f} с)")
+                    if job.index in keys:
+                        cache.put(keys[job.index], {'code': job.code, 'duration_s': job.duration,
+                                                    'out_path': job.out_path})
+        finally:
+            if executor is not None:
+                stop_executor(executor, kill=timeouts > 0)
+            if cache is not None:
+                cache.close()
+                fingerprints.close()
         
         console.print(f"\n[green]Обработано: {processed}, ошибок: {errors}[/green]")
 
@@ -208,9 +505,22 @@ def main():
         parser.add_argument("image_b", help="Второе изображение")
         parser.add_argument("-o", "--output", default="diff.png", help="Выходной файл")
         parser.add_argument("-f", "--fuzz", type=int, default=10, help="Порог различия")
+        parser.add_argument("--check", action="store_true", help="Только проверка (код выхода 0/1/2)")
+        parser.add_argument("--max-diff-percent", type=float, default=0.0, help="Допуск различий для --check (%%)")
+        parser.add_argument("--regions", type=int, default=0, help="Вывести N крупнейших регионов различий")
         
         args = parser.parse_args()
         
+        if args.check:
+            try:
+                result = check_pair(args.image_a, args.image_b, fuzz=args.fuzz,
+                                    max_diff_percent=args.max_diff_percent)
+            except Exception as e:
+                print(f"Ошибка: {e}")
+                sys.exit(EXIT_ERROR)
+            print(format_check(result, args.max_diff_percent))
+            sys.exit(EXIT_DIFFERENT if result['different'] else EXIT_PASS)
+        
         img_a = safe_imread(args.image_a)
         img_b = safe_imread(args.image_b)
         
@@ -226,6 +536,11 @@ def main():
         
         safe_imwrite(args.output, result)
         print(f"Результат сохранён в {args.output}")
+        if args.regions > 0:
+            found = region_report(img_a, img_b, mask, limit=0)
+            print(f"Регионов различий: {len(found)}")
+            if found:
+                print(format_regions(found[:args.regions]))
 
 
 if __name__ == "__main__":
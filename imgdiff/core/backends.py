@@ -0,0 +1,196 @@
+"""
+Вычислительные бэкенды ядра разделения «появилось»/«исчезло».
+
+opencv — цепочка векторных вызовов OpenCV (всегда доступен).
+numba  — одно слитное ядро по строкам (nopython, parallel, без GIL):
+         знаковая разность, ΔE², порог и серые яркости add/del за один
+         проход по Lab без промежуточных HxWx3 буферов. Опционально
+         (pip install numba); при его отсутствии auto выбирает opencv.
+
+Оба бэкенда дают побитово одинаковые маски.
+"""
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .colors import lab_delta_mask
+from .workspace import DiffWorkspace, scratch
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:  # pragma: no cover - зависит от окружения
+    numba = None
+    NUMBA_AVAILABLE = False
+
+if NUMBA_AVAILABLE and not os.environ.get("NUMBA_THREADING_LAYER"):
+    # Ядро запускается из потоков конвейера; слой tbb, впервые поднятый
+    # не из главного потока, зависает при выходе интерпретатора
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+# Коэффициенты cv2.COLOR_BGR2GRAY для uint8 (фиксированная точка, сдвиг 15) —
+# с ними серая яркость совпадает с OpenCV на всех 2^24 цветах
+_B2Y, _G2Y, _R2Y = 3735, 19235, 9798
+_GRAY_SHIFT = 15
+
+Masks = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _split_thresholds(fuzz: float) -> Tuple[float, int]:
+    """Порог ΔE² (fuzz <= 0 — все пиксели) и порог серой яркости add/del."""
+    thr2 = float(fuzz) * float(fuzz) if fuzz > 0 else -1.0
+    return thr2, max(1, int(fuzz))
+
+
+class OpenCVBackend:
+    """Векторная цепочка OpenCV: subtract/max/multiply/transform/cvtColor/compare."""
+
+    name = "opencv"
+
+    def split_lab(
+        self,
+        lab_a: np.ndarray,
+        lab_b: np.ndarray,
+        fuzz: float = 10,
+        workspace: Optional[DiffWorkspace] = None,
+        dst: Optional[np.ndarray] = None
+    ) -> Masks:
+        """
+        Сырые маски (без шумоподавления) по готовым Lab-кадрам.
+
+        :param lab_a: Lab изображение A (uint8 HxWx3)
+        :param lab_b: Lab изображение B (uint8 HxWx3)
+        :param fuzz: порог различия в единицах Lab
+        :param workspace: буферы промежуточных результатов
+        :param dst: буфер общей маски HxW uint8
+        :return: (total, add, del) — маски 0/255; add/del — новые массивы,
+                 не обрезанные общей маской
+        """
+        h, w = lab_a.shape[:2]
+        _, split_thr = _split_thresholds(fuzz)
+        diff_add = cv2.subtract(lab_b, lab_a, dst=scratch(workspace, "lab_add", (h, w, 3)))
+        diff_del = cv2.subtract(lab_a, lab_b, dst=scratch(workspace, "lab_del", (h, w, 3)))
+        # |ΔLab| = max(add, del): поканально одна из частей нулевая
+        d = cv2.max(diff_add, diff_del, dst=scratch(workspace, "absdiff", (h, w, 3)))
+        total = lab_delta_mask(d, fuzz=fuzz, workspace=workspace, dst=dst)
+        masks = []
+        for name, part in (("gray_add", diff_add), ("gray_del", diff_del)):
+            gray = cv2.cvtColor(part, cv2.COLOR_BGR2GRAY, dst=scratch(workspace, name, (h, w)))
+            masks.append(cv2.compare(gray, float(split_thr), cv2.CMP_GT))
+        return total, masks[0], masks[1]
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _split_kernel(lab_a, lab_b, thr2, split_thr, total, mask_add, mask_del):  # pragma: no cover
+        h, w = total.shape
+        for y in numba.prange(h):
+            for x in range(w):
+                d2 = 0
+                g_add = 0
+                g_del = 0
+                for c in range(3):
+                    va = np.int32(lab_a[y, x, c])
+                    vb = np.int32(lab_b[y, x, c])
+                    d = vb - va
+                    d2 += d * d
+                    k = _B2Y if c == 0 else (_G2Y if c == 1 else _R2Y)
+                    if d > 0:
+                        g_add += d * k
+                    else:
+                        g_del -= d * k
+                total[y, x] = 255 if d2 >= thr2 else 0
+                half = 1 << (_GRAY_SHIFT - 1)
+                mask_add[y, x] = 255 if (g_add + half) >> _GRAY_SHIFT > split_thr else 0
+                mask_del[y, x] = 255 if (g_del + half) >> _GRAY_SHIFT > split_thr else 0
+
+
+class NumbaBackend(OpenCVBackend):
+    """Слитное ядро Numba: один проход по строкам вместо ~10 полнокадровых."""
+
+    name = "numba"
+
+    def __init__(self):
+        if not NUMBA_AVAILABLE:
+            raise RuntimeError("Numba не установлен: pip install numba")
+        # Слой потоков workqueue не допускает параллельных вызовов ядер
+        # из разных потоков — для него вызовы сериализуются
+        self._lock = threading.Lock()
+        self._serial: Optional[bool] = None
+
+    def split_lab(
+        self,
+        lab_a: np.ndarray,
+        lab_b: np.ndarray,
+        fuzz: float = 10,
+        workspace: Optional[DiffWorkspace] = None,
+        dst: Optional[np.ndarray] = None
+    ) -> Masks:
+        h, w = lab_a.shape[:2]
+        thr2, split_thr = _split_thresholds(fuzz)
+        total = dst if dst is not None else np.empty((h, w), dtype=np.uint8)
+        mask_add = np.empty((h, w), dtype=np.uint8)
+        mask_del = np.empty((h, w), dtype=np.uint8)
+        args = (np.ascontiguousarray(lab_a), np.ascontiguousarray(lab_b), thr2, split_thr,
+                total, mask_add, mask_del)
+        if self._serial is None:
+            with self._lock:
+                _split_kernel(*args)
+                self._serial = numba.threading_layer() == "workqueue"
+        elif self._serial:
+            with self._lock:
+                _split_kernel(*args)
+        else:
+            _split_kernel(*args)
+        return total, mask_add, mask_del
+
+
+_FACTORIES = {
+    OpenCVBackend.name: OpenCVBackend,
+    NumbaBackend.name: NumbaBackend,
+}
+_instances: Dict[str, OpenCVBackend] = {}
+_default = "auto"
+
+
+def available_backends() -> Tuple[str, ...]:
+    """
+    Бэкенды, доступные в текущем окружении.
+
+    :return: имена бэкендов
+    """
+    return tuple(name for name in _FACTORIES if name != NumbaBackend.name or NUMBA_AVAILABLE)
+
+
+def get_backend(name: Optional[str] = None) -> OpenCVBackend:
+    """
+    Бэкенд по имени.
+
+    :param name: "opencv", "numba", "auto" (numba, если установлен, иначе opencv)
+                 или None — бэкенд по умолчанию (см. set_backend)
+    :return: экземпляр бэкенда (один на процесс)
+    """
+    name = name or _default
+    if name == "auto":
+        name = NumbaBackend.name if NUMBA_AVAILABLE else OpenCVBackend.name
+    if name not in _FACTORIES:
+        raise ValueError(f"Неизвестный бэкенд: {name} (доступны: auto, {', '.join(_FACTORIES)})")
+    if name not in _instances:
+        _instances[name] = _FACTORIES[name]()
+    return _instances[name]
+
+
+def set_backend(name: str) -> str:
+    """
+    Выбирает бэкенд по умолчанию для процесса.
+
+    :param name: "auto", "opencv" или "numba"
+    :return: имя фактически выбранного бэкенда
+    """
+    global _default
+    backend = get_backend(name)
+    _default = name
+    return backend.name
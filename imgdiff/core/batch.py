@@ -0,0 +1,561 @@
+"""
+Пакетная обработка конвейером стадий с ограниченными очередями.
+
+    [проверка кэша] → чтение байтов (упреждающее) → декодирование → сравнение → запись
+
+Каждая стадия — свои потоки; между стадиями очереди ограниченного размера,
+поэтому быстрая стадия ждёт медленную (backpressure), а в памяти не больше
+prefetch пар «впереди» сравнения. Пока идёт сравнение, диск уже читает
+следующие пары. Запись — отложенная (encoder.EncoderPool): воркер сравнения
+отдаёт оверлей и сразу свободен, а пара считается готовой только после
+атомарной записи файла на диск; несжатые оверлеи в очереди записи
+ограничены бюджетом в байтах.
+
+Сравнение выполняется в потоках или, если передан пул процессов, в
+процессах-воркерах: кадры тогда декодируются в SharedImagePool, а в процесс
+уходят только дескрипторы (см. pipeline.run_shared).
+
+Необязательная первая стадия probe (например, CacheProbe) хэширует входы
+и проверяет кэш результатов в своих потоках: попадания сразу выдаются
+из run, не занимая чтение и сравнение.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from .encoder import DEFAULT_ENCODE_BYTES, EncoderPool
+from .equality import StageTimer
+from .io import FingerprintIndex, ResultCache
+from .pipeline import isolated_main, run_shared
+from .shm import SharedImage, SharedImagePool
+
+# Пар «впереди» сравнения по умолчанию (прочитанные, но ещё не сравненные)
+DEFAULT_PREFETCH = 4
+# Период опроса флага «задача начата» при таймауте пары, секунд
+_START_POLL = 0.02
+
+_STOP = object()
+
+
+class BatchJob:
+    """
+    Пара файлов пакета и её результат.
+
+    code: 1 — есть отличия, 0 — равны, -1 — ошибка или отмена (текст в error);
+    timings — время стадий (probe, read, bytes, decode, pixels, compare, render, encode);
+    cached — результат взят из кэша стадией probe, cache_key — ключ ResultCache пары.
+
+    analysis — сохранённые маски анализа пары (кэш масок): тогда читается
+    и декодируется только B, а результат собирается comparator.render.
+    При analysis_key (и без analysis) после сравнения новые маски
+    появляются в analysis_out — их можно положить в кэш под этим ключом.
+    """
+
+    __slots__ = ('index', 'left', 'right', 'out_path', 'name', 'file_hashes', 'cache_key', 'cached',
+                 'analysis_key', 'analysis', 'analysis_out', 'code', 'error', 'duration', 'timings',
+                 '_data', '_start')
+
+    def __init__(self, index: int, left, right, out_path, name: Optional[str] = None,
+                 file_hashes: Optional[Tuple[str, str]] = None, analysis_key: Optional[str] = None,
+                 analysis: Optional[bytes] = None):
+        self.index = index
+        self.left = str(left)
+        self.right = str(right)
+        self.out_path = str(out_path)
+        self.name = name if name is not None else self.out_path
+        self.file_hashes = file_hashes
+        self.cache_key: Optional[str] = None
+        self.cached = False
+        self.analysis_key = analysis_key
+        self.analysis = analysis
+        self.analysis_out: Optional[bytes] = None
+        self.code = -1
+        self.error = ""
+        self.duration = 0.0
+        self.timings = {}
+        self._data: Tuple[Any, ...] = ()
+        self._start = 0.0
+
+    def __repr__(self) -> str:
+        return f"BatchJob({self.index}, {self.name!r}, code={self.code})"
+
+
+def read_bytes(path: str) -> np.ndarray:
+    """
+    Читает файл целиком (пути с кириллицей поддерживаются).
+
+    :param path: путь к файлу
+    :return: байты файла uint8
+    """
+    return np.fromfile(path, dtype=np.uint8)
+
+
+class BatchPipeline:
+    """
+    Конвейер пакетного сравнения.
+
+    comparator — объект со свойствами сравнения (см. pipeline.OutlineComparator):
+    quick_equal, overlay_shape(shape_a, shape_b), __call__(old, new, timer, out=None)
+    → (code, overlay | None, write_arg) и encode(overlay, out_path, write_arg) → байты файла.
+    Для кэша масок — ещё compare(..., keep_analysis) и render(new, analysis, timer)
+    (необязательно; без них BatchJob.analysis не поддерживается).
+    Для пула процессов он должен сериализоваться (pickle).
+    """
+
+    def __init__(
+        self,
+        comparator,
+        prefetch: int = DEFAULT_PREFETCH,
+        read_workers: int = 2,
+        decode_workers: int = 2,
+        compare_workers: int = 1,
+        encode_workers: int = 1,
+        encode_bytes: int = DEFAULT_ENCODE_BYTES,
+        executor=None,
+        pool: Optional[SharedImagePool] = None,
+        cancel_fn: Optional[Callable[[], bool]] = None,
+        pause_fn: Optional[Callable[[], bool]] = None,
+        decode_flags: int = cv2.IMREAD_COLOR,
+        probe: Optional[Callable[[BatchJob], Optional[int]]] = None,
+        probe_workers: int = 2,
+        timeout: Optional[float] = None
+    ):
+        """
+        :param comparator: сравнение пары и запись результата
+        :param prefetch: сколько прочитанных пар может ждать декодирования
+        :param read_workers: потоков чтения файлов
+        :param decode_workers: потоков декодирования
+        :param compare_workers: одновременных сравнений (потоков или задач пула)
+        :param encode_workers: потоков кодирования и записи результатов
+        :param encode_bytes: бюджет несжатых оверлеев, ожидающих записи
+        :param executor: пул процессов (concurrent.futures) для сравнения; None — потоки
+        :param pool: пул разделяемой памяти для режима процессов (по умолчанию свой)
+        :param cancel_fn: функция «отменить пакет»
+        :param pause_fn: функция «пауза» (новые пары не читаются)
+        :param decode_flags: флаги cv2.imdecode
+        :param probe: первая стадия: probe(job) → готовый код пары (0/1) или None —
+                      пара идёт дальше (probe может заполнить file_hashes, analysis)
+        :param probe_workers: потоков стадии probe
+        :param timeout: предел сравнения одной пары в пуле процессов, секунд. Отсчёт
+                        идёт с момента, когда воркер взял задачу (ожидание в очереди
+                        пула не считается); пара получает ошибку Timeout, процесс
+                        дорабатывает её сам. Пул должен иметь compare_workers процессов:
+                        если все они заняты зависшими парами, остальные пары
+                        сразу получают Timeout
+        """
+        self.comparator = comparator
+        self.prefetch = max(1, int(prefetch))
+        self.read_workers = max(1, int(read_workers))
+        self.decode_workers = max(1, int(decode_workers))
+        self.compare_workers = max(1, int(compare_workers))
+        self.encode_workers = max(1, int(encode_workers))
+        self.encode_bytes = encode_bytes
+        self.executor = executor
+        self._own_pool = executor is not None and pool is None
+        self.pool = SharedImagePool() if self._own_pool else pool
+        self.cancel_fn = cancel_fn
+        self.pause_fn = pause_fn
+        self.decode_flags = decode_flags
+        self.probe = probe
+        self.probe_workers = max(1, int(probe_workers))
+        self.timeout = timeout if timeout and timeout > 0 else None
+        # Таймаут в пуле: флаги «задача начата» в разделяемой памяти (слот на задачу)
+        self._board: Optional[SharedImage] = None
+        self._slots: "queue.Queue" = queue.Queue()
+        self._abandon_lock = threading.Lock()
+        self._stuck = 0
+        self._running = False
+        self._encoder: Optional[EncoderPool] = None
+        self._results: "queue.Queue" = queue.Queue()
+
+    def run(self, jobs: Iterable[BatchJob]) -> Iterator[BatchJob]:
+        """
+        Запускает конвейер и выдаёт пары по мере готовности (не по порядку).
+
+        :param jobs: пары пакета
+        :return: итератор завершённых BatchJob
+        """
+        q_read: "queue.Queue" = queue.Queue(maxsize=self.read_workers)
+        q_decode: "queue.Queue" = queue.Queue(maxsize=self.prefetch)
+        q_compare: "queue.Queue" = queue.Queue(maxsize=self.compare_workers)
+        # Стадия сравнения ничего не передаёт дальше — только конец пакета
+        q_done: "queue.Queue" = queue.Queue()
+        self._encoder = EncoderPool(self.encode_workers, self.encode_bytes)
+        if self.executor is not None and self.timeout:
+            slots = 2 * self.compare_workers
+            self._board = self.pool.acquire((slots,), np.uint8)
+            for slot in range(slots):
+                self._slots.put(slot)
+        self._running = True
+        stages = [
+            (self._read, q_read, q_decode, self.read_workers),
+            (self._decode, q_decode, q_compare, self.decode_workers),
+            (self._compare, q_compare, q_done, self.compare_workers),
+        ]
+        q_first = q_read
+        if self.probe is not None:
+            q_first = queue.Queue(maxsize=self.probe_workers)
+            stages.insert(0, (self._probe, q_first, q_read, self.probe_workers))
+        threads: List[threading.Thread] = [
+            threading.Thread(target=self._feed, args=(jobs, q_first), name="batch-feed", daemon=True),
+            threading.Thread(target=self._drain, args=(q_done,), name="batch-drain", daemon=True),
+        ]
+        for fn, q_in, q_out, n in stages:
+            remaining = [n]
+            lock = threading.Lock()
+            for i in range(n):
+                threads.append(threading.Thread(
+                    target=self._worker, args=(fn, q_in, q_out, remaining, lock),
+                    name=f"batch-{fn.__name__.strip('_')}-{i}", daemon=True
+                ))
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                job = self._results.get()
+                if job is _STOP:
+                    break
+                yield job
+        finally:
+            for t in threads:
+                t.join()
+            self._encoder.close()
+            with self._abandon_lock:
+                self._running = False
+                self._release_board()
+            if self._own_pool:
+                self.pool.close()
+
+    def _cancelled(self) -> bool:
+        return callable(self.cancel_fn) and bool(self.cancel_fn())
+
+    def _feed(self, jobs: Iterable[BatchJob], q_read: "queue.Queue") -> None:
+        for job in jobs:
+            while callable(self.pause_fn) and self.pause_fn() and not self._cancelled():
+                time.sleep(0.05)
+            job._start = time.perf_counter()
+            if self._cancelled():
+                self._finish(job, -1, "Cancelled")
+                continue
+            q_read.put(job)
+        q_read.put(_STOP)
+
+    def _drain(self, q_done: "queue.Queue") -> None:
+        """Конец пакета — после того как сравнения закончились и записи легли на диск."""
+        q_done.get()
+        self._encoder.drain()
+        self._results.put(_STOP)
+
+    def _worker(self, fn, q_in: "queue.Queue", q_out: "queue.Queue", remaining: List[int],
+                lock: threading.Lock) -> None:
+        while True:
+            job = q_in.get()
+            if job is _STOP:
+                # Соседние потоки стадии тоже должны остановиться
+                q_in.put(_STOP)
+                break
+            if self._cancelled():
+                self._finish(job, -1, "Cancelled")
+                continue
+            try:
+                if fn(job):
+                    q_out.put(job)
+            except Exception as e:
+                self._finish(job, -1, str(e) or type(e).__name__)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            # Последний поток стадии закрывает следующую
+            q_out.put(_STOP)
+
+    def _finish(self, job: BatchJob, code: int, error: str = "") -> None:
+        """Результат пары; освобождает её буферы в разделяемой памяти."""
+        for item in job._data:
+            if isinstance(item, SharedImage):
+                self.pool.release(item)
+        job._data = ()
+        job.code = code
+        job.error = error
+        job.duration = max(0.0, time.perf_counter() - job._start) if code >= 0 else 0.0
+        self._results.put(job)
+
+    def _probe(self, job: BatchJob) -> bool:
+        with StageTimer(job.timings).stage('probe'):
+            code = self.probe(job)
+        if code is None:
+            return True
+        job.cached = True
+        self._finish(job, code)
+        return False
+
+    def _read(self, job: BatchJob) -> bool:
+        timer = StageTimer(job.timings)
+        if job.analysis is not None:
+            if not job.analysis:
+                # По маскам отличий нет — файлы не нужны
+                self._finish(job, 0)
+                return False
+            # Оформление по маскам: нужен только B
+            with timer.stage('read'):
+                job._data = (None, read_bytes(job.right))
+            return True
+        with timer.stage('read'):
+            data_a = read_bytes(job.left)
+            data_b = read_bytes(job.right)
+        if self.comparator.quick_equal:
+            # Побайтно одинаковые файлы — без декодирования
+            with timer.stage('bytes'):
+                if data_a.size != data_b.size:
+                    same = False
+                elif job.file_hashes and all(job.file_hashes):
+                    same = job.file_hashes[0] == job.file_hashes[1]
+                else:
+                    same = np.array_equal(data_a, data_b)
+            if same:
+                if job.analysis_key is not None and hasattr(self.comparator, 'compare'):
+                    job.analysis_out = b""
+                self._finish(job, 0)
+                return False
+        job._data = (data_a, data_b)
+        return True
+
+    def _decode(self, job: BatchJob) -> bool:
+        data_a, data_b = job._data
+        with StageTimer(job.timings).stage('decode'):
+            old = cv2.imdecode(data_a, self.decode_flags) if data_a is not None else None
+            new = cv2.imdecode(data_b, self.decode_flags)
+        if (old is None and data_a is not None) or new is None:
+            raise FileNotFoundError(f"Не удалось загрузить {job.left} или {job.right}")
+        if self.executor is None or job.analysis is not None:
+            # Оформление по маскам дешёвое — выполняется в потоке, без пула
+            job._data = (old, new)
+        else:
+            # Дескрипторы сразу в job: при ошибке _finish их освободит
+            job._data = (self.pool.put(old),)
+            job._data += (self.pool.put(new),)
+        return True
+
+    def _compare(self, job: BatchJob) -> bool:
+        keep = job.analysis_key is not None and hasattr(self.comparator, 'compare')
+        if job.analysis is not None:
+            _, new = job._data
+            code, overlay, write_arg = self.comparator.render(new, job.analysis, StageTimer(job.timings))
+            job._data = ()
+            del new
+        elif self.executor is None:
+            old, new = job._data
+            if keep:
+                code, overlay, write_arg, job.analysis_out = self.comparator.compare(
+                    old, new, StageTimer(job.timings), keep_analysis=True)
+            else:
+                code, overlay, write_arg = self.comparator(old, new, StageTimer(job.timings))
+            job._data = ()
+            del old, new
+        else:
+            handle_a, handle_b = job._data
+            overlay = self.pool.acquire(self.comparator.overlay_shape(handle_a.shape, handle_b.shape))
+            job._data = (handle_a, handle_b, overlay)
+            slot = None
+            if self._board is not None:
+                slot = self._slots.get()
+                self._board.array()[slot] = 0
+            abandoned = False
+            try:
+                # Новые процессы пула стартуют внутри submit
+                with isolated_main():
+                    future = self.executor.submit(run_shared, self.comparator, handle_a, handle_b, overlay, keep,
+                                                  (self._board, slot) if slot is not None else None)
+                code, error, _, timings, write_arg, job.analysis_out = self._wait(future, slot)
+            except FutureTimeout as e:
+                # Процесс ещё пишет в сегменты — они вернутся в пул, когда задача завершится
+                abandoned = True
+                job._data = ()
+                self._abandon(future, slot, handle_a, handle_b, overlay)
+                self._finish(job, -1, str(e))
+                return False
+            finally:
+                # Прочие ошибки пула (BrokenProcessPool, сериализация) завершают пару
+                # в _worker через _finish — он же вернёт сегменты из job._data
+                if slot is not None and not abandoned:
+                    self._slots.put(slot)
+            job.timings.update(timings)
+            self.pool.release(handle_a)
+            self.pool.release(handle_b)
+            job._data = (overlay,)
+            if code < 0:
+                self._finish(job, code, error)
+                return False
+            if write_arg is None:
+                overlay = None
+        if overlay is None:
+            self._finish(job, code)
+            return False
+        job.code = code
+        job._data = (overlay,)
+        image = overlay.array() if isinstance(overlay, SharedImage) else overlay
+        # Ждёт только при исчерпанном бюджете записи
+        self._encoder.submit(
+            image, job.out_path,
+            lambda img: self._encode(img, job, write_arg),
+            lambda future: self._written(job, future),
+        )
+        return False
+
+    def _wait(self, future, slot: Optional[int]):
+        """
+        Результат задачи пула; с таймаутом время считается от флага «начата» в слоте.
+
+        :raises FutureTimeout: пара не уложилась в timeout или ей не досталось процесса
+        """
+        if slot is None:
+            return future.result()
+        flags = self._board.array()
+        started = None
+        while True:
+            wait = _START_POLL if started is None else max(0.0, started + self.timeout - time.perf_counter())
+            try:
+                return future.result(timeout=wait)
+            except FutureTimeout:
+                now = time.perf_counter()
+                if started is None:
+                    if flags[slot]:
+                        started = now
+                    elif self._stuck >= self.compare_workers:
+                        raise FutureTimeout("Timeout: все процессы пула заняты зависшими парами") from None
+                elif now >= started + self.timeout:
+                    raise FutureTimeout(f"Timeout ({self.timeout:g} s)") from None
+
+    def _abandon(self, future, slot: Optional[int], *handles: SharedImage) -> None:
+        """Оставляет задачу пулу: сегменты и слот освободятся, когда она завершится."""
+        with self._abandon_lock:
+            self._stuck += 1
+        # Ещё не отправленную в процесс задачу можно снять
+        future.cancel()
+        future.add_done_callback(lambda f: self._abandoned_done(slot, handles))
+
+    def _abandoned_done(self, slot: Optional[int], handles: Tuple[SharedImage, ...]) -> None:
+        for handle in handles:
+            try:
+                self.pool.release(handle)
+            except ValueError:
+                # Пул уже закрыт вместе с концом пакета
+                pass
+        if slot is not None:
+            self._slots.put(slot)
+        with self._abandon_lock:
+            self._stuck -= 1
+            if not self._running:
+                self._release_board()
+
+    def _release_board(self) -> None:
+        """Возвращает флаги слотов в пул, когда ни одна задача пакета их уже не тронет."""
+        if self._board is None or self._stuck > 0:
+            return
+        try:
+            self.pool.release(self._board)
+        except ValueError:
+            pass
+        self._board = None
+        self._slots = queue.Queue()
+
+    def _encode(self, image: np.ndarray, job: BatchJob, write_arg) -> np.ndarray:
+        with StageTimer(job.timings).stage('encode'):
+            return self.comparator.encode(image, job.out_path, write_arg)
+
+    def _written(self, job: BatchJob, future) -> None:
+        error = future.exception()
+        if error is None:
+            self._finish(job, job.code)
+        else:
+            self._finish(job, -1, str(error) or type(error).__name__)
+
+
+def in_order(jobs: Iterable[BatchJob], order: Sequence[int]) -> Iterator[BatchJob]:
+    """
+    Выдаёт завершённые пары в заданном порядке (результаты run приходят
+    по мере готовности). Пара ждёт в буфере, пока не выданы все предыдущие.
+
+    :param jobs: завершённые пары в любом порядке
+    :param order: BatchJob.index в нужном порядке
+    :return: итератор пар в порядке order (пары вне order — в конце)
+    """
+    waiting: Dict[int, BatchJob] = {}
+    pos = 0
+    for job in jobs:
+        waiting[job.index] = job
+        while pos < len(order) and order[pos] in waiting:
+            yield waiting.pop(order[pos])
+            pos += 1
+    for index in order[pos:]:
+        if index in waiting:
+            yield waiting.pop(index)
+    yield from waiting.values()
+
+
+class CacheProbe:
+    """
+    Стадия probe конвейера: хэши входов (FingerprintIndex) и проверка кэшей.
+
+    Заполняет у пары file_hashes и cache_key, а при промахе ResultCache —
+    analysis_key/analysis из кэша масок. Попадание даёт код: 0 — пары равны,
+    1 — отличия и файл результата на месте. Ошибки stat/чтения не фатальны:
+    пара идёт дальше без кэша (и получит ошибку на стадии чтения).
+    """
+
+    def __init__(self, fingerprints: FingerprintIndex, results: ResultCache, settings_hash: str,
+                 masks: Optional[ResultCache] = None, analysis_hash: Optional[str] = None):
+        """
+        :param fingerprints: индекс хэшей файлов
+        :param results: кэш результатов
+        :param settings_hash: хэш всех параметров сравнения (ключ результатов)
+        :param masks: кэш масок анализа (io.MaskCache) или None
+        :param analysis_hash: хэш параметров анализа (ключ масок)
+        """
+        self.fingerprints = fingerprints
+        self.results = results
+        self.settings_hash = settings_hash
+        self.masks = masks if analysis_hash else None
+        self.analysis_hash = analysis_hash
+
+    def __call__(self, job: BatchJob) -> Optional[int]:
+        try:
+            hash_a = self.fingerprints.digest(job.left)
+            hash_b = self.fingerprints.digest(job.right)
+        except OSError:
+            return None
+        job.file_hashes = (hash_a, hash_b)
+        job.cache_key = self.results.get_cache_key(hash_a, hash_b, self.settings_hash)
+        cached = self.results.get(job.cache_key)
+        if isinstance(cached, dict):
+            code = cached.get('code')
+            if code == 0 or (code == 1 and os.path.exists(job.out_path)):
+                return code
+        if self.masks is not None:
+            job.analysis_key = self.masks.get_cache_key(hash_a, hash_b, self.analysis_hash)
+            job.analysis = self.masks.get(job.analysis_key)
+        return None
+
+    def store(self, job: BatchJob) -> None:
+        """
+        Сохраняет в кэши результат пары, посчитанный конвейером.
+
+        :param job: завершённая пара (попадания и ошибки пропускаются)
+        """
+        if job.cached or job.code < 0:
+            return
+        if job.cache_key:
+            self.results.put(job.cache_key, {
+                'code': int(job.code),
+                'duration_s': float(job.duration),
+                'out_path': job.out_path,
+                'timings': dict(job.timings),
+            })
+        if self.masks is not None and job.analysis_key and job.analysis_out is not None:
+            self.masks.put(job.analysis_key, job.analysis_out)
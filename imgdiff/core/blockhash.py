@@ -0,0 +1,118 @@
+"""
+Индекс хэшей блоков: пропуск побайтно одинаковых участков до конверсии цвета
+"""
+import hashlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .diff import refine_rois, rois_to_mask
+from .pyramid import grid_runs
+from .tiled import NOISE_HALO
+from .workspace import DiffWorkspace
+
+# Сторона блока по умолчанию (px)
+BLOCK_SIZE = 64
+
+Box = Tuple[int, int, int, int]
+
+
+class BlockHashIndex:
+    """
+    Хэши (BLAKE2b-128) блоков block×block сырого декодированного буфера.
+
+    Индекс не зависит от второго изображения, поэтому при сравнении одного A
+    со многими B хэши A считаются один раз и передаются повторно.
+    """
+
+    def __init__(self, digests: np.ndarray, shape: Tuple[int, ...], block: int):
+        self.digests = digests
+        self.shape = tuple(shape)
+        self.block = block
+
+    @classmethod
+    def from_image(cls, img: np.ndarray, block: int = BLOCK_SIZE) -> "BlockHashIndex":
+        """
+        Строит индекс по изображению.
+
+        :param img: изображение (любое число каналов, uint8)
+        :param block: сторона блока
+        :return: индекс
+        """
+        h, w = img.shape[:2]
+        nby = (h + block - 1) // block
+        nbx = (w + block - 1) // block
+        digests = np.empty((nby, nbx), dtype="S16")
+        for by, y in enumerate(range(0, h, block)):
+            strip = img[y:y+block]
+            bh = strip.shape[0]
+            row = strip.reshape(bh, w, -1)
+            full = w // block
+            # Полные блоки строки — одним непрерывным буфером (копия полосы, не кадра)
+            if full:
+                blocks = np.ascontiguousarray(
+                    row[:, :full * block].reshape(bh, full, -1).transpose(1, 0, 2)
+                )
+                for bx in range(full):
+                    digests[by, bx] = hashlib.blake2b(blocks[bx].data, digest_size=16).digest()
+            if full < nbx:
+                tail = np.ascontiguousarray(row[:, full * block:])
+                digests[by, full] = hashlib.blake2b(tail.data, digest_size=16).digest()
+        return cls(digests, img.shape, block)
+
+    def changed(self, other: "BlockHashIndex") -> np.ndarray:
+        """
+        Сетка блоков, которые различаются хотя бы одним байтом.
+
+        :param other: индекс второго изображения той же формы
+        :return: булева сетка ceil(h/block) × ceil(w/block)
+        """
+        if self.shape != other.shape or self.block != other.block:
+            raise ValueError(
+                f"Несовместимые индексы: {self.shape}/{self.block} vs {other.shape}/{other.block}"
+            )
+        return self.digests != other.digests
+
+    def changed_boxes(self, other: "BlockHashIndex", pad: int = 0) -> List[Box]:
+        """
+        Боксы (x, y, w, h) изменённых блоков, серии по строкам.
+
+        :param other: индекс второго изображения
+        :param pad: расширение боксов (px), обрезается по кадру
+        :return: список (x, y, w, h)
+        """
+        return grid_runs(self.changed(other), self.block, self.shape, pad=pad)
+
+
+def diff_mask_blocks(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    use_lab: bool = True,
+    index_a: Optional[BlockHashIndex] = None,
+    index_b: Optional[BlockHashIndex] = None,
+    block: int = BLOCK_SIZE,
+    workspace: Optional[DiffWorkspace] = None
+) -> np.ndarray:
+    """
+    diff_mask_fast только по изменённым блокам; результат совпадает
+    с полнокадровой маской, одинаковые блоки не конвертируются в Lab.
+
+    :param a: BGR изображение A
+    :param b: BGR изображение B
+    :param fuzz: порог различия
+    :param use_lab: использовать Lab пространство
+    :param index_a: готовый индекс A (переиспользуется между парами)
+    :param index_b: готовый индекс B
+    :param block: сторона блока, если индексы строятся здесь
+    :param workspace: буферы для уточнения изменённых блоков
+    :return: бинарная маска различий 0/255
+    """
+    if index_a is None:
+        index_a = BlockHashIndex.from_image(a, block)
+    if index_b is None:
+        index_b = BlockHashIndex.from_image(b, index_a.block)
+    # Шумоподавление может «сдвинуть» пиксель маски на 1 px за границу блока
+    boxes = index_a.changed_boxes(index_b, pad=1)
+    rois = refine_rois(a, b, boxes, fuzz=fuzz, use_lab=use_lab, halo=NOISE_HALO, workspace=workspace)
+    return rois_to_mask(a.shape, rois)
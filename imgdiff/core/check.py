@@ -0,0 +1,96 @@
+"""
+Режим проверки «различаются ли изображения?» без построения результата
+"""
+from typing import Any, Dict, Optional
+
+import cv2
+import numpy as np
+
+from .colors import bgr_simple_diff, bgr_to_lab_diff
+from .morph import denoise_mask
+from .pyramid import diff_strength, strength_threshold
+from .tiled import NOISE_HALO, TILE_SIZE, iter_tiles
+from .workspace import DiffWorkspace, scratch
+
+
+def diff_pixel_limit(total_pixels: int, max_diff_percent: float = 0.0) -> int:
+    """
+    Допустимое число различающихся пикселей для заданного процента.
+
+    :param total_pixels: число пикселей кадра
+    :param max_diff_percent: допуск в процентах (0 — любое отличие недопустимо)
+    :return: максимальное число пикселей, при котором проверка пройдена
+    """
+    return int(np.floor(total_pixels * max(0.0, max_diff_percent) / 100.0))
+
+
+def check_images(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    use_lab: bool = True,
+    max_diff_percent: float = 0.0,
+    noise_filter: bool = True,
+    tile_size: int = TILE_SIZE,
+    workspace: Optional[DiffWorkspace] = None
+) -> Dict[str, Any]:
+    """
+    Решение «равны / различаются» с ранним выходом.
+
+    Кадр обходится тайлами (как diff_mask_tiled); тайл, в котором дешёвая
+    верхняя оценка diff_strength нигде не достигает порога, пропускается
+    без конверсии в Lab. Как только счётчик различающихся пикселей превышает
+    допуск, обход прекращается — diff_pixels тогда нижняя оценка (exact=False).
+    Пиксели считаются по маске diff_mask_fast (без фильтра площади и расширения).
+
+    :param a: BGR изображение A
+    :param b: BGR изображение B той же формы
+    :param fuzz: порог различия
+    :param use_lab: использовать Lab пространство
+    :param max_diff_percent: допустимая доля различий в процентах
+    :param noise_filter: применять фильтрацию шума
+    :param tile_size: сторона тайла
+    :param workspace: буферы тайла (см. DiffWorkspace)
+    :return: словарь different, diff_pixels, diff_percent, exact,
+             tiles_scanned, tiles_skipped
+    """
+    if a.shape != b.shape:
+        raise ValueError(f"Размеры не совпадают: {a.shape} vs {b.shape}")
+    h, w = a.shape[:2]
+    total = h * w
+    limit = diff_pixel_limit(total, max_diff_percent)
+    thr = strength_threshold(fuzz)
+    halo = NOISE_HALO if noise_filter else 0
+
+    diff_pixels = 0
+    scanned = skipped = 0
+    exact = True
+    for (x, y, tw, th), (ox, oy, ow, oh) in iter_tiles(h, w, tile_size, halo):
+        ta = a[oy:oy+oh, ox:ox+ow]
+        tb = b[oy:oy+oh, ox:ox+ow]
+        # Без превышения верхней оценки в тайле (с ореолом) маска тайла пуста
+        _, max_val, _, _ = cv2.minMaxLoc(diff_strength(ta, tb, use_lab=use_lab, workspace=workspace))
+        if max_val < thr:
+            skipped += 1
+            continue
+        scanned += 1
+        raw = scratch(workspace, "mask_raw", (oh, ow))
+        if use_lab:
+            m = bgr_to_lab_diff(ta, tb, fuzz=fuzz, workspace=workspace, dst=raw)
+        else:
+            m = bgr_simple_diff(ta, tb, fuzz=fuzz, workspace=workspace, dst=raw)
+        if noise_filter:
+            m = denoise_mask(m, workspace=workspace, dst=scratch(workspace, "mask_tile", (oh, ow)))
+        diff_pixels += cv2.countNonZero(m[y-oy:y-oy+th, x-ox:x-ox+tw])
+        if diff_pixels > limit:
+            exact = False
+            break
+
+    return {
+        'different': diff_pixels > limit,
+        'diff_pixels': diff_pixels,
+        'diff_percent': (diff_pixels / float(total)) * 100 if total else 0.0,
+        'exact': exact,
+        'tiles_scanned': scanned,
+        'tiles_skipped': skipped,
+    }
@@ -3,49 +3,89 @@
 """
 import cv2
 import numpy as np
+from typing import Optional
 
+from .workspace import DiffWorkspace, scratch
 
-def bgr_to_lab_diff(a: np.ndarray, b: np.ndarray, fuzz: int = 10) -> np.ndarray:
+# Матрица суммирования каналов для cv2.transform
+_ONES_3 = np.ones((1, 3), dtype=np.float32)
+
+
+def bgr_to_lab_diff(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    workspace: Optional[DiffWorkspace] = None,
+    dst: Optional[np.ndarray] = None
+) -> np.ndarray:
     """
     Вычисляет перцептуальную разность между изображениями в пространстве Lab.
     Возвращает бинарную маску различий.
     
+    Квадрат ΔE сравнивается с fuzz² (без sqrt); промежуточные Lab/absdiff/float
+    буферы берутся из workspace, если он передан.
+    
     :param a: BGR изображение A
     :param b: BGR изображение B
     :param fuzz: порог различия в единицах Lab (5-12 оптимально)
+    :param workspace: переиспользуемые буферы (DiffWorkspace)
+    :param dst: буфер для результата HxW uint8
     :return: бинарная маска 0/255
     """
-    # Конверсия в Lab (минимум копий)
-    a_lab = cv2.cvtColor(a, cv2.COLOR_BGR2LAB)
-    b_lab = cv2.cvtColor(b, cv2.COLOR_BGR2LAB)
+    h, w = a.shape[:2]
     
-    # ΔE*ab ≈ L2 в Lab (быстро и перцептуально корректно)
-    d = cv2.absdiff(a_lab, b_lab)
+    # Конверсия в Lab (в готовые буферы)
+    a_lab = cv2.cvtColor(a, cv2.COLOR_BGR2LAB, dst=scratch(workspace, "lab_a", (h, w, 3)))
+    b_lab = cv2.cvtColor(b, cv2.COLOR_BGR2LAB, dst=scratch(workspace, "lab_b", (h, w, 3)))
     
-    # Нормируем к скалярной "силе различия" без Python-циклов
-    diff = np.sqrt(
-        d[..., 0].astype(np.float32) ** 2 +
-        d[..., 1].astype(np.float32) ** 2 +
-        d[..., 2].astype(np.float32) ** 2
-    )
+    # ΔE*ab ≈ L2 в Lab (быстро и перцептуально корректно)
+    d = cv2.absdiff(a_lab, b_lab, dst=scratch(workspace, "absdiff", (h, w, 3)))
+    return lab_delta_mask(d, fuzz=fuzz, workspace=workspace, dst=dst)
+
+
+def lab_delta_mask(
+    d: np.ndarray,
+    fuzz: int = 10,
+    workspace: Optional[DiffWorkspace] = None,
+    dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Порог ΔE по готовой поканальной |ΔLab|.
     
-    # Порог по fuzz в единицах Lab
-    m = (diff >= float(fuzz)).astype(np.uint8) * 255
+    :param d: абсолютная разность Lab HxWx3 uint8
+    :param fuzz: порог различия в единицах Lab
+    :param workspace: переиспользуемые буферы (DiffWorkspace)
+    :param dst: буфер для результата HxW uint8
+    :return: бинарная маска 0/255 (ΔE >= fuzz)
+    """
+    h, w = d.shape[:2]
+    # ΔE² = Σ d² — целые значения, во float32 представимы точно
+    sq = cv2.multiply(d, d, dst=scratch(workspace, "sq", (h, w, 3), np.float32), dtype=cv2.CV_32F)
+    dist2 = cv2.transform(sq, _ONES_3, dst=scratch(workspace, "sum", (h, w), np.float32))
     
-    return m
+    # Порог по fuzz в единицах Lab: ΔE >= fuzz  <=>  ΔE² >= fuzz²
+    thr2 = float(fuzz) * float(fuzz) if fuzz > 0 else -1.0
+    return cv2.compare(dist2, thr2, cv2.CMP_GE, dst=dst)
 
 
-def bgr_simple_diff(a: np.ndarray, b: np.ndarray, fuzz: int = 10) -> np.ndarray:
+def bgr_simple_diff(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    workspace: Optional[DiffWorkspace] = None,
+    dst: Optional[np.ndarray] = None
+) -> np.ndarray:
     """
     Простая разность в BGR (быстрее, но менее перцептуально).
     
     :param a: BGR изображение A
     :param b: BGR изображение B
     :param fuzz: порог различия
+    :param workspace: переиспользуемые буферы (DiffWorkspace)
+    :param dst: буфер для результата HxW uint8
     :return: бинарная маска 0/255
     """
-    m = cv2.absdiff(a, b)
-    m = cv2.cvtColor(m, cv2.COLOR_BGR2GRAY)
-    m = (m >= fuzz).astype(np.uint8) * 255
-    return m
-
+    h, w = a.shape[:2]
+    m = cv2.absdiff(a, b, dst=scratch(workspace, "absdiff", a.shape))
+    m = cv2.cvtColor(m, cv2.COLOR_BGR2GRAY, dst=scratch(workspace, "gray", (h, w)))
+    return cv2.compare(m, float(fuzz), cv2.CMP_GE, dst=dst)
@@ -0,0 +1,371 @@
+"""
+Компоненты связности: векторная фильтрация по площади и таблица регионов
+"""
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+Box = Tuple[int, int, int, int]
+
+
+# Высота полосы потоковой разметки: временные буферы — около 12 Б на пиксель полосы
+STRIP_ROWS = 256
+
+
+def _merge_labels(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Слияние меток по рёбрам (векторный union-find: корни подвешиваются
+    к меньшему корню, затем пути сжимаются).
+
+    :param n: число меток
+    :param a: метки первых концов рёбер
+    :param b: метки вторых концов рёбер
+    :return: корень (наименьшая метка класса) для каждой метки
+    """
+    root = np.arange(n, dtype=np.int64)
+    while len(a):
+        ra, rb = root[a], root[b]
+        open_ = ra != rb
+        if not open_.any():
+            break
+        a, b, ra, rb = a[open_], b[open_], ra[open_], rb[open_]
+        low = np.minimum(ra, rb)
+        np.minimum.at(root, ra, low)
+        np.minimum.at(root, rb, low)
+        while True:
+            nxt = root[root]
+            if np.array_equal(nxt, root):
+                break
+            root = nxt
+    return root
+
+
+def _global_row(row: np.ndarray, offset: int) -> np.ndarray:
+    """Строка локальных меток → глобальные номера (-1 вне компонент)"""
+    return np.where(row > 0, row.astype(np.int64) + offset, -1)
+
+
+def _seam_edges(upper: np.ndarray, lower: np.ndarray, diagonal: bool) -> np.ndarray:
+    """
+    Рёбра между компонентами по шву двух полос.
+
+    :param upper: глобальные метки последней строки верхней полосы
+    :param lower: глобальные метки первой строки нижней полосы
+    :param diagonal: учитывать диагональных соседей (8-связность)
+    :return: массив 2×k различных пар меток
+    """
+    w = len(upper)
+    edges = []
+    for dx in ((-1, 0, 1) if diagonal else (0,)):
+        u = upper[max(dx, 0):w + min(dx, 0)]
+        v = lower[max(-dx, 0):w + min(-dx, 0)]
+        hit = (u >= 0) & (v >= 0)
+        edges.append(np.stack([u[hit], v[hit]]))
+    # Вдоль шва одна пара компонент повторяется на каждом столбце
+    return np.unique(np.concatenate(edges, axis=1), axis=1)
+
+
+def _concat_edges(edges: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    if not edges:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    pairs = np.concatenate(edges, axis=1)
+    return pairs[0], pairs[1]
+
+
+def filter_components(
+    mask: np.ndarray,
+    min_area: int = 0,
+    fill: bool = False,
+    strip: int = STRIP_ROWS,
+    bit: int = 255,
+    dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Потоковый отбор 8-связных компонент по площади полосами по strip строк.
+
+    Полоса размечается connectedComponentsWithStats, компоненты соседних полос
+    сшиваются по шву (union-find по меткам, не по пикселям). При fill дыры —
+    4-связные участки фона, не связанные с границей кадра, — заливаются
+    и входят в площадь охватывающей компоненты, как у внешних контуров
+    findContours. Второй проход заново размечает полосы и пишет результат
+    через таблицу меток (np.take), поэтому память — результат плюс одна полоса.
+
+    :param mask: маска (передний план — пиксели с ненулевым mask & bit)
+    :param min_area: минимальная площадь компоненты (px, с дырами при fill)
+    :param fill: заливать дыры оставшихся компонент
+    :param strip: высота полосы (строк)
+    :param bit: бит(ы) переднего плана; остальные биты пикселя сохраняются
+    :param dst: буфер результата той же формы (можно сам mask)
+    :return: dst — в bit выставлены пиксели оставшихся компонент
+    """
+    h, w = mask.shape[:2]
+    strip = max(int(strip), 1)
+    if dst is None:
+        dst = np.zeros_like(mask)
+
+    def foreground(y0: int, y1: int) -> np.ndarray:
+        rows = mask[y0:y1] if bit == 255 else np.bitwise_and(mask[y0:y1], bit)
+        return cv2.threshold(rows, 0, 255, cv2.THRESH_BINARY)[1]
+
+    def label(y0: int, y1: int, stats: bool = True, background: bool = True):
+        # connectedComponents без статистики нумерует так же, как WithStats
+        run = cv2.connectedComponentsWithStats if stats else cv2.connectedComponents
+        fg = foreground(y0, y1)
+        f = run(fg, connectivity=8, ltype=cv2.CV_32S)
+        if not (fill and background):
+            return f, None
+        return f, run(cv2.bitwise_not(fg, dst=fg), connectivity=4, ltype=cv2.CV_32S)
+
+    # Проход 1: площади, швы и (для fill) соседство компонент с кандидатами в дыры
+    f_count, b_count = [], []
+    f_area, b_area, b_edge = [], [], []
+    f_edges, b_edges, touch = [], [], []
+    nf_total = nb_total = 0
+    up_f = up_b = up_hole = None
+    for y0 in range(0, h, strip):
+        y1 = min(y0 + strip, h)
+        (nf, fl, fst, _), bg = label(y0, y1)
+        f_off = nf_total - 1
+        f_count.append(nf)
+        f_area.append(fst[1:, cv2.CC_STAT_AREA])
+        top_f = _global_row(fl[0], f_off)
+        if up_f is not None:
+            f_edges.append(_seam_edges(up_f, top_f, diagonal=True))
+        nf_total += nf - 1
+        if bg is None:
+            up_f = _global_row(fl[-1], f_off)
+            continue
+        nb, bl, bst, _ = bg
+        b_off = nb_total - 1
+        b_count.append(nb)
+        b_area.append(bst[1:, cv2.CC_STAT_AREA])
+        left = bst[1:, cv2.CC_STAT_LEFT]
+        top = bst[1:, cv2.CC_STAT_TOP]
+        edge = (left == 0) | (left + bst[1:, cv2.CC_STAT_WIDTH] == w)
+        if y0 == 0:
+            edge |= top == 0
+        if y1 == h:
+            edge |= top + bst[1:, cv2.CC_STAT_HEIGHT] == y1 - y0
+        b_edge.append(edge)
+        # Кандидаты в дыры: фон полосы, не касающийся границы кадра
+        inner = np.zeros(nb, dtype=bool)
+        inner[1:] = ~edge
+        if inner.any():
+            near = inner[bl]
+            for fa, ba, hit in ((fl[:, :-1], bl[:, 1:], near[:, 1:]),
+                                (fl[:, 1:], bl[:, :-1], near[:, :-1]),
+                                (fl[:-1], bl[1:], near[1:]),
+                                (fl[1:], bl[:-1], near[:-1])):
+                hit = hit & (fa > 0)
+                keys = np.unique(fa[hit].astype(np.int64) * nb + ba[hit])
+                touch.append(np.stack([keys // nb + f_off, keys % nb + b_off]))
+        top_b = _global_row(bl[0], b_off)
+        if up_b is not None:
+            b_edges.append(_seam_edges(up_b, top_b, diagonal=False))
+            top_hole = np.where(inner[bl[0]], top_b, -1)
+            touch.append(_seam_edges(up_f, top_hole, diagonal=False))
+            touch.append(_seam_edges(top_f, up_hole, diagonal=False))
+        up_b = _global_row(bl[-1], b_off)
+        up_hole = np.where(inner[bl[-1]], up_b, -1)
+        up_f = _global_row(fl[-1], f_off)
+        nb_total += nb - 1
+
+    f_area = np.concatenate(f_area).astype(np.int64) if f_area else np.zeros(0, np.int64)
+    if fill:
+        b_root = _merge_labels(nb_total, *_concat_edges(b_edges))
+        edge_root = np.zeros(nb_total, dtype=bool)
+        edge_root[b_root[np.concatenate(b_edge)]] = True
+        hole = ~edge_root[b_root]
+        # Дыра и острова в ней относятся к одной (охватывающей) компоненте
+        fid, bid = _concat_edges(touch)
+        sel = hole[bid]
+        fid, hr = fid[sel], b_root[bid[sel]]
+        order = np.argsort(hr, kind='stable')
+        fid, hr = fid[order], hr[order]
+        holes, first = np.unique(hr, return_index=True)
+        lead = fid[first]
+        f_edges.append(np.stack([fid, lead[np.searchsorted(holes, hr)]]))
+    f_root = _merge_labels(nf_total, *_concat_edges(f_edges))
+    area = np.bincount(f_root, weights=f_area, minlength=nf_total)
+    if fill:
+        owner = np.full(nb_total, -1, dtype=np.int64)
+        owner[holes] = f_root[lead]
+        owner = owner[b_root]
+        owned = np.flatnonzero(owner >= 0)
+        area += np.bincount(owner[owned], weights=np.concatenate(b_area)[owned],
+                            minlength=nf_total)
+    keep_f = area[f_root] >= min_area
+    if fill:
+        keep_b = np.zeros(nb_total, dtype=bool)
+        keep_b[owned] = area[owner[owned]] >= min_area
+
+    # Проход 2: перенумерация полос через таблицу меток прямо в dst
+    on = np.uint8(bit)
+    f_off = b_off = 0
+    for i, y0 in enumerate(range(0, h, strip)):
+        y1 = min(y0 + strip, h)
+        nf = f_count[i]
+        nb = b_count[i] if fill else 0
+        kept = keep_f[f_off:f_off + nf - 1]
+        filled = fill and keep_b[b_off:b_off + nb - 1].any()
+        rest = None if bit == 255 else np.bitwise_and(mask[y0:y1], np.uint8(~bit & 0xFF))
+        out = dst[y0:y1]
+        if not (kept.any() or filled):
+            out[:] = 0
+            bg = None
+        else:
+            (_, fl), bg = label(y0, y1, stats=False, background=filled)
+            lut = np.zeros(nf, dtype=np.uint8)
+            lut[1:][kept] = on
+            np.take(lut, fl, out=out, mode='clip')
+        f_off += nf - 1
+        if bg is not None:
+            lut = np.zeros(nb, dtype=np.uint8)
+            lut[1:][keep_b[b_off:b_off + nb - 1]] = on
+            np.bitwise_or(out, np.take(lut, bg[1], mode='clip'), out=out)
+        b_off += nb - 1
+        if rest is not None:
+            np.bitwise_or(out, rest, out=out)
+    return dst
+
+
+def fill_holes(mask: np.ndarray, dst: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Заливает дыры — участки фона, не связанные с границей кадра.
+    Фон берётся 4-связным (дополнение к 8-связным компонентам),
+    как у внешних контуров findContours.
+
+    :param mask: бинарная маска 0/255
+    :param dst: буфер результата (по умолчанию новый массив)
+    :return: маска с залитыми дырами
+    """
+    return filter_components(mask, 0, fill=True, dst=dst)
+
+
+class Components:
+    """
+    Компоненты связности бинарной маски.
+
+    labels — карта меток int32 (0 — фон, 1..n — компоненты), stats/centroids —
+    строки cv2.connectedComponentsWithStats без фона. Таблица считается один раз
+    и переиспользуется для боксов, отчётов и подсветки без повторного прохода.
+    """
+
+    def __init__(self, labels: np.ndarray, stats: np.ndarray, centroids: np.ndarray):
+        self.labels = labels
+        self.stats = stats
+        self.centroids = centroids
+
+    @classmethod
+    def from_mask(
+        cls,
+        mask: np.ndarray,
+        min_area: int = 0,
+        fill: bool = False,
+        connectivity: int = 8
+    ) -> "Components":
+        """
+        Разметка маски с отбором компонент по площади через таблицу меток (LUT).
+
+        :param mask: бинарная маска 0/255
+        :param min_area: минимальная площадь компоненты (px)
+        :param fill: заливать дыры перед разметкой (площадь — с дырами)
+        :param connectivity: связность компонент (4 или 8)
+        :return: компоненты с площадью >= min_area, метки перенумерованы по порядку
+        """
+        if fill:
+            mask = fill_holes(mask)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=connectivity)
+        stats = stats[1:]
+        centroids = centroids[1:]
+        keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+        if not keep.all():
+            # Один проход по карте меток: старая метка → новая (0 для отброшенных)
+            lut = np.zeros(n, dtype=np.int32)
+            lut[1:][keep] = np.arange(1, int(keep.sum()) + 1, dtype=np.int32)
+            np.take(lut, labels, out=labels, mode='clip')
+            stats = stats[keep]
+            centroids = centroids[keep]
+        return cls(labels, stats, centroids)
+
+    def __len__(self) -> int:
+        return len(self.stats)
+
+    @property
+    def areas(self) -> np.ndarray:
+        """Площади компонент (px)"""
+        return self.stats[:, cv2.CC_STAT_AREA]
+
+    def boxes(self) -> List[Box]:
+        """
+        Боксы компонент.
+
+        :return: список (x, y, w, h)
+        """
+        return [tuple(int(v) for v in row[:4]) for row in self.stats]
+
+    def to_mask(self, dst: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Бинарная маска оставшихся компонент.
+
+        :param dst: буфер результата (по умолчанию новый массив)
+        :return: маска 0/255
+        """
+        return cv2.compare(self.labels, 0, cv2.CMP_GT, dst=dst)
+
+    def region_table(
+        self,
+        delta: Optional[np.ndarray] = None,
+        mask_add: Optional[np.ndarray] = None,
+        mask_del: Optional[np.ndarray] = None
+    ) -> Dict[str, np.ndarray]:
+        """
+        Сводная таблица регионов (столбцы по компонентам, порядок меток).
+
+        :param delta: карта силы различия (например, ΔE), та же форма
+        :param mask_add: маска «появилось» для доли add
+        :param mask_del: маска «исчезло» для доли del
+        :return: словарь столбцов: bbox (n×4), area, centroid (n×2)
+                 и при наличии карт — mean_delta, max_delta, add_share, del_share
+        """
+        n = len(self)
+        area = self.areas.astype(np.float64)
+        table = {
+            'bbox': self.stats[:, :4].copy(),
+            'area': self.stats[:, cv2.CC_STAT_AREA].copy(),
+            'centroid': self.centroids.copy(),
+        }
+        # Только пиксели компонент: маски различий обычно разрежены
+        fg = np.flatnonzero(self.labels)
+        flat = self.labels.ravel()[fg]
+        if delta is not None:
+            values = delta.ravel()[fg].astype(np.float64)
+            sums = np.bincount(flat, weights=values, minlength=n + 1)[1:]
+            table['mean_delta'] = sums / np.maximum(area, 1.0)
+            peak = np.zeros(n + 1, dtype=np.float64)
+            np.maximum.at(peak, flat, values)
+            table['max_delta'] = peak[1:]
+        for key, part in (('add_share', mask_add), ('del_share', mask_del)):
+            if part is not None:
+                hits = np.bincount(flat, weights=part.ravel()[fg] > 0, minlength=n + 1)[1:]
+                table[key] = hits / np.maximum(area, 1.0)
+        return table
+
+    def regions(self, **maps) -> List[Dict[str, object]]:
+        """
+        Таблица регионов построчно (для отчётов и GUI).
+
+        :param maps: те же карты, что у region_table
+        :return: список словарей по компонентам
+        """
+        table = self.region_table(**maps)
+        rows = []
+        for i in range(len(self)):
+            row = {}
+            for key, col in table.items():
+                value = col[i]
+                row[key] = tuple(value.tolist()) if np.ndim(value) else value.item()
+            rows.append(row)
+        return rows
@@ -3,16 +3,22 @@
 """
 import cv2
 import numpy as np
-from typing import List, Tuple
-
-try:
-    from skimage.metrics import structural_similarity as ssim
-    SSIM_AVAILABLE = True
-except ImportError:
-    SSIM_AVAILABLE = False
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+from .backends import get_backend
 from .colors import bgr_to_lab_diff, bgr_simple_diff
-from .morph import bboxes_from_mask
+from .morph import denoise_mask, merge_boxes
+from .pyramid import (
+    diff_strength, strength_threshold, max_pool, flagged_boxes, build_max_pyramid, grid_runs
+)
+from .ssim import ssim_candidate_boxes, ssim_map_tiled
+from .tiled import NOISE_HALO
+from .workspace import DiffWorkspace, scratch
+
+Box = Tuple[int, int, int, int]
+Roi = Tuple[Box, np.ndarray]
+# ((x, y, w, h), общая маска, маска «появилось», маска «исчезло»)
+SplitRoi = Tuple[Box, np.ndarray, np.ndarray, np.ndarray]
 
 
 def diff_mask_fast(
@@ -20,7 +26,8 @@ def diff_mask_fast(
     b: np.ndarray,
     fuzz: int = 10,
     use_lab: bool = True,
-    noise_filter: bool = True
+    noise_filter: bool = True,
+    workspace: Optional[DiffWorkspace] = None
 ) -> np.ndarray:
     """
     Быстрая векторизованная разность с морфологией только в маске.
@@ -30,113 +37,307 @@ def diff_mask_fast(
     :param fuzz: порог различия (Lab: 5-12, BGR: 10-30)
     :param use_lab: использовать перцептуальное Lab пространство
     :param noise_filter: применять фильтрацию шума
+    :param workspace: буферы промежуточных результатов (см. DiffWorkspace);
+                      возвращаемая маска всегда новый массив
     :return: бинарная маска различий 0/255
     """
-    # 1. Вычисление разности
+    # 1. Вычисление разности (до шумоподавления маска — промежуточная)
+    raw = scratch(workspace, "mask_raw", a.shape[:2]) if noise_filter else None
     if use_lab:
-        m = bgr_to_lab_diff(a, b, fuzz=fuzz)
+        m = bgr_to_lab_diff(a, b, fuzz=fuzz, workspace=workspace, dst=raw)
     else:
-        m = bgr_simple_diff(a, b, fuzz=fuzz)
+        m = bgr_simple_diff(a, b, fuzz=fuzz, workspace=workspace, dst=raw)
     
     # 2. Лёгкое шумоподавление
     if noise_filter:
-        m = cv2.medianBlur(m, 3)
-        m = cv2.morphologyEx(m, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8), iterations=1)
+        m = denoise_mask(m, workspace=workspace)
     
     return m
 
 
+def signed_lab_diff(
+    a: np.ndarray,
+    b: np.ndarray,
+    workspace: Optional[DiffWorkspace] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Знаковые части Lab-разности: «появилось» (B - A) и «исчезло» (A - B)
+    с насыщением в 0. Каждое изображение конвертируется в Lab один раз;
+    поканально одна из частей нулевая, поэтому max(add, del) = |ΔLab|.
+    
+    :param a: BGR изображение A (старое)
+    :param b: BGR изображение B (новое)
+    :param workspace: буферы; с ним результат лежит в workspace
+                      и действителен до следующего вызова ядра
+    :return: (add, del) — HxWx3 uint8
+    """
+    h, w = a.shape[:2]
+    a_lab = cv2.cvtColor(a, cv2.COLOR_BGR2LAB, dst=scratch(workspace, "lab_a", (h, w, 3)))
+    b_lab = cv2.cvtColor(b, cv2.COLOR_BGR2LAB, dst=scratch(workspace, "lab_b", (h, w, 3)))
+    diff_add = cv2.subtract(b_lab, a_lab, dst=scratch(workspace, "lab_add", (h, w, 3)))
+    diff_del = cv2.subtract(a_lab, b_lab, dst=scratch(workspace, "lab_del", (h, w, 3)))
+    return diff_add, diff_del
+
+
+def diff_masks_split(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    noise_filter: bool = True,
+    workspace: Optional[DiffWorkspace] = None,
+    backend: Optional[str] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Общая маска и её разделение на «появилось»/«исчезло» за один проход Lab.
+    
+    Общая маска совпадает с diff_mask_fast(use_lab=True); пиксель общей маски
+    попадает в add (del), если серая яркость знаковой разности B - A (A - B)
+    больше max(1, fuzz).
+    
+    :param a: BGR изображение A (старое)
+    :param b: BGR изображение B (новое)
+    :param fuzz: порог различия
+    :param noise_filter: применять фильтрацию шума к общей маске
+    :param workspace: буферы промежуточных результатов (см. DiffWorkspace)
+    :param backend: вычислительный бэкенд ("opencv", "numba", "auto";
+                    None — по умолчанию, см. backends.set_backend)
+    :return: (total, add, del) — новые бинарные маски 0/255
+    """
+    h, w = a.shape[:2]
+    a_lab = cv2.cvtColor(a, cv2.COLOR_BGR2LAB, dst=scratch(workspace, "lab_a", (h, w, 3)))
+    b_lab = cv2.cvtColor(b, cv2.COLOR_BGR2LAB, dst=scratch(workspace, "lab_b", (h, w, 3)))
+    
+    # 1. Сырые маски: ΔE и направление по знаковой разности Lab
+    raw_dst = scratch(workspace, "mask_raw", (h, w)) if noise_filter else None
+    raw, mask_add, mask_del = get_backend(backend).split_lab(
+        a_lab, b_lab, fuzz=fuzz, workspace=workspace, dst=raw_dst
+    )
+    total = denoise_mask(raw, workspace=workspace) if noise_filter else raw
+    
+    # 2. Направление изменений — только внутри общей маски
+    cv2.bitwise_and(mask_add, total, dst=mask_add)
+    cv2.bitwise_and(mask_del, total, dst=mask_del)
+    return total, mask_add, mask_del
+
+
 def coarse_to_fine(
     a: np.ndarray,
     b: np.ndarray,
     fuzz: int = 10,
     scale: float = 0.25,
     min_area: int = 50,
-    use_lab: bool = True
-) -> List[Tuple[int, int, int, int]]:
+    use_lab: bool = True,
+    return_masks: bool = False,
+    workspace: Optional[DiffWorkspace] = None
+) -> Union[List[Box], List[Roi]]:
     """
     Многомасштабное сравнение: грубо → точно.
     Ускорение 5-20× на больших изображениях.
     
+    В режиме return_masks пересекающиеся/соседние боксы сначала сливаются,
+    каждый итоговый ROI уточняется ровно один раз, и его маска возвращается
+    вместе с боксом — вызывающему коду не нужно пересчитывать diff_mask_fast.
+    
+    Грубый проход берёт разность на полном разрешении (дешёвую верхнюю
+    оценку ΔE), затем max-pooling блоками ~1/scale px: блок без различий
+    не может скрыть пиксель с ΔE >= fuzz, поэтому итоговая маска совпадает
+    с diff_mask_fast на всём кадре. (Даунскейл A и B через INTER_AREA
+    «усреднял» тонкие линии ниже порога и терял их.)
+    
     :param a: BGR изображение A
     :param b: BGR изображение B
     :param fuzz: порог различия
     :param scale: масштаб грубого прохода (0.2-0.3 оптимально)
     :param min_area: минимальная площадь региона
     :param use_lab: использовать Lab пространство
-    :return: список боксов (x, y, w, h) с различиями
+    :param return_masks: вернуть уточнённые маски ROI вместе с боксами
+    :param workspace: буферы промежуточных результатов (см. DiffWorkspace)
+    :return: список боксов (x, y, w, h) с различиями,
+             либо список ((x, y, w, h), маска ROI) при return_masks
+    """
+    block = max(1, int(round(1.0 / scale)))
+    flags = max_pool(diff_strength(a, b, use_lab=use_lab, workspace=workspace), block) >= strength_threshold(fuzz)
+    if not flags.any():
+        return []
+    # Шумоподавление может «сдвинуть» пиксель маски на 1 px от исходного различия
+    boxes = merge_boxes(flagged_boxes(flags, block, a.shape, pad=1))
+    rois = refine_rois(a, b, boxes, fuzz=fuzz, use_lab=use_lab, halo=NOISE_HALO, workspace=workspace)
+    if return_masks:
+        return rois
+    return [box for box, _ in rois]
+
+
+def refine_rois(
+    a: np.ndarray,
+    b: np.ndarray,
+    boxes: List[Box],
+    fuzz: int = 10,
+    use_lab: bool = True,
+    halo: int = 0,
+    workspace: Optional[DiffWorkspace] = None,
+    split: bool = False
+) -> Union[List[Roi], List[SplitRoi]]:
+    """
+    Точная маска внутри каждого бокса; пустые ROI отбрасываются.
+    При halo = NOISE_HALO маска ROI совпадает с вырезкой полнокадровой маски.
+    При split (только Lab) вместе с маской возвращаются маски add/del
+    из diff_masks_split — без повторной конверсии ROI в Lab.
+    
+    :param a: BGR изображение A
+    :param b: BGR изображение B
+    :param boxes: список (x, y, w, h)
+    :param fuzz: порог различия
+    :param use_lab: использовать Lab пространство
+    :param halo: контекст вокруг бокса для шумоподавления (px)
+    :param workspace: буферы, общие для всех ROI
+    :param split: добавить маски «появилось»/«исчезло»
+    :return: список ((x, y, w, h), маска ROI 0/255[, add, del])
+    """
+    if split and not use_lab:
+        raise ValueError("split поддерживается только для Lab")
+    h_max, w_max = a.shape[:2]
+    rois = []
+    for (x, y, w, h) in boxes:
+        x0, y0 = max(0, x - halo), max(0, y - halo)
+        x1, y1 = min(w_max, x + w + halo), min(h_max, y + h + halo)
+        if split:
+            masks = diff_masks_split(a[y0:y1, x0:x1], b[y0:y1, x0:x1], fuzz=fuzz, workspace=workspace)
+        else:
+            masks = (diff_mask_fast(a[y0:y1, x0:x1], b[y0:y1, x0:x1], fuzz=fuzz, use_lab=use_lab,
+                                    workspace=workspace),)
+        if halo:
+            masks = tuple(m[y-y0:y-y0+h, x-x0:x-x0+w] for m in masks)
+        if cv2.countNonZero(masks[0]) > 0:
+            rois.append(((x, y, w, h),) + tuple(masks))
+    return rois
+
+
+def hierarchical_diff(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    use_lab: bool = True,
+    levels: int = 4,
+    leaf: int = 16,
+    dense_ratio: float = 0.75,
+    workspace: Optional[DiffWorkspace] = None,
+    split: bool = False
+) -> Tuple[Union[List[Roi], List[SplitRoi]], List[Dict[str, Any]]]:
     """
-    # 1. Грубая маска на уменьшенных копиях
-    a_small = cv2.resize(a, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
-    b_small = cv2.resize(b, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    Иерархическое (quadtree) уточнение по пирамиде максимумов.
     
-    m_small = diff_mask_fast(
-        a_small, b_small,
-        fuzz=max(3, int(fuzz * scale)),
-        use_lab=use_lab
-    )
+    Верхний уровень делит кадр на ячейки leaf·2^(levels-1) px; на каждом
+    следующем уровне проверяются только дочерние ячейки помеченных родителей.
+    Если у родителя помечено не меньше dense_ratio детей, спуск прекращается
+    и родитель уточняется целиком. Как и coarse_to_fine, пропусков нет:
+    результат совпадает с diff_mask_fast на всём кадре.
     
-    boxes_small = bboxes_from_mask(m_small, min_area=10)
+    :param a: BGR изображение A
+    :param b: BGR изображение B
+    :param fuzz: порог различия
+    :param use_lab: использовать Lab пространство
+    :param levels: глубина пирамиды (1 = только листовые ячейки)
+    :param leaf: сторона листовой ячейки (px)
+    :param dense_ratio: доля помеченных детей, при которой спуск прекращается
+    :param workspace: буферы промежуточных результатов (см. DiffWorkspace)
+    :param split: вернуть также маски «появилось»/«исчезло» (см. refine_rois)
+    :return: (список ((x, y, w, h), маска ROI[, add, del]), статистика по уровням)
+    """
+    h, w = a.shape[:2]
+    # Шумоподавление может «сдвинуть» пиксель маски на 1 px от исходного различия
+    strength = cv2.dilate(diff_strength(a, b, use_lab=use_lab, workspace=workspace), np.ones((3, 3), np.uint8))
+    thr = strength_threshold(fuzz)
+    pyr = build_max_pyramid(strength, leaf, max(1, levels))
+    del strength
     
-    # 2. Пересчёт боксов на full-res и точная проверка только внутри ROI
-    boxes = []
-    for (xs, ys, ws, hs) in boxes_small:
-        x = int(xs / scale)
-        y = int(ys / scale)
-        w = int(ws / scale)
-        h = int(hs / scale)
-        
-        # Проверяем границы
-        h_max, w_max = a.shape[:2]
-        if x >= w_max or y >= h_max:
-            continue
-            
-        # Корректируем размеры ROI
-        w = min(w, w_max - x)
-        h = min(h, h_max - y)
-        
-        if w <= 0 or h <= 0:
-            continue
+    boxes: List[Box] = []
+    stats: List[Dict[str, Any]] = []
+    descend = None
+    for lvl in range(len(pyr) - 1, -1, -1):
+        grid = pyr[lvl]
+        cell = leaf << lvl
+        if descend is None:
+            active = np.ones(grid.shape, dtype=bool)
+        else:
+            active = np.repeat(np.repeat(descend, 2, axis=0), 2, axis=1)[:grid.shape[0], :grid.shape[1]]
+        flagged = active & (grid >= thr)
         
-        roi_a = a[y:y+h, x:x+w]
-        roi_b = b[y:y+h, x:x+w]
+        dense = np.zeros_like(flagged)
+        if lvl > 0:
+            if flagged.any():
+                child = (pyr[lvl - 1] >= thr).astype(np.int32)
+                rows = np.arange(0, child.shape[0], 2)
+                cols = np.arange(0, child.shape[1], 2)
+                n_flag = np.add.reduceat(np.add.reduceat(child, rows, axis=0), cols, axis=1)
+                n_all = np.add.reduceat(np.add.reduceat(np.ones_like(child), rows, axis=0), cols, axis=1)
+                dense = flagged & (n_flag >= dense_ratio * n_all)
+            descend = flagged & ~dense
+            boxes.extend(grid_runs(dense, cell, a.shape))
+        else:
+            boxes.extend(grid_runs(flagged, cell, a.shape))
         
-        m = diff_mask_fast(roi_a, roi_b, fuzz=fuzz, use_lab=use_lab)
-        
-        if cv2.countNonZero(m) > 0:
-            boxes.append((x, y, w, h))
+        cell_h = np.minimum(cell, h - np.arange(0, h, cell))
+        cell_w = np.minimum(cell, w - np.arange(0, w, cell))
+        pruned_px = int(np.outer(cell_h, cell_w)[active & ~flagged].sum())
+        stats.append({
+            'level': lvl,
+            'cell': cell,
+            'examined': int(active.sum()),
+            'flagged': int(flagged.sum()),
+            'dense': int(dense.sum()),
+            'pruned_px': pruned_px,
+            'pruned_fraction': pruned_px / float(h * w) if h * w else 0.0,
+        })
+        if lvl > 0 and not descend.any():
+            break
     
-    return boxes
+    rois = refine_rois(a, b, boxes, fuzz=fuzz, use_lab=use_lab, halo=NOISE_HALO,
+                       workspace=workspace, split=split)
+    return rois, stats
+
+
+def rois_to_mask(shape: Tuple[int, ...], rois: List[Roi]) -> np.ndarray:
+    """
+    Собирает полнокадровую маску из масок ROI без пересчёта.
+    
+    :param shape: форма изображения (h, w[, c])
+    :param rois: список ((x, y, w, h), маска ROI[, add, del])
+    :return: бинарная маска 0/255
+    """
+    mask = np.zeros(shape[:2], np.uint8)
+    for (x, y, w, h), m, *_ in rois:
+        mask[y:y+h, x:x+w] |= m
+    return mask
 
 
 def ssim_mask(
     a: np.ndarray,
     b: np.ndarray,
     win: int = 11,
-    thresh: float = 0.85
+    thresh: float = 0.85,
+    gaussian: bool = False
 ) -> np.ndarray:
     """
     SSIM-маска по Y-каналу (яркость).
-    Только для случаев, когда установлен scikit-image.
+    SSIM считается только в окрестности блоков, где Y различается
+    (вне их окно целиком совпадает и SSIM = 1).
     
     :param a: BGR изображение A
     :param b: BGR изображение B
     :param win: размер окна SSIM (7-11)
     :param thresh: порог схожести (0.8-0.9)
+    :param gaussian: гауссово окно (sigma 1.5) вместо равномерного
     :return: бинарная маска различий 0/255
     """
-    if not SSIM_AVAILABLE:
-        # Fallback на простую разность
-        return diff_mask_fast(a, b, use_lab=False)
-    
     # Считаем SSIM по яркости (канал Y)
     y_a = cv2.cvtColor(a, cv2.COLOR_BGR2YCrCb)[..., 0]
     y_b = cv2.cvtColor(b, cv2.COLOR_BGR2YCrCb)[..., 0]
     
-    _, full = ssim(y_a, y_b, win_size=win, data_range=255, full=True)
+    boxes = ssim_candidate_boxes(y_a, y_b, win=win)
+    full = ssim_map_tiled(y_a, y_b, win=win, gaussian=gaussian, boxes=boxes)
     
-    # full ∈ [0..1] — карта схожести; маска различий:
-    return (full < thresh).astype(np.uint8) * 255
+    # full ∈ [-1..1] — карта схожести; маска различий:
+    return cv2.compare(full, float(thresh), cv2.CMP_LT)
 
 
 def align_images_ecc(
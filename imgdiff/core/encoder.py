@@ -0,0 +1,192 @@
+"""
+Отложенная запись результатов: кодирование и запись на диск в своём пуле.
+
+Воркер сравнения отдаёт готовый оверлей в EncoderPool и сразу берётся за
+следующую пару. Пул кодирует изображение (PNG и т.п.) и пишет файл атомарно:
+во временный файл рядом с целевым, fsync, затем os.replace. Поэтому по пути
+результата всегда лежит либо старый, либо полностью записанный файл.
+
+Объём ожидающих записи изображений ограничен бюджетом в байтах: если он
+исчерпан, submit ждёт (backpressure), так что несжатые оверлеи не копятся
+в памяти быстрее, чем диск успевает их принять.
+"""
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence
+
+import cv2
+import numpy as np
+
+# Бюджет несжатых изображений в очереди записи по умолчанию (256 МиБ)
+DEFAULT_ENCODE_BYTES = 256 << 20
+
+_IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif')
+
+
+def encode_image(image: np.ndarray, ext: str = '.png', params: Optional[Sequence[int]] = None) -> np.ndarray:
+    """
+    Кодирует изображение в буфер.
+
+    :param image: изображение
+    :param ext: расширение формата (неизвестное — PNG)
+    :param params: параметры cv2.imencode (например, IMWRITE_PNG_COMPRESSION)
+    :return: закодированные байты uint8
+    """
+    ext = ext.lower()
+    if ext not in _IMAGE_EXTS:
+        ext = '.png'
+    ok, buffer = cv2.imencode(ext, image, list(params or []))
+    if not ok:
+        raise IOError(f"Не удалось закодировать изображение в {ext}")
+    return buffer
+
+
+def atomic_write(path, data, durable: bool = True) -> None:
+    """
+    Атомарная запись файла: временный файл в той же директории → os.replace.
+
+    :param path: путь файла (директория создаётся при необходимости)
+    :param data: байты (bytes или ndarray uint8)
+    :param durable: fsync файла и директории перед возвратом
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(memoryview(data))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    if durable:
+        _fsync_dir(path.parent)
+
+
+def _fsync_dir(directory: Path) -> None:
+    """Фиксирует запись о переименовании в директории (на Windows недоступно)."""
+    try:
+        fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class EncoderPool:
+    """
+    Пул потоков кодирования и атомарной записи с бюджетом памяти.
+
+    submit принимает изображение и функцию кодирования и возвращает Future,
+    который завершается, только когда файл записан (и при durable — сброшен
+    на диск). Пока изображения в очереди занимают больше max_bytes, submit
+    ждёт; одно изображение больше бюджета принимается, если очередь пуста.
+    """
+
+    def __init__(self, workers: int = 1, max_bytes: int = DEFAULT_ENCODE_BYTES, durable: bool = True):
+        """
+        :param workers: потоков кодирования/записи
+        :param max_bytes: бюджет несжатых изображений в очереди
+        :param durable: fsync каждого файла перед завершением задачи
+        """
+        self.workers = max(1, int(workers))
+        self.max_bytes = max(1, int(max_bytes))
+        self.durable = durable
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="imgdiff-encode")
+        self._cond = threading.Condition()
+        self._bytes = 0
+        self._pending = 0
+        self._written = 0
+        self._failed = 0
+
+    def __enter__(self) -> "EncoderPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def submit(
+        self,
+        image: np.ndarray,
+        out_path,
+        encode_fn: Callable[[np.ndarray], np.ndarray],
+        callback: Optional[Callable[[Future], None]] = None
+    ) -> Future:
+        """
+        Ставит изображение в очередь записи (ждёт, если бюджет исчерпан).
+
+        :param image: изображение; не должно меняться до завершения задачи
+        :param out_path: путь результата
+        :param encode_fn: кодирование изображения в байты (см. encode_image)
+        :param callback: вызывается из потока пула по завершении (Future.result() —
+                         путь файла или исключение записи)
+        :return: Future с путём записанного файла
+        """
+        nbytes = int(image.nbytes)
+        with self._cond:
+            while self._pending > 0 and self._bytes + nbytes > self.max_bytes:
+                self._cond.wait()
+            self._bytes += nbytes
+            self._pending += 1
+        try:
+            future = self._executor.submit(self._write, image, str(out_path), encode_fn)
+        except BaseException:
+            self._done(nbytes, False)
+            raise
+        # callback раньше учёта: после drain() все callback уже отработали
+        if callback is not None:
+            future.add_done_callback(callback)
+        future.add_done_callback(lambda f: self._done(nbytes, f.exception() is None))
+        return future
+
+    def _write(self, image: np.ndarray, out_path: str, encode_fn) -> str:
+        atomic_write(out_path, encode_fn(image), durable=self.durable)
+        return out_path
+
+    def _done(self, nbytes: int, ok: bool) -> None:
+        with self._cond:
+            self._bytes -= nbytes
+            self._pending -= 1
+            if ok:
+                self._written += 1
+            else:
+                self._failed += 1
+            self._cond.notify_all()
+
+    def drain(self) -> None:
+        """Ждёт завершения всех поставленных записей."""
+        with self._cond:
+            while self._pending > 0:
+                self._cond.wait()
+
+    def occupancy(self) -> Dict[str, int]:
+        """
+        Состояние очереди записи.
+
+        :return: словарь: pending, bytes_pending, max_bytes, written, failed
+        """
+        with self._cond:
+            return {
+                'pending': self._pending,
+                'bytes_pending': self._bytes,
+                'max_bytes': self.max_bytes,
+                'written': self._written,
+                'failed': self._failed,
+            }
+
+    def close(self) -> None:
+        """Дожидается записей и останавливает потоки пула."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,91 @@
+"""
+Поэтапная проверка равенства пары: байты файлов → декодированные пиксели
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+
+# Размер блока потокового сравнения файлов (байт)
+CHUNK_SIZE = 1024 * 1024
+
+# Высота полосы при построчном сравнении пикселей
+ROWS_PER_CHUNK = 256
+
+
+class StageTimer:
+    """
+    Накопитель времени по этапам обработки пары.
+    Повторный вход в этап с тем же именем суммирует время.
+    """
+
+    def __init__(self, timings: Optional[Dict[str, float]] = None):
+        self.timings: Dict[str, float] = timings if timings is not None else {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Замеряет время блока with и добавляет его к этапу name.
+
+        :param name: имя этапа
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start)
+
+
+def files_identical(
+    path_a: str,
+    path_b: str,
+    hash_a: Optional[str] = None,
+    hash_b: Optional[str] = None,
+    chunk_size: int = CHUNK_SIZE
+) -> bool:
+    """
+    Побайтное равенство файлов без декодирования.
+
+    Сначала сравниваются размеры (stat). Если хэши обоих файлов уже известны
+    (например, посчитаны для ключа кэша), решают они; иначе файлы читаются
+    параллельно блоками chunk_size до первого расхождения.
+
+    :param path_a: путь к первому файлу
+    :param path_b: путь ко второму файлу
+    :param hash_a: готовый хэш содержимого A (опционально)
+    :param hash_b: готовый хэш содержимого B (тем же алгоритмом)
+    :param chunk_size: размер блока чтения
+    :return: True, если содержимое совпадает байт в байт
+    """
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    if hash_a is not None and hash_b is not None:
+        return hash_a == hash_b
+    if os.path.samefile(path_a, path_b):
+        return True
+    with open(path_a, 'rb') as fa, open(path_b, 'rb') as fb:
+        while True:
+            chunk_a = fa.read(chunk_size)
+            if chunk_a != fb.read(chunk_size):
+                return False
+            if not chunk_a:
+                return True
+
+
+def pixels_identical(a: np.ndarray, b: np.ndarray, rows: int = ROWS_PER_CHUNK) -> bool:
+    """
+    Равенство декодированных буферов полосами с ранним выходом.
+
+    :param a: изображение A
+    :param b: изображение B
+    :param rows: высота полосы сравнения
+    :return: True, если форма, тип и все пиксели совпадают
+    """
+    if a.shape != b.shape or a.dtype != b.dtype:
+        return False
+    for y in range(0, a.shape[0], max(1, rows)):
+        if not np.array_equal(a[y:y+rows], b[y:y+rows]):
+            return False
+    return True
@@ -5,30 +5,181 @@ import cv2
 import numpy as np
 import hashlib
 import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, Tuple
+
+# Файлы от этого размера отображаются в память (mmap), меньшие читаются
+# в переиспользуемый буфер потока
+MMAP_THRESHOLD = 8 << 20
+
+_local = threading.local()
+
+# Пределы ResultCache по умолчанию
+RESULT_CACHE_ENTRIES = 200_000
+RESULT_CACHE_BYTES = 256 << 20
+MASK_CACHE_BYTES = 1 << 30
+# Предел FingerprintIndex по умолчанию
+FINGERPRINT_ENTRIES = 1_000_000
+
+# Флаги декодирования с уменьшением в 2/4/8 раз (для JPEG — масштабированное
+# обратное DCT в libjpeg, без полного декодирования)
+_REDUCED_FLAGS = {
+    cv2.IMREAD_COLOR: {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                       8: cv2.IMREAD_REDUCED_COLOR_8},
+    cv2.IMREAD_GRAYSCALE: {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                           8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+}
+
+# Маркеры JPEG SOFn с размерами кадра (кроме DHT/JPG/DAC)
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+@contextmanager
+def file_view(path) -> Iterator[np.ndarray]:
+    """
+    Содержимое файла как uint8-массив без лишних копий.
+
+    Большие файлы (от MMAP_THRESHOLD) отображаются в память, меньшие
+    читаются одним readinto в буфер потока, который переиспользуется
+    между вызовами. Пути с кириллицей поддерживаются (open, а не cv2.imread).
+
+    :param path: путь к файлу
+    :return: контекст с массивом только для чтения; действителен внутри with
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield np.frombuffer(mm, dtype=np.uint8)
+            finally:
+                try:
+                    mm.close()
+                except BufferError:
+                    # На отображение ещё ссылается массив — закроется вместе с ним
+                    pass
+            return
+        if getattr(_local, 'busy', False):
+            # Вложенное чтение в том же потоке — отдельный буфер
+            buf = np.empty(size, dtype=np.uint8)
+        else:
+            buf = getattr(_local, 'buf', None)
+            if buf is None or buf.size < size:
+                buf = _local.buf = np.empty(max(size, 1 << 16), dtype=np.uint8)
+            _local.busy = True
+        try:
+            view = buf[:size]
+            view = view[:f.readinto(memoryview(view))]
+            view.flags.writeable = False
+            yield view
+        finally:
+            if buf is getattr(_local, 'buf', None):
+                _local.busy = False
 
 
 def safe_imread(path: str, flags: int = cv2.IMREAD_COLOR) -> Optional[np.ndarray]:
     """
     Безопасное чтение изображения с поддержкой кириллицы в путях.
+    Декодирует прямо из file_view — без промежуточных копий байтов файла.
     
     :param path: путь к файлу
-    :param flags: флаги cv2.imread
+    :param flags: флаги cv2.imdecode
     :return: изображение или None
     """
     try:
-        # Сначала пробуем через numpy (поддержка кириллицы)
-        with open(path, 'rb') as f:
-            img_array = np.asarray(bytearray(f.read()), dtype=np.uint8)
-            img = cv2.imdecode(img_array, flags)
-            return img
-    except Exception:
-        # Fallback к обычному cv2.imread
-        try:
-            return cv2.imread(str(path), flags)
-        except Exception:
-            return None
+        with file_view(path) as data:
+            if data.size == 0:
+                return None
+            return cv2.imdecode(data, flags)
+    except (OSError, ValueError, cv2.error):
+        return None
+
+
+def image_header_size(data) -> Optional[Tuple[int, int]]:
+    """
+    Размер изображения по заголовку файла, без декодирования (PNG, JPEG, BMP).
+
+    :param data: байты файла (bytes или ndarray uint8)
+    :return: (ширина, высота) или None, если формат не распознан
+    """
+    buf = memoryview(data).cast('B') if not isinstance(data, bytes) else data
+    head = bytes(buf[:26])
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if head[:2] == b'BM' and len(head) >= 26:
+        w, h = struct.unpack('<ii', head[18:26])
+        return abs(w), abs(h)
+    if head[:2] == b'\xff\xd8':
+        pos = 2
+        n = len(buf)
+        while pos + 9 <= n:
+            if buf[pos] != 0xFF:
+                pos += 1
+                continue
+            marker = buf[pos + 1]
+            if marker == 0xFF or 0xD0 <= marker <= 0xD9 or marker == 0x01:
+                # Заполнитель и маркеры без длины
+                pos += 1 if marker == 0xFF else 2
+                continue
+            length = (buf[pos + 2] << 8) | buf[pos + 3]
+            if marker in _JPEG_SOF:
+                h = (buf[pos + 5] << 8) | buf[pos + 6]
+                w = (buf[pos + 7] << 8) | buf[pos + 8]
+                return w, h
+            pos += 2 + length
+    return None
+
+
+def reduction_factor(size: Tuple[int, int], max_side: int) -> int:
+    """
+    Наибольшее уменьшение 1/2/4/8, после которого большая сторона
+    всё ещё не меньше max_side (дальше изображение уменьшают resize).
+
+    :param size: (ширина, высота) исходного изображения
+    :param max_side: нужная большая сторона
+    :return: 1, 2, 4 или 8
+    """
+    side = max(size)
+    for factor in (8, 4, 2):
+        if side // factor >= max_side:
+            return factor
+    return 1
+
+
+def imread_reduced(path, max_side: int, flags: int = cv2.IMREAD_COLOR) -> Optional[np.ndarray]:
+    """
+    Чтение изображения сразу с уменьшенным разрешением, не меньше max_side
+    по большой стороне.
+
+    JPEG декодируется с уменьшением 2/4/8 (IMREAD_REDUCED_*) — в разы
+    быстрее полного декодирования. Для остальных форматов такого пути нет:
+    декодирование полное, уменьшение остаётся вызывающему коду.
+
+    :param path: путь к файлу (кириллица поддерживается)
+    :param max_side: нужная большая сторона результата
+    :param flags: cv2.IMREAD_COLOR или cv2.IMREAD_GRAYSCALE
+    :return: изображение (большая сторона >= min(max_side, исходной)) или None
+    """
+    try:
+        with file_view(path) as data:
+            if data.size == 0:
+                return None
+            size = image_header_size(data)
+            factor = reduction_factor(size, max_side) if size else 1
+            if factor > 1 and data[:2].tobytes() == b'\xff\xd8' and flags in _REDUCED_FLAGS:
+                img = cv2.imdecode(data, _REDUCED_FLAGS[flags][factor])
+                if img is not None:
+                    return img
+            return cv2.imdecode(data, flags)
+    except (OSError, ValueError, cv2.error):
+        return None
 
 
 def safe_imwrite(path: str, img: np.ndarray) -> bool:
@@ -82,6 +233,27 @@ def compute_file_hash(path: str) -> str:
     return sha256.hexdigest()
 
 
+def compute_file_digest(path: str) -> str:
+    """
+    Вычисляет SHA256 хэш файла чтением блоками по 1 МиБ в один буфер.
+    Значение то же, что у compute_file_hash: ключи ResultCache совпадают
+    с ключами кэша, перенесённого из старого формата.
+    
+    :param path: путь к файлу
+    :return: hex строка хэша
+    """
+    digest = hashlib.sha256()
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
 def compute_settings_hash(settings: Dict[str, Any]) -> str:
     """
     Вычисляет хэш настроек для кэширования.
@@ -96,71 +268,412 @@ def compute_settings_hash(settings: Dict[str, Any]) -> str:
 class ResultCache:
     """
     Кэш результатов сравнения для избежания повторных вычислений.
+
+    Хранится в SQLite (cache_dir/results.sqlite3, журнал WAL): результат
+    лежит прямо в строке таблицы, запись дешёвая и не переписывает весь
+    индекс. Изменения копятся в памяти и пишутся одной транзакцией
+    (commit_every изменений или commit_interval секунд, а также flush/close),
+    поэтому блокировка записи в базе держится только на время пачки. Размер ограничен
+    max_entries и max_bytes — вытесняются давно не читанные записи (LRU);
+    при ttl устаревшие записи не возвращаются и удаляются.
+
+    Несколько процессов на одной машине могут работать с одним каталогом:
+    конкурентный доступ разруливает SQLite (busy_timeout). Старый формат
+    (index.json + файл на ключ) переносится в базу один раз при открытии.
+
+    После close get возвращает промах, а put ничего не пишет: потоки пакета,
+    которые ещё доделывают работу при закрытии окна, не падают.
     """
-    
-    def __init__(self, cache_dir: str = ".imgdiff_cache"):
+
+    DB_NAME = "results.sqlite3"
+
+    def __init__(
+        self,
+        cache_dir: str = ".imgdiff_cache",
+        max_entries: int = RESULT_CACHE_ENTRIES,
+        max_bytes: int = RESULT_CACHE_BYTES,
+        ttl: Optional[float] = None,
+        commit_every: int = 64,
+        commit_interval: float = 2.0
+    ):
+        """
+        :param cache_dir: каталог кэша
+        :param max_entries: предел числа записей (0 — без предела)
+        :param max_bytes: предел суммарного размера результатов (0 — без предела)
+        :param ttl: время жизни записи в секундах (None — бессрочно)
+        :param commit_every: фиксировать изменения после стольких записей
+        :param commit_interval: и не реже чем раз в столько секунд
+        """
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
-        self.index_file = self.cache_dir / "index.json"
-        self.index = self._load_index()
-    
-    def _load_index(self) -> Dict:
-        """Загружает индекс кэша"""
-        if self.index_file.exists():
-            try:
-                with open(self.index_file, 'r') as f:
-                    return json.load(f)
-            except Exception:
-                return {}
-        return {}
-    
-    def _save_index(self):
-        """Сохраняет индекс кэша"""
-        try:
-            with open(self.index_file, 'w') as f:
-                json.dump(self.index, f, indent=2)
-        except Exception:
-            pass
-    
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        self.commit_every = max(1, int(commit_every))
+        self.commit_interval = float(commit_interval)
+        self._lock = threading.RLock()
+        # Ещё не записанные в базу: key -> (value, created) и key -> время чтения
+        self._puts: Dict[str, Tuple[str, float]] = {}
+        self._touches: Dict[str, float] = {}
+        self._last_commit = time.monotonic()
+        self._db = sqlite3.connect(
+            str(self.cache_dir / self.DB_NAME), timeout=30.0, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results(accessed)")
+        self._db.commit()
+        self._migrate_json()
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.stats()['entries']
+
     def get_cache_key(self, img_a_hash: str, img_b_hash: str, settings_hash: str) -> str:
         """Формирует ключ кэша"""
         combined = f"{img_a_hash}_{img_b_hash}_{settings_hash}"
         return hashlib.sha256(combined.encode()).hexdigest()
-    
+
     def get(self, cache_key: str) -> Optional[Dict]:
-        """Получает результат из кэша"""
-        if cache_key in self.index:
-            cache_file = self.cache_dir / f"{cache_key}.json"
-            if cache_file.exists():
-                try:
-                    with open(cache_file, 'r') as f:
-                        return json.load(f)
-                except Exception:
-                    pass
-        return None
-    
+        """Получает результат из кэша (после close — всегда промах)"""
+        now = time.time()
+        with self._lock:
+            if self._db is None:
+                return None
+            row = self._puts.get(cache_key) or self._db.execute(
+                "SELECT value, created FROM results WHERE key = ?", (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                # Удалит вытеснение при следующей записи пачки
+                return None
+            self._touches[cache_key] = now
+            self._changed()
+        try:
+            return self._loads(value)
+        except ValueError:
+            return None
+
     def put(self, cache_key: str, result: Dict):
-        """Сохраняет результат в кэш"""
-        cache_file = self.cache_dir / f"{cache_key}.json"
+        """Сохраняет результат в кэш (после close запись отбрасывается)"""
         try:
-            with open(cache_file, 'w') as f:
-                json.dump(result, f, indent=2)
-            self.index[cache_key] = {
-                "file": str(cache_file),
-                "timestamp": str(Path(cache_file).stat().st_mtime)
-            }
-            self._save_index()
-        except Exception:
-            pass
-    
+            value = self._dumps(result)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            if self._db is None:
+                return
+            self._puts[cache_key] = (value, time.time())
+            self._touches.pop(cache_key, None)
+            self._changed()
+
+    def flush(self):
+        """Фиксирует накопленные изменения (с вытеснением сверх пределов)"""
+        with self._lock:
+            if self._db is None:
+                return
+            puts, touches = self._puts, self._touches
+            self._puts, self._touches = {}, {}
+            self._last_commit = time.monotonic()
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    [(key, value, len(value), created, created) for key, (value, created) in puts.items()]
+                )
+                self._db.executemany(
+                    "UPDATE results SET accessed = MAX(accessed, ?) WHERE key = ?",
+                    [(accessed, key) for key, accessed in touches.items()]
+                )
+                self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Заполненность кэша.
+
+        :return: словарь: entries, bytes, max_entries, max_bytes
+        """
+        with self._lock:
+            if self._db is None:
+                return {'entries': 0, 'bytes': 0, 'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+            self.flush()
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {'entries': entries, 'bytes': size, 'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
     def clear(self):
         """Очищает кэш"""
-        import shutil
-        if self.cache_dir.exists():
-            shutil.rmtree(self.cache_dir)
+        with self._lock:
+            self._puts.clear()
+            self._touches.clear()
+            if self._db is None:
+                return
+            with self._db:
+                self._db.execute("DELETE FROM results")
+
+    def close(self):
+        """Фиксирует изменения и закрывает базу"""
+        with self._lock:
+            if self._db is None:
+                return
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def _dumps(self, result):
+        """Значение для строки базы"""
+        return json.dumps(result, separators=(',', ':'))
+
+    def _loads(self, value):
+        """Результат из строки базы"""
+        return json.loads(value)
+
+    def _changed(self):
+        """Записывает пачку, когда накопилось commit_every изменений или прошло commit_interval"""
+        pending = len(self._puts) + len(self._touches)
+        if pending >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.flush()
+
+    def _evict(self):
+        """Удаляет устаревшие записи и самые давно читанные сверх пределов"""
+        db = self._db
+        if self.ttl is not None:
+            db.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        excess = entries - self.max_entries if self.max_entries > 0 else 0
+        over = size - self.max_bytes if self.max_bytes > 0 else 0
+        if excess <= 0 and over <= 0:
+            return
+        victims = []
+        for key, row_size in db.execute("SELECT key, size FROM results ORDER BY accessed"):
+            if excess <= 0 and over <= 0:
+                break
+            victims.append((key,))
+            excess -= 1
+            over -= row_size
+        db.executemany("DELETE FROM results WHERE key = ?", victims)
+
+    def _migrate_json(self):
+        """Однократный перенос старого формата: index.json + <key>.json на ключ"""
+        index_file = self.cache_dir / "index.json"
+        if not index_file.exists():
+            return
+        with self._lock:
+            # Другой процесс мог уже перенести кэш — проверяем под блокировкой записи
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                try:
+                    with open(index_file, 'r') as f:
+                        index = json.load(f)
+                except (OSError, ValueError):
+                    index = {}
+                if not isinstance(index, dict):
+                    index = {}
+                for cache_key, meta in index.items():
+                    cache_file = self.cache_dir / f"{cache_key}.json"
+                    try:
+                        with open(cache_file, 'r') as f:
+                            value = json.dumps(json.load(f), separators=(',', ':'))
+                        stamp = float((meta or {}).get("timestamp", 0) or cache_file.stat().st_mtime)
+                    except (OSError, ValueError, TypeError, AttributeError):
+                        continue
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                        (cache_key, value, len(value), stamp, stamp)
+                    )
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            for cache_key in index:
+                try:
+                    (self.cache_dir / f"{cache_key}.json").unlink()
+                except OSError:
+                    pass
+            try:
+                index_file.unlink()
+            except OSError:
+                pass
+        self.flush()
+
+
+class FingerprintIndex:
+    """
+    Постоянный индекс отпечатков файлов: (st_dev, st_ino, st_size, st_mtime_ns)
+    → SHA256 содержимого.
+
+    Файл перечитывается и хэшируется, только если его stat-подпись
+    изменилась (или её ещё нет в индексе) — повторный запуск пакета по
+    неизменённым входам не читает их с диска. Хранится в SQLite
+    (cache_dir/fingerprints.sqlite3, WAL) рядом с ResultCache; новые
+    отпечатки пишутся пачками, как в ResultCache.
+
+    Файл, изменённый в последние RACY_SECONDS секунд, хэшируется, но не
+    запоминается: запись в тот же тик mtime не изменила бы подпись.
+    """
+
+    DB_NAME = "fingerprints.sqlite3"
+    RACY_SECONDS = 2.0
+
+    def __init__(self, cache_dir: str = ".imgdiff_cache", max_entries: int = FINGERPRINT_ENTRIES,
+                 commit_every: int = 256):
+        """
+        :param cache_dir: каталог кэша
+        :param max_entries: предел числа отпечатков (вытесняются давно не запрошенные)
+        :param commit_every: записывать новые отпечатки пачками такого размера
+        """
+        self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
-        self.index = {}
-        self._save_index()
+        self.max_entries = int(max_entries)
+        self.commit_every = max(1, int(commit_every))
+        self._lock = threading.RLock()
+        self._pending: Dict[Tuple[int, int, int, int], Tuple[str, float]] = {}
+        self._hashed = 0
+        self._hits = 0
+        self._db = sqlite3.connect(
+            str(self.cache_dir / self.DB_NAME), timeout=30.0, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            " dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+            " digest TEXT NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS fingerprints_accessed ON fingerprints(accessed)")
+        self._db.commit()
+
+    def __enter__(self) -> "FingerprintIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @staticmethod
+    def signature(path) -> Tuple[int, int, int, int]:
+        """
+        Stat-подпись файла.
+
+        :param path: путь к файлу
+        :return: (st_dev, st_ino, st_size, st_mtime_ns)
+        """
+        st = os.stat(path)
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+    def digest(self, path) -> str:
+        """
+        Хэш содержимого файла; для неизменённого файла — из индекса, без чтения.
+
+        :param path: путь к файлу
+        :return: hex строка SHA256 (как compute_file_digest)
+        """
+        sig = self.signature(path)
+        now = time.time()
+        with self._lock:
+            if sig in self._pending:
+                digest = self._pending[sig][0]
+            elif self._db is None:
+                digest = None
+            else:
+                row = self._db.execute(
+                    "SELECT digest FROM fingerprints WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?", sig
+                ).fetchone()
+                digest = row[0] if row else None
+            if digest is not None:
+                self._hits += 1
+                self._pending[sig] = (digest, now)
+                self._maybe_flush()
+                return digest
+        digest = compute_file_digest(path)
+        # Подпись проверяется после чтения: файл мог измениться во время хэширования
+        if self.signature(path) == sig and now - sig[3] / 1e9 > self.RACY_SECONDS:
+            with self._lock:
+                self._pending[sig] = (digest, now)
+                self._maybe_flush()
+        with self._lock:
+            self._hashed += 1
+        return digest
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Счётчики индекса.
+
+        :return: словарь: entries, hits (без чтения файла), hashed (с чтением)
+        """
+        with self._lock:
+            self.flush()
+            entries = self._db.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0] if self._db else 0
+            return {'entries': entries, 'hits': self._hits, 'hashed': self._hashed}
+
+    def flush(self):
+        """Записывает накопленные отпечатки (с вытеснением сверх max_entries)"""
+        with self._lock:
+            if self._db is None:
+                self._pending.clear()
+                return
+            pending, self._pending = self._pending, {}
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO fingerprints (dev, ino, size, mtime_ns, digest, accessed)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [sig + (digest, accessed) for sig, (digest, accessed) in pending.items()]
+                )
+                if self.max_entries > 0:
+                    self._db.execute(
+                        "DELETE FROM fingerprints WHERE rowid IN (SELECT rowid FROM fingerprints"
+                        " ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+                    )
+
+    def close(self):
+        """Записывает отпечатки и закрывает базу"""
+        with self._lock:
+            if self._db is None:
+                return
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def _maybe_flush(self):
+        if len(self._pending) >= self.commit_every:
+            self.flush()
+
+
+class MaskCache(ResultCache):
+    """
+    Кэш продуктов анализа пары (например, упакованных масок отличий) —
+    тот же ResultCache, но значения — байты (cache_dir/masks.sqlite3).
+
+    Ключ строится только из параметров анализа, поэтому смена цвета или
+    толщины обводки переиспользует маски без повторного сравнения.
+    """
+
+    DB_NAME = "masks.sqlite3"
+
+    def __init__(self, cache_dir: str = ".imgdiff_cache", max_entries: int = RESULT_CACHE_ENTRIES,
+                 max_bytes: int = MASK_CACHE_BYTES, ttl: Optional[float] = None,
+                 commit_every: int = 16, commit_interval: float = 2.0):
+        super().__init__(cache_dir, max_entries, max_bytes, ttl, commit_every, commit_interval)
+
+    def _dumps(self, result) -> bytes:
+        if not isinstance(result, (bytes, bytearray, memoryview, np.ndarray)):
+            raise TypeError("MaskCache хранит только байты")
+        return bytes(result)
+
+    def _loads(self, value) -> bytes:
+        return bytes(value)
+
+    def _migrate_json(self):
+        """Старого формата у кэша масок нет (index.json принадлежит ResultCache)"""
 
 
 def resize_for_preview(img: np.ndarray, max_size: int = 2000) -> np.ndarray:
@@ -3,59 +3,150 @@
 """
 import cv2
 import numpy as np
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+from .components import STRIP_ROWS, Components, filter_components
+from .workspace import DiffWorkspace, scratch
 
 
 def bboxes_from_mask(m: np.ndarray, min_area: int = 50) -> List[Tuple[int, int, int, int]]:
     """
     Извлекает боксы компонент из бинарной маски.
-    Использует connectedComponentsWithStats (быстрее findContours).
+    Использует connectedComponentsWithStats (быстрее findContours);
+    если нужны и другие характеристики регионов, используйте Components.
     
     :param m: бинарная маска 0/255
     :param min_area: минимальная площадь компоненты
     :return: список (x, y, w, h)
     """
-    n, labels, stats, _ = cv2.connectedComponentsWithStats(m, connectivity=8)
-    boxes = []
-    for i in range(1, n):  # пропускаем фон (0)
-        x, y, w, h, area = stats[i]
-        if area >= min_area:
-            boxes.append((x, y, w, h))
-    return boxes
+    return Components.from_mask(m, min_area=min_area).boxes()
+
+
+def merge_boxes(
+    boxes: List[Tuple[int, int, int, int]],
+    gap: int = 0
+) -> List[Tuple[int, int, int, int]]:
+    """
+    Объединяет пересекающиеся и соприкасающиеся боксы.
+    Повторяет слияние до тех пор, пока результат не перестанет меняться,
+    поэтому итоговые боксы попарно не пересекаются.
+    
+    :param boxes: список (x, y, w, h)
+    :param gap: допустимый зазор между боксами для слияния (px)
+    :return: список непересекающихся (x, y, w, h)
+    """
+    if not boxes:
+        return []
+    # (x0, y0, x1, y1) с исключающей правой/нижней границей
+    rest = np.array([(x, y, x + w, y + h) for x, y, w, h in boxes], dtype=np.int64)
+    while True:
+        merged = []
+        while len(rest):
+            cur = rest[0]
+            rest = rest[1:]
+            while len(rest):
+                hit = (
+                    (rest[:, 0] <= cur[2] + gap) & (rest[:, 2] + gap >= cur[0]) &
+                    (rest[:, 1] <= cur[3] + gap) & (rest[:, 3] + gap >= cur[1])
+                )
+                if not hit.any():
+                    break
+                grp = rest[hit]
+                cur = np.array([
+                    min(cur[0], grp[:, 0].min()), min(cur[1], grp[:, 1].min()),
+                    max(cur[2], grp[:, 2].max()), max(cur[3], grp[:, 3].max()),
+                ])
+                rest = rest[~hit]
+            merged.append(cur)
+        if len(merged) == len(boxes):
+            break
+        boxes = merged
+        rest = np.array(merged, dtype=np.int64)
+    return [(int(x0), int(y0), int(x1 - x0), int(y1 - y0)) for x0, y0, x1, y1 in merged]
 
 
 def filter_small_components(
     mask: np.ndarray,
-    min_area: int = 20
+    min_area: int = 20,
+    strip: int = STRIP_ROWS,
+    dst: Optional[np.ndarray] = None
 ) -> np.ndarray:
     """
     Фильтрует мелкие компоненты из маски (шумоподавление).
+    Как и заливка внешних контуров, заливает дыры оставшихся компонент;
+    площадь считается в пикселях вместе с дырами.
+    Маска обрабатывается полосами (см. components.filter_components):
+    кроме результата память — одна полоса.
     
     :param mask: бинарная маска
     :param min_area: минимальная площадь
+    :param strip: высота полосы (строк)
+    :param dst: буфер результата (можно сам mask)
     :return: отфильтрованная маска
     """
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    mask_out = np.zeros_like(mask)
-    for cnt in contours:
-        if cv2.contourArea(cnt) >= min_area:
-            cv2.drawContours(mask_out, [cnt], -1, 255, -1)
-    return mask_out
+    return filter_components(mask, min_area, fill=True, strip=strip, dst=dst)
 
 
-def dilate_mask(mask: np.ndarray, thickness: int = 3) -> np.ndarray:
+def denoise_mask(
+    m: np.ndarray,
+    workspace: Optional[DiffWorkspace] = None,
+    dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Лёгкое шумоподавление бинарной маски: медиана 3×3 + MORPH_OPEN 3×3.
+    Влияет на соседей в радиусе 3 px (см. tiled.NOISE_HALO).
+    
+    :param m: бинарная маска 0/255
+    :param workspace: буферы для промежуточной медианы
+    :param dst: буфер результата (по умолчанию новый массив)
+    :return: очищенная маска
+    """
+    med = cv2.medianBlur(m, 3, dst=scratch(workspace, "mask_median", m.shape))
+    return cv2.morphologyEx(med, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8), dst=dst, iterations=1)
+
+
+def dilate_mask(
+    mask: np.ndarray,
+    thickness: int = 3,
+    strip: int = 0,
+    dst: Optional[np.ndarray] = None
+) -> np.ndarray:
     """
     Расширяет маску для лучшей видимости (толщина линий).
     
+    При strip > 0 кадр обрабатывается полосами с перекрытием на размер ядра;
+    нерасширенные строки над полосой хранятся отдельно, поэтому dst может
+    быть самой mask, а результат совпадает с расширением целого кадра.
+    
     :param mask: бинарная маска
     :param thickness: толщина в пикселях
+    :param strip: высота полосы (строк); 0 — весь кадр сразу
+    :param dst: буфер результата (по умолчанию новый массив)
     :return: расширенная маска
     """
     if thickness <= 1:
-        return mask
+        if dst is None or dst is mask:
+            return mask
+        np.copyto(dst, mask)
+        return dst
     
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (thickness, thickness))
-    return cv2.dilate(mask, kernel)
+    if strip <= 0:
+        return cv2.dilate(mask, kernel, dst=dst)
+    
+    h = mask.shape[0]
+    if dst is None:
+        dst = np.empty_like(mask)
+    halo = thickness
+    above = mask[:0].copy()
+    for y0 in range(0, h, strip):
+        y1 = min(y0 + strip, h)
+        # Исходные строки: halo над полосой (сохранены до записи) и halo под ней
+        block = np.concatenate([above, mask[y0:min(y1 + halo, h)]])
+        top = len(above)
+        above = block[max(top + y1 - y0 - halo, 0):top + y1 - y0].copy()
+        dst[y0:y1] = cv2.dilate(block, kernel)[top:top + y1 - y0]
+    return dst
 
 
 def close_gaps(mask: np.ndarray, size: int = 3) -> np.ndarray:
@@ -74,31 +74,46 @@ def draw_two_color_overlay(
     return overlay
 
 
-def create_heatmap(
+def diff_magnitude(
     a: np.ndarray,
     b: np.ndarray,
     use_lab: bool = True
 ) -> np.ndarray:
     """
-    Создаёт тепловую карту различий (heatmap).
+    Попиксельная величина различия (ΔE в Lab или разница яркости).
     
     :param a: изображение A (BGR)
     :param b: изображение B (BGR)
     :param use_lab: использовать Lab пространство
-    :return: цветная heatmap (BGR)
+    :return: карта различий float32 (H, W)
     """
     if use_lab:
         a_lab = cv2.cvtColor(a, cv2.COLOR_BGR2LAB)
         b_lab = cv2.cvtColor(b, cv2.COLOR_BGR2LAB)
         d = cv2.absdiff(a_lab, b_lab)
-        diff = np.sqrt(
+        return np.sqrt(
             d[..., 0].astype(np.float32) ** 2 +
             d[..., 1].astype(np.float32) ** 2 +
             d[..., 2].astype(np.float32) ** 2
         )
-    else:
-        d = cv2.absdiff(a, b)
-        diff = cv2.cvtColor(d, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    d = cv2.absdiff(a, b)
+    return cv2.cvtColor(d, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+
+def create_heatmap(
+    a: np.ndarray,
+    b: np.ndarray,
+    use_lab: bool = True
+) -> np.ndarray:
+    """
+    Создаёт тепловую карту различий (heatmap).
+    
+    :param a: изображение A (BGR)
+    :param b: изображение B (BGR)
+    :param use_lab: использовать Lab пространство
+    :return: цветная heatmap (BGR)
+    """
+    diff = diff_magnitude(a, b, use_lab=use_lab)
     
     # Нормализация
     diff_norm = cv2.normalize(diff, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
@@ -0,0 +1,532 @@
+"""
+Пайплайн сравнения пары файлов для пакетной обработки (без Qt).
+
+Модуль импортирует только imgdiff.core, поэтому годится как точка входа
+воркеров пула процессов (spawn): run_shared принимает и возвращает
+только сериализуемые значения и дескрипторы разделяемой памяти.
+"""
+import logging
+import sys
+import threading
+import time
+import types
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .components import STRIP_ROWS, filter_components
+from .diff import hierarchical_diff
+from .encoder import encode_image
+from .equality import StageTimer, pixels_identical
+from .io import safe_imread
+from .morph import dilate_mask
+from .shm import SharedImage
+from .tiled import diff_mask_tiled
+from .two_color import diff_two_color
+from .workspace import thread_workspace
+
+logger = logging.getLogger(__name__)
+
+# Параметры задачи, которые передаются в воркер (остальные — только для GUI)
+JOB_PARAM_KEYS = (
+    'fuzz', 'thick', 'del_color_bgr', 'add_color_bgr', 'match_tolerance', 'match_color_bgr',
+    'gamma', 'morph_open', 'min_area', 'debug', 'use_ssim', 'output_dir', 'use_fast_core',
+    'save_only_diffs', 'png_compression', 'quick_max_side', 'auto_png', 'auto_align',
+    'auto_align_max_percent', 'tile_size', 'file_hashes',
+)
+
+# Параметры, от которых зависят маски анализа (outline_masks); цвета и
+# толщина обводки — только оформление и в ключ кэша масок не входят
+ANALYSIS_PARAM_KEYS = ('fuzz', 'min_area', 'use_ssim', 'match_tolerance', 'tile_size')
+# Версия формата масок анализа (меняется вместе с outline_masks)
+ANALYSIS_VERSION = 1
+
+_MAIN_LOCK = threading.Lock()
+
+def fast_cv2_imread(path):
+    """Чтение BGR изображения (io.safe_imread: mmap/буфер потока → imdecode, пути с кириллицей)."""
+    return safe_imread(str(path), cv2.IMREAD_COLOR)
+
+
+def job_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Сериализуемая часть параметров задачи (без колбэков паузы/отмены и т.п.).
+
+    :param params: параметры задачи GUI
+    :return: словарь только с ключами JOB_PARAM_KEYS
+    """
+    return {k: params[k] for k in JOB_PARAM_KEYS if k in params}
+
+
+def analysis_settings(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Параметры для ключа кэша масок (см. ANALYSIS_PARAM_KEYS).
+
+    :param params: параметры задачи
+    :return: словарь для compute_settings_hash
+    """
+    settings = {key: params.get(key) for key in ANALYSIS_PARAM_KEYS}
+    settings['analysis_version'] = ANALYSIS_VERSION
+    return settings
+
+
+class OutlineComparator:
+    """
+    Сравнение пары (outline_overlay), разбитое на шаги для конвейера
+    (batch.BatchPipeline) и пула процессов: проверка равенства пикселей,
+    сборка оверлея (в том числе в готовый буфер) и кодирование PNG.
+    Сериализуется вместе с параметрами задачи.
+    """
+
+    def __init__(self, params: Dict[str, Any]):
+        """
+        :param params: параметры задачи (лишние ключи отбрасываются, см. JOB_PARAM_KEYS)
+        """
+        self.params = job_params(params)
+
+    @property
+    def quick_equal(self) -> bool:
+        """Равные пары можно отбрасывать до сравнения (результат не пишется)"""
+        return bool(self.params.get('save_only_diffs', True) or self.params.get('use_fast_core', True))
+
+    def overlay_shape(self, shape_a: Tuple[int, ...], shape_b: Tuple[int, ...]) -> Tuple[int, int, int]:
+        """Форма буфера результата для пары кадров"""
+        return outline_shape(shape_a, shape_b)
+
+    def __call__(self, old: np.ndarray, new: np.ndarray, timer: StageTimer,
+                 out: Optional[np.ndarray] = None) -> Tuple[int, Optional[np.ndarray], Optional[int]]:
+        """
+        Сравнение декодированной пары.
+
+        :param old: изображение A
+        :param new: изображение B
+        :param timer: замер этапов pixels/compare
+        :param out: буфер оверлея формы overlay_shape
+        :return: (code, overlay или None, уровень PNG)
+        """
+        return self.compare(old, new, timer, out)[:3]
+
+    def compare(self, old: np.ndarray, new: np.ndarray, timer: StageTimer, out: Optional[np.ndarray] = None,
+                keep_analysis: bool = False) -> Tuple[int, Optional[np.ndarray], Optional[int], Optional[bytes]]:
+        """
+        Сравнение пары с сохранением продукта анализа для кэша масок.
+
+        :param old: изображение A
+        :param new: изображение B
+        :param timer: замер этапов pixels/compare
+        :param out: буфер оверлея формы overlay_shape
+        :param keep_analysis: вернуть упакованные маски (только быстрое ядро)
+        :return: (code, overlay или None, уровень PNG, маски pack_masks или None);
+                 пустые байты — отличий нет
+        """
+        p = self.params
+        if self.quick_equal:
+            # Разные файлы, но одинаковые пиксели (сжатие, метаданные)
+            with timer.stage('pixels'):
+                same_pixels = pixels_identical(old, new)
+            if same_pixels:
+                return 0, None, None, b"" if keep_analysis else None
+        if not (keep_analysis and p.get('use_fast_core', True)):
+            with timer.stage('compare'):
+                code, overlay, comp = outline_overlay(
+                    old, new, p['fuzz'], p['thick'], p['del_color_bgr'], p['add_color_bgr'],
+                    p['match_tolerance'], p['match_color_bgr'], p['gamma'], p['morph_open'],
+                    p['min_area'], p['debug'], p['use_ssim'], p['output_dir'],
+                    p.get('use_fast_core', True), p.get('save_only_diffs', True), p.get('png_compression', 1),
+                    p.get('auto_png', False), p.get('tile_size', 0), out=out,
+                )
+            return code, overlay, comp, None
+        with timer.stage('compare'):
+            old, new = fit_pair(old, new)
+            label = outline_masks(old, new, p['fuzz'], p['min_area'], p.get('tile_size', 0))
+        if label is None:
+            return 0, None, None, b""
+        with timer.stage('render'):
+            code, overlay, comp = self._render(new, label, out)
+        return code, overlay, comp, pack_masks(label)
+
+    def render(self, new: np.ndarray, analysis: bytes, timer: StageTimer,
+               out: Optional[np.ndarray] = None) -> Tuple[int, Optional[np.ndarray], Optional[int]]:
+        """
+        Результат по сохранённым маскам анализа (см. compare): без A и без ΔE.
+
+        :param new: изображение B
+        :param analysis: маски pack_masks (пустые байты — отличий нет)
+        :param timer: замер этапа render
+        :param out: буфер оверлея формы overlay_shape
+        :return: (code, overlay или None, уровень PNG)
+        """
+        if not analysis:
+            return 0, None, None
+        with timer.stage('render'):
+            return self._render(new, unpack_masks(analysis), out)
+
+    def _render(self, new, label, out):
+        p = self.params
+        code, overlay, comp = render_outline(
+            new, label, p['thick'], p['del_color_bgr'], p['add_color_bgr'],
+            p.get('png_compression', 1), p.get('auto_png', False), out=out,
+        )
+        return code, overlay, comp if overlay is not None else None
+
+    def encode(self, overlay: np.ndarray, out_path, comp: int) -> np.ndarray:
+        """Кодирование результата для записи (см. encoder.EncoderPool)"""
+        return encode_overlay(overlay, out_path, comp)
+
+
+def run_shared(
+    comparator,
+    handle_a: SharedImage,
+    handle_b: SharedImage,
+    overlay: SharedImage,
+    keep_analysis: bool = False,
+    started: Optional[Tuple[SharedImage, int]] = None
+) -> Tuple[int, str, float, Dict[str, float], Any, Optional[bytes]]:
+    """
+    Сравнение уже декодированной пары из разделяемой памяти (точка входа воркера).
+    Между процессами передаются только дескрипторы: воркер читает A/B
+    и собирает результат прямо в сегменте overlay владельца, запись
+    на диск остаётся за владельцем (comparator.encode).
+
+    :param comparator: сравнение пары (например, OutlineComparator)
+    :param handle_a: изображение A
+    :param handle_b: изображение B
+    :param overlay: буфер результата формы comparator.overlay_shape(A, B)
+    :param keep_analysis: вернуть продукт анализа для кэша масок (comparator.compare)
+    :param started: (флаги, слот): воркер ставит 1 в слот, взяв задачу, — от этого
+                    момента владелец отсчитывает таймаут пары
+    :return: (code, error_message, duration_s, timings, write_arg, analysis);
+             write_arg None — записывать нечего; analysis — упакованные маски
+             или None; code -1 — ошибка
+    """
+    timings: Dict[str, float] = {}
+    start_t = time.perf_counter()
+    if started is not None:
+        board, slot = started
+        flags = board.array()
+        flags[slot] = 1
+        del flags
+        board.close()
+    old = new = out = None
+    try:
+        old = handle_a.array()
+        new = handle_b.array()
+        timer = StageTimer(timings)
+        if keep_analysis and hasattr(comparator, 'compare'):
+            code, out, write_arg, analysis = comparator.compare(old, new, timer, out=overlay.array(),
+                                                                keep_analysis=True)
+        else:
+            code, out, write_arg = comparator(old, new, timer, out=overlay.array())
+            analysis = None
+        duration = max(0.0, time.perf_counter() - start_t)
+        return code, "", duration, timings, write_arg if out is not None else None, analysis
+    except Exception as e:
+        return -1, str(e), 0.0, timings, None, None
+    finally:
+        old = new = out = None
+        for handle in (handle_a, handle_b, overlay):
+            handle.close()
+
+
+def worker_init(cv_threads: Optional[int] = 1, log_file: Optional[str] = None) -> None:
+    """
+    Инициализация процесса-воркера: ограничивает потоки OpenCV, чтобы
+    N процессов не делили ядра с N внутренними пулами, и настраивает лог
+    (процесс spawn начинается с чистой конфигурации logging).
+
+    :param cv_threads: число потоков OpenCV на процесс (None — не менять)
+    :param log_file: файл лога воркера (None — не настраивать)
+    """
+    if cv_threads is not None:
+        cv2.setNumThreads(int(cv_threads))
+    if log_file:
+        logging.basicConfig(
+            filename=log_file,
+            filemode='a',
+            format='%(asctime)s [%(process)d] %(levelname)s: %(message)s',
+            level=logging.INFO
+        )
+
+
+def shutdown_executor(executor, wait: bool = True) -> None:
+    """
+    Останавливает пул, снимая ещё не начатые задачи.
+
+    cancel_futures есть в Executor.shutdown с Python 3.9; на 3.8 начатые
+    и ожидающие задачи дорабатывают до конца.
+
+    :param executor: пул concurrent.futures
+    :param wait: дождаться завершения процессов
+    """
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=wait, cancel_futures=True)
+    else:
+        executor.shutdown(wait=wait)
+
+
+@contextmanager
+def isolated_main() -> Iterator[None]:
+    """
+    Запуск процессов spawn без повторного исполнения главного скрипта.
+
+    Дочерний процесс spawn по умолчанию заново импортирует __main__
+    (для GUI — вместе с PyQt). Задачам пула он не нужен: run_shared
+    живёт в этом модуле, поэтому на время старта процессов __main__
+    подменяется пустым модулем. В собранном exe (sys.frozen) подмена
+    не нужна — там работает multiprocessing.freeze_support().
+    """
+    if getattr(sys, 'frozen', False):
+        yield
+        return
+    # Подмена общая для процесса: потоки, запускающие задачи, ждут друг друга
+    with _MAIN_LOCK:
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main
+
+
+def png_level(diff_pixels: int, total_pixels: int, png_compression: int, auto_png: bool) -> int:
+    """
+    Уровень сжатия PNG результата.
+
+    :param diff_pixels: число отличающихся пикселей
+    :param total_pixels: число пикселей кадра
+    :param png_compression: уровень, выбранный пользователем
+    :param auto_png: подбирать уровень по доле отличий (много отличий — быстрее)
+    :return: уровень для cv2.IMWRITE_PNG_COMPRESSION
+    """
+    comp = int(png_compression)
+    if auto_png and total_pixels > 0:
+        ratio = diff_pixels / float(total_pixels)
+        if ratio > 0.05:
+            comp = 1
+        elif ratio > 0.005:
+            comp = 2
+        else:
+            comp = 4
+    return comp
+
+
+def encode_overlay(overlay: np.ndarray, out_path, comp: int) -> np.ndarray:
+    """
+    Кодирует оверлей результата в формат по расширению out_path.
+
+    :param overlay: BGRA изображение
+    :param out_path: путь результата
+    :param comp: уровень сжатия PNG
+    :return: закодированные байты
+    """
+    return encode_image(overlay, Path(out_path).suffix, [cv2.IMWRITE_PNG_COMPRESSION, int(comp)])
+
+
+def outline_shape(old_shape: Tuple[int, ...], new_shape: Tuple[int, ...]) -> Tuple[int, int, int]:
+    """
+    Форма оверлея для пары кадров (меньший кадр растягивается до большего).
+
+    :param old_shape: форма изображения A
+    :param new_shape: форма изображения B
+    :return: (h, w, 4)
+    """
+    return max(old_shape[0], new_shape[0]), max(old_shape[1], new_shape[1]), 4
+
+
+def fit_pair(old: np.ndarray, new: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Приводит пару к общему размеру (меньший кадр растягивается, LANCZOS4).
+
+    :param old: изображение A
+    :param new: изображение B
+    :return: (A, B) размера outline_shape
+    """
+    h, w, _ = outline_shape(old.shape, new.shape)
+    if old.shape[:2] != (h, w):
+        old = cv2.resize(old, (w, h), interpolation=cv2.INTER_LANCZOS4)
+    if new.shape[:2] != (h, w):
+        new = cv2.resize(new, (w, h), interpolation=cv2.INTER_LANCZOS4)
+    return old, new
+
+
+def outline_overlay(old, new, fuzz, thick, del_color_bgr, add_color_bgr,
+                    match_tolerance, match_color_bgr, gamma, morph_open, min_area,
+                    debug, use_ssim, output_dir, use_fast_core, save_only_diffs,
+                    png_compression, auto_png, tile_size, out=None):
+    """Сравнение декодированной пары без записи на диск.
+
+    Возвращает (code, overlay, comp): code 1 — есть отличия, 0 — равны;
+    overlay — BGRA для записи (None, если писать нечего), comp — уровень PNG.
+    При переданном out (буфер формы outline_shape, например в разделяемой
+    памяти) оверлей собирается прямо в нём.
+    """
+    # Выравниваем размеры
+    old, new = fit_pair(old, new)
+
+    # REMOVED: Quick pre-check optimization that was causing false negatives
+    # Now all comparisons go through the full comparison algorithm
+    # This ensures files with real differences are properly detected
+
+    if use_fast_core:
+        label = outline_masks(old, new, fuzz, min_area, tile_size)
+        if label is None:
+            return 0, None, 0
+        return render_outline(new, label, thick, del_color_bgr, add_color_bgr, png_compression, auto_png, out=out)
+
+    # Fallback: старая двухцветная LAB‑дифференциация на весь кадр
+    debug_dir = Path(output_dir) / 'debug' if debug and output_dir else Path('.')
+    overlay, meta = diff_two_color(
+        old_img=old,
+        new_img=new,
+        sens=fuzz,
+        blur=3,
+        morph_open=morph_open,
+        min_area=min_area,
+        kernel=thick,
+        alpha=0.6,
+        gamma=gamma,
+        del_color=del_color_bgr,
+        add_color=add_color_bgr,
+        debug=debug,
+        debug_dir=debug_dir,
+        use_ssim=use_ssim,
+        match_tolerance=match_tolerance,
+        match_color=match_color_bgr,
+        block_index=True,
+    )
+
+    diff_pixels = int(meta.get('diff_pixels', 0))
+    code = 1 if diff_pixels > 0 else 0
+    if diff_pixels == 0 and save_only_diffs:
+        return code, None, 0
+    if out is not None:
+        np.copyto(out, overlay)
+        overlay = out
+    return code, overlay, png_level(diff_pixels, int(meta.get('total_pixels', 0)), png_compression, auto_png)
+
+
+# Биты метки в упакованных масках анализа (outline_masks)
+MASK_TOTAL = 1
+MASK_ADD = 2
+MASK_DEL = 4
+
+
+def outline_masks(old, new, fuzz, min_area, tile_size) -> Optional[np.ndarray]:
+    """
+    Анализ пары быстрым ядром — дорогая часть outline_overlay, не зависящая
+    от оформления (цвета, толщина обводки).
+
+    :param old: изображение A (уже приведённое к размеру пары)
+    :param new: изображение B того же размера
+    :param fuzz: порог различия
+    :param min_area: минимальная площадь компоненты
+    :param tile_size: сторона тайла (0 — иерархический проход)
+    :return: метка HxW uint8: бит MASK_TOTAL — отличия после фильтрации мелких
+             компонент (до обводки), MASK_ADD/MASK_DEL — «появилось»/«исчезло»;
+             None — отличий нет
+    """
+    h, w = old.shape[:2]
+    # Буферы ядра принадлежат потоку пула и переживают между парами
+    ws = thread_workspace()
+    # Общая маска и add/del пишутся битами в одну метку — 1 Б/px на кадр
+    label = np.zeros((h, w), dtype=np.uint8)
+
+    if tile_size and tile_size > 0:
+        # Потайловый проход: маска как у полного кадра, временные буферы —
+        # на тайл; add/del считаются в том же проходе по тайлу
+        diff_mask_tiled(old, new, fuzz=fuzz, use_lab=True, tile_size=int(tile_size),
+                        workspace=ws, out=label, bits=(MASK_TOTAL, MASK_ADD, MASK_DEL))
+    else:
+        # Иерархическое уточнение по пирамиде максимумов: спускаемся только
+        # в помеченные ячейки, различия не теряются ни на каком уровне.
+        # Маски ROI приходят готовыми и не пересекаются
+        rois, level_stats = hierarchical_diff(old, new, fuzz=fuzz, use_lab=True, levels=4, leaf=16,
+                                              workspace=ws, split=True)
+        for st in level_stats:
+            logger.debug(
+                f"pyramid L{st['level']} ({st['cell']}px): examined={st['examined']} "
+                f"flagged={st['flagged']} dense={st['dense']} pruned={st['pruned_fraction']:.1%}"
+            )
+        if not rois:
+            return None
+
+        for (x, y, bw, bh), roi_mask, add_bin, del_bin in rois:
+            # ROI после слияния не пересекаются — пишем напрямую;
+            # направление изменений (add/del) посчитано тем же проходом Lab.
+            # Маски 0/255: AND с битом даёт 0/бит
+            dst = label[y:y+bh, x:x+bw]
+            np.bitwise_and(roi_mask, np.uint8(MASK_TOTAL), out=dst)
+            dst |= add_bin & np.uint8(MASK_ADD)
+            dst |= del_bin & np.uint8(MASK_DEL)
+
+    # Фильтр мелких компонент — по биту MASK_TOTAL на месте, полосами
+    filter_components(label, min_area, fill=True, bit=MASK_TOTAL, dst=label)
+    if not any(np.bitwise_and(label[y:y+STRIP_ROWS], MASK_TOTAL).any() for y in range(0, h, STRIP_ROWS)):
+        return None
+    return label
+
+
+def render_outline(new, label, thick, del_color_bgr, add_color_bgr, png_compression, auto_png,
+                   out=None) -> Tuple[int, Optional[np.ndarray], int]:
+    """
+    Оформление результата по маскам анализа: обводка толщиной thick
+    и заливка add/del поверх B. Изображение A не нужно.
+
+    :param new: изображение B (приводится к размеру label)
+    :param label: метка outline_masks
+    :param thick: толщина обводки
+    :param del_color_bgr: цвет «исчезло»
+    :param add_color_bgr: цвет «появилось»
+    :param png_compression: уровень сжатия PNG
+    :param auto_png: подбирать уровень по доле отличий
+    :param out: буфер оверлея (h, w, 4)
+    :return: (code, overlay BGRA или None, уровень PNG)
+    """
+    h, w = label.shape[:2]
+    if new.shape[:2] != (h, w):
+        new = cv2.resize(new, (w, h), interpolation=cv2.INTER_LANCZOS4)
+    mask_total = cv2.compare(cv2.bitwise_and(label, MASK_TOTAL), 0, cv2.CMP_GT)
+    mask_total = dilate_mask(mask_total, thickness=thick)
+    mask_add_total = cv2.bitwise_and(cv2.compare(cv2.bitwise_and(label, MASK_ADD), 0, cv2.CMP_GT), mask_total)
+    mask_del_total = cv2.bitwise_and(cv2.compare(cv2.bitwise_and(label, MASK_DEL), 0, cv2.CMP_GT), mask_total)
+
+    diff_pixels = int(cv2.countNonZero(mask_total))
+    if diff_pixels == 0:
+        return 0, None, 0
+
+    # Сборка RGBA overlay (как раньше)
+    overlay = out if out is not None else np.empty((h, w, 4), dtype=np.uint8)
+    overlay[..., :3] = new
+    overlay[..., 3] = 0
+    alpha_val = int(255 * 0.6)
+    overlay[mask_add_total > 0, :3] = add_color_bgr
+    overlay[mask_add_total > 0, 3] = alpha_val
+    overlay[mask_del_total > 0, :3] = del_color_bgr
+    overlay[mask_del_total > 0, 3] = alpha_val
+    return 1, overlay, png_level(diff_pixels, h * w, png_compression, auto_png)
+
+
+def pack_masks(label: np.ndarray) -> bytes:
+    """
+    Компактная форма меток для кэша (PNG: разреженные маски сжимаются в разы).
+
+    :param label: метка outline_masks
+    :return: байты
+    """
+    return encode_image(label, '.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]).tobytes()
+
+
+def unpack_masks(data: bytes) -> np.ndarray:
+    """
+    Метка из pack_masks.
+
+    :param data: байты
+    :return: метка HxW uint8
+    """
+    label = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if label is None or label.ndim != 2:
+        raise ValueError("Повреждённые маски анализа в кэше")
+    return label
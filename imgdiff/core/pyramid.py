@@ -0,0 +1,149 @@
+"""
+Пирамида разностей с max-pooling: грубый проход без ложных «равно»
+"""
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .morph import bboxes_from_mask
+from .workspace import DiffWorkspace, scratch
+
+# Верхняя граница ΔE (8-bit Lab OpenCV) при изменении одного канала B, G, R на 1.
+# Получена полным перебором 256³ цветов (макс. 3.0 / 5.39 / 3.17) и округлена вверх.
+# По неравенству треугольника ΔE(a, b) <= Σ K_c·|a_c - b_c|.
+LAB_STEP_BOUND = (3.0, 5.4, 3.2)
+
+Box = Tuple[int, int, int, int]
+
+
+def diff_strength(
+    a: np.ndarray,
+    b: np.ndarray,
+    use_lab: bool = True,
+    workspace: Optional[DiffWorkspace] = None
+) -> np.ndarray:
+    """
+    Дешёвая (без конверсии в Lab) верхняя оценка силы различия.
+    Для Lab: Σ K_c·|ΔBGR_c| >= ΔE; для BGR: Σ |ΔBGR_c| >= серого absdiff.
+
+    :param a: BGR изображение A
+    :param b: BGR изображение B
+    :param use_lab: оценивать Lab ΔE (иначе серый absdiff)
+    :param workspace: буферы для промежуточной разности
+    :return: карта силы uint8 (с насыщением на 255)
+    """
+    d = cv2.absdiff(a, b, dst=scratch(workspace, "absdiff", a.shape))
+    if d.ndim == 2:
+        d = d[..., None]
+    weights = LAB_STEP_BOUND if use_lab else (1.0, 1.0, 1.0)
+    return cv2.transform(d, np.array([weights[:d.shape[2]]], dtype=np.float32))
+
+
+def strength_threshold(fuzz: float) -> int:
+    """
+    Порог для diff_strength, гарантирующий полноту: любой пиксель с
+    различием >= fuzz даёт силу >= этого порога (с учётом округления).
+
+    :param fuzz: порог различия
+    :return: целочисленный порог
+    """
+    return max(0, int(np.floor(fuzz)))
+
+
+def max_pool(m: np.ndarray, block: int) -> np.ndarray:
+    """
+    Максимум по блокам block×block (неполные крайние блоки учитываются).
+
+    :param m: одноканальная карта
+    :param block: сторона блока
+    :return: карта ceil(h/block) × ceil(w/block)
+    """
+    if block <= 1:
+        return m
+    h, w = m.shape[:2]
+    out = np.maximum.reduceat(m, np.arange(0, h, block), axis=0)
+    return np.maximum.reduceat(out, np.arange(0, w, block), axis=1)
+
+
+def build_max_pyramid(m: np.ndarray, block: int, levels: int = 1) -> List[np.ndarray]:
+    """
+    Пирамида максимумов: уровень 0 — блоки block×block,
+    каждый следующий — max-pooling 2×2 предыдущего.
+
+    :param m: одноканальная карта (обычно diff_strength)
+    :param block: сторона блока нижнего уровня
+    :param levels: число уровней
+    :return: список карт от мелких блоков к крупным
+    """
+    pyr = [max_pool(m, block)]
+    for _ in range(1, levels):
+        pyr.append(max_pool(pyr[-1], 2))
+    return pyr
+
+
+def block_counts(binary: np.ndarray, block: int) -> np.ndarray:
+    """
+    Число ненулевых пикселей в каждом блоке.
+    Интегральное изображение строится по полосам высотой block,
+    поэтому дополнительная память — O(block × w), а не O(h × w).
+
+    :param binary: бинарная карта (0 / не 0)
+    :param block: сторона блока
+    :return: карта счётчиков int64 ceil(h/block) × ceil(w/block)
+    """
+    h, w = binary.shape[:2]
+    xs = np.append(np.arange(0, w, block), w)
+    counts = np.zeros(((h + block - 1) // block, len(xs) - 1), dtype=np.int64)
+    for i, y in enumerate(range(0, h, block)):
+        strip = (binary[y:y+block] > 0).astype(np.uint8)
+        last = cv2.integral(strip, sdepth=cv2.CV_32S)[-1]
+        counts[i] = last[xs[1:]] - last[xs[:-1]]
+    return counts
+
+
+def flagged_boxes(flags: np.ndarray, block: int, shape: Tuple[int, ...], pad: int = 0) -> List[Box]:
+    """
+    Переводит сетку помеченных блоков в боксы полного разрешения.
+
+    :param flags: булева сетка блоков
+    :param block: сторона блока
+    :param shape: форма полного изображения
+    :param pad: расширение боксов (px), обрезается по кадру
+    :return: список (x, y, w, h)
+    """
+    h, w = shape[:2]
+    boxes = []
+    for (bx, by, bw, bh) in bboxes_from_mask(flags.astype(np.uint8) * 255, min_area=1):
+        x0 = max(0, int(bx) * block - pad)
+        y0 = max(0, int(by) * block - pad)
+        x1 = min(w, int(bx + bw) * block + pad)
+        y1 = min(h, int(by + bh) * block + pad)
+        boxes.append((x0, y0, x1 - x0, y1 - y0))
+    return boxes
+
+
+def grid_runs(flags: np.ndarray, cell: int, shape: Tuple[int, ...], pad: int = 0) -> List[Box]:
+    """
+    Горизонтальные серии помеченных ячеек → боксы полного разрешения.
+    В отличие от flagged_boxes не объединяет ячейки в общий габарит,
+    поэтому непомеченная площадь внутри боксов не появляется.
+
+    :param flags: булева сетка ячеек
+    :param cell: сторона ячейки
+    :param shape: форма полного изображения
+    :param pad: расширение боксов (px), обрезается по кадру
+    :return: список (x, y, w, h)
+    """
+    h, w = shape[:2]
+    boxes = []
+    for gy in np.flatnonzero(flags.any(axis=1)):
+        row = np.concatenate(([False], flags[gy], [False])).astype(np.int8)
+        edges = np.flatnonzero(np.diff(row))
+        y0 = max(0, int(gy) * cell - pad)
+        y1 = min(h, (int(gy) + 1) * cell + pad)
+        for gx0, gx1 in zip(edges[::2], edges[1::2]):
+            x0 = max(0, int(gx0) * cell - pad)
+            x1 = min(w, int(gx1) * cell + pad)
+            boxes.append((x0, y0, x1 - x0, y1 - y0))
+    return boxes
@@ -0,0 +1,249 @@
+"""
+Изображения в разделяемой памяти для обмена между процессами без копий.
+
+Владелец (обычно главный процесс) держит SharedImagePool: выделяет сегменты,
+считает ссылки и переиспользует освободившиеся сегменты. Между процессами
+передаются только дескрипторы SharedImage (имя сегмента, форма, dtype) —
+пиксели не сериализуются; воркер получает ndarray поверх того же сегмента.
+"""
+import threading
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Верхняя граница памяти пула по умолчанию (1 ГиБ)
+DEFAULT_POOL_BYTES = 1 << 30
+# Гранула размера сегмента: близкие по размеру кадры попадают в один сегмент
+SEGMENT_GRANULE = 1 << 20
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Подключение к сегменту владельца (удаляет сегмент только владелец)."""
+    try:
+        # Python 3.13+: без регистрации в resource_tracker
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # До 3.13 дочерние процессы (spawn/fork) делят resource_tracker
+        # с владельцем, и повторная регистрация того же имени ничего не меняет
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedImage:
+    """
+    Дескриптор изображения в разделяемой памяти.
+
+    Сериализуется как (name, shape, dtype) — несколько десятков байт
+    вместо пикселей. array() в любом процессе возвращает ndarray поверх
+    сегмента (подключение происходит один раз на дескриптор).
+    """
+
+    __slots__ = ('name', 'shape', 'dtype', '_shm', '_attached')
+
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str = 'uint8',
+                 shm: Optional[shared_memory.SharedMemory] = None):
+        self.name = name
+        self.shape = tuple(int(v) for v in shape)
+        self.dtype = np.dtype(dtype).str
+        # Дескриптор владельца разделяет сегмент с пулом и не закрывает его сам
+        self._shm = shm
+        self._attached = False
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state
+        self._shm = None
+        self._attached = False
+
+    def __repr__(self) -> str:
+        return f"SharedImage({self.name!r}, {self.shape}, {np.dtype(self.dtype).name})"
+
+    @property
+    def nbytes(self) -> int:
+        """Размер изображения в байтах"""
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def array(self) -> np.ndarray:
+        """
+        Изображение как ndarray поверх разделяемой памяти (без копии).
+
+        :return: массив формы shape; действителен, пока владелец не освободил сегмент
+        """
+        if self._shm is None:
+            self._shm = _attach(self.name)
+            self._attached = True
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def close(self) -> None:
+        """Отключается от сегмента в этом процессе (сам сегмент не удаляется)."""
+        if self._attached:
+            try:
+                self._shm.close()
+            except BufferError:
+                # На сегмент ещё есть живые ndarray — закроется вместе с ними
+                return
+            self._shm = None
+            self._attached = False
+
+
+class SharedImagePool:
+    """
+    Пул сегментов разделяемой памяти со счётчиком ссылок.
+
+    acquire/put выдают дескриптор со счётчиком 1, retain/release его меняют;
+    при нуле сегмент возвращается в пул и отдаётся следующему кадру подходящего
+    размера. Свободные сегменты сверх max_bytes удаляются сразу; занятые
+    не ограничиваются (число задач в работе ограничивает вызывающий код).
+    Пул потокобезопасен; счётчики живут в процессе-владельце.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_POOL_BYTES, granule: int = SEGMENT_GRANULE):
+        """
+        :param max_bytes: предел памяти пула (занятые + свободные сегменты)
+        :param granule: гранула размера сегмента в байтах
+        """
+        self.max_bytes = int(max_bytes)
+        self.granule = max(1, int(granule))
+        self._lock = threading.Lock()
+        self._segments: Dict[str, shared_memory.SharedMemory] = {}
+        self._refs: Dict[str, int] = {}
+        self._free: List[str] = []
+        self._hits = 0
+        self._misses = 0
+
+    def __enter__(self) -> "SharedImagePool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def acquire(self, shape: Tuple[int, ...], dtype=np.uint8) -> SharedImage:
+        """
+        Сегмент под изображение заданной формы (содержимое не инициализировано).
+
+        :param shape: форма массива
+        :param dtype: тип элементов
+        :return: дескриптор со счётчиком ссылок 1
+        """
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        with self._lock:
+            shm = self._take_free(size)
+            if shm is None:
+                self._misses += 1
+                alloc = -(-size // self.granule) * self.granule
+                self._trim(self.max_bytes - alloc)
+                shm = shared_memory.SharedMemory(create=True, size=alloc)
+                self._segments[shm.name] = shm
+            else:
+                self._hits += 1
+            self._refs[shm.name] = 1
+        return SharedImage(shm.name, shape, np.dtype(dtype).str, shm=shm)
+
+    def put(self, array: np.ndarray) -> SharedImage:
+        """
+        Копирует массив в сегмент пула.
+
+        :param array: изображение
+        :return: дескриптор со счётчиком ссылок 1
+        """
+        handle = self.acquire(array.shape, array.dtype)
+        np.copyto(handle.array(), array)
+        return handle
+
+    def retain(self, handle: SharedImage) -> SharedImage:
+        """
+        Ещё одна ссылка на сегмент (например, для следующей стадии).
+
+        :param handle: дескриптор этого пула
+        :return: тот же дескриптор
+        """
+        with self._lock:
+            if self._refs.get(handle.name, 0) <= 0:
+                raise ValueError(f"Сегмент не выдан пулом: {handle.name}")
+            self._refs[handle.name] += 1
+        return handle
+
+    def release(self, handle: SharedImage) -> None:
+        """
+        Снимает ссылку; при нуле сегмент возвращается в пул.
+
+        :param handle: дескриптор этого пула
+        """
+        with self._lock:
+            refs = self._refs.get(handle.name, 0)
+            if refs <= 0:
+                raise ValueError(f"Сегмент не выдан пулом: {handle.name}")
+            if refs > 1:
+                self._refs[handle.name] = refs - 1
+                return
+            del self._refs[handle.name]
+            self._free.append(handle.name)
+            self._trim(self.max_bytes)
+
+    def occupancy(self) -> Dict[str, int]:
+        """
+        Заполненность пула.
+
+        :return: словарь: segments, in_use, free, bytes_in_use, bytes_free,
+                 bytes_total, max_bytes, hits (переиспользования), misses (выделения)
+        """
+        with self._lock:
+            in_use = sum(self._segments[name].size for name in self._refs)
+            free = sum(self._segments[name].size for name in self._free)
+            return {
+                'segments': len(self._segments),
+                'in_use': len(self._refs),
+                'free': len(self._free),
+                'bytes_in_use': in_use,
+                'bytes_free': free,
+                'bytes_total': in_use + free,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+    def close(self) -> None:
+        """Удаляет все сегменты пула (выданные дескрипторы становятся недействительны)."""
+        with self._lock:
+            for shm in self._segments.values():
+                _unlink(shm)
+            self._segments.clear()
+            self._refs.clear()
+            self._free.clear()
+
+    def _take_free(self, size: int) -> Optional[shared_memory.SharedMemory]:
+        """Наименьший свободный сегмент, вмещающий size, но не больше 2×size."""
+        best = None
+        for name in self._free:
+            seg = self._segments[name].size
+            if size <= seg <= 2 * size + self.granule and (best is None or seg < self._segments[best].size):
+                best = name
+        if best is None:
+            return None
+        self._free.remove(best)
+        return self._segments[best]
+
+    def _trim(self, limit: int) -> None:
+        """Удаляет свободные сегменты (крупные первыми), пока пул больше limit."""
+        total = sum(shm.size for shm in self._segments.values())
+        for name in sorted(self._free, key=lambda n: self._segments[n].size, reverse=True):
+            if total <= limit:
+                break
+            shm = self._segments.pop(name)
+            self._free.remove(name)
+            total -= shm.size
+            _unlink(shm)
+
+
+def _unlink(shm: shared_memory.SharedMemory) -> None:
+    """Закрывает и удаляет сегмент (живые ndarray владельца остаются валидны до их удаления)."""
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,197 @@
+"""
+SSIM / MS-SSIM на фильтрах OpenCV (float32, без scikit-image)
+"""
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from .pyramid import grid_runs, max_pool
+from .tiled import iter_tiles
+
+# Константы SSIM (Wang et al., 2004)
+K1 = 0.01
+K2 = 0.03
+
+# Веса масштабов MS-SSIM (Wang et al., 2003)
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+Box = Tuple[int, int, int, int]
+
+
+def _window_mean(img: np.ndarray, win: int, gaussian: bool, sigma: float) -> np.ndarray:
+    """Среднее по окну (раздельный фильтр, отражение на границе как в scipy)."""
+    if gaussian:
+        return cv2.GaussianBlur(img, (win, win), sigma, borderType=cv2.BORDER_REFLECT)
+    return cv2.boxFilter(img, cv2.CV_32F, (win, win), normalize=True, borderType=cv2.BORDER_REFLECT)
+
+
+def _ssim_terms(
+    x: np.ndarray,
+    y: np.ndarray,
+    win: int,
+    gaussian: bool,
+    sigma: float,
+    data_range: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Яркостный (l) и контрастно-структурный (cs) члены SSIM по окну."""
+    x = x.astype(np.float32)
+    y = y.astype(np.float32)
+    c1 = (K1 * data_range) ** 2
+    c2 = (K2 * data_range) ** 2
+
+    mu_x = _window_mean(x, win, gaussian, sigma)
+    mu_y = _window_mean(y, win, gaussian, sigma)
+    xx = _window_mean(x * x, win, gaussian, sigma)
+    yy = _window_mean(y * y, win, gaussian, sigma)
+    xy = _window_mean(x * y, win, gaussian, sigma)
+
+    mu_xx = mu_x * mu_x
+    mu_yy = mu_y * mu_y
+    mu_xy = mu_x * mu_y
+    # Несмещённая (выборочная) ковариация для равномерного окна — как в scikit-image
+    cov_norm = 1.0 if gaussian else win * win / (win * win - 1.0)
+    var_x = (xx - mu_xx) * cov_norm
+    var_y = (yy - mu_yy) * cov_norm
+    cov = (xy - mu_xy) * cov_norm
+
+    lum = (2 * mu_xy + c1) / (mu_xx + mu_yy + c1)
+    cs = (2 * cov + c2) / (var_x + var_y + c2)
+    return lum, cs
+
+
+def ssim_map(
+    x: np.ndarray,
+    y: np.ndarray,
+    win: int = 7,
+    gaussian: bool = False,
+    sigma: float = 1.5,
+    data_range: float = 255.0
+) -> np.ndarray:
+    """
+    Карта SSIM двух одноканальных изображений.
+
+    :param x: изображение A (HxW)
+    :param y: изображение B (HxW)
+    :param win: сторона окна (нечётная)
+    :param gaussian: гауссово окно вместо равномерного
+    :param sigma: sigma гауссова окна
+    :param data_range: диапазон значений (255 для uint8)
+    :return: карта SSIM float32 (1 — идентично)
+    """
+    lum, cs = _ssim_terms(x, y, win, gaussian, sigma, data_range)
+    return lum * cs
+
+
+def ssim_map_tiled(
+    x: np.ndarray,
+    y: np.ndarray,
+    win: int = 7,
+    gaussian: bool = False,
+    sigma: float = 1.5,
+    data_range: float = 255.0,
+    tile_size: int = 1024,
+    boxes: Optional[Sequence[Box]] = None
+) -> np.ndarray:
+    """
+    Карта SSIM по тайлам (или только в заданных боксах); вне боксов — 1.
+    Тайлы и боксы считаются с контекстом в пол-окна, поэтому значения
+    внутри совпадают с ssim_map на всём кадре (с точностью float32).
+
+    :param x: изображение A (HxW)
+    :param y: изображение B (HxW)
+    :param win: сторона окна
+    :param gaussian: гауссово окно
+    :param sigma: sigma гауссова окна
+    :param data_range: диапазон значений
+    :param tile_size: сторона тайла (если boxes не заданы)
+    :param boxes: список (x, y, w, h), где нужна карта
+    :return: карта SSIM float32
+    """
+    h, w = x.shape[:2]
+    halo = win // 2
+    out = np.ones((h, w), dtype=np.float32)
+    if boxes is None:
+        regions = iter_tiles(h, w, tile_size, halo)
+    else:
+        regions = (
+            ((bx, by, bw, bh), _expand((bx, by, bw, bh), halo, h, w)) for bx, by, bw, bh in boxes
+        )
+    for (bx, by, bw, bh), (ox, oy, ow, oh) in regions:
+        s = ssim_map(x[oy:oy+oh, ox:ox+ow], y[oy:oy+oh, ox:ox+ow], win, gaussian, sigma, data_range)
+        out[by:by+bh, bx:bx+bw] = s[by-oy:by-oy+bh, bx-ox:bx-ox+bw]
+    return out
+
+
+def ssim_candidate_boxes(
+    x: np.ndarray,
+    y: np.ndarray,
+    win: int = 7,
+    gaussian: bool = False,
+    sigma: float = 1.5,
+    block: int = 32
+) -> List[Box]:
+    """
+    Боксы, вне которых SSIM равен 1: окно, целиком лежащее
+    в совпадающих пикселях, даёт одинаковые моменты.
+
+    :param x: изображение A (HxW)
+    :param y: изображение B (HxW)
+    :param win: сторона окна
+    :param gaussian: гауссово окно
+    :param sigma: sigma гауссова окна
+    :param block: сторона блока грубого прохода
+    :return: список (x, y, w, h)
+    """
+    flags = max_pool(cv2.compare(x, y, cv2.CMP_NE), block) > 0
+    return grid_runs(flags, block, x.shape, pad=win // 2)
+
+
+def ms_ssim(
+    x: np.ndarray,
+    y: np.ndarray,
+    weights: Sequence[float] = MS_SSIM_WEIGHTS,
+    win: int = 11,
+    gaussian: bool = True,
+    sigma: float = 1.5,
+    data_range: float = 255.0
+) -> float:
+    """
+    Многомасштабный SSIM (скаляр): cs на каждом масштабе, яркость — на последнем.
+    Масштабы строятся cv2.pyrDown; число масштабов ограничено размером кадра.
+
+    :param x: изображение A (HxW)
+    :param y: изображение B (HxW)
+    :param weights: веса масштабов (от мелкого к крупному)
+    :param win: сторона окна
+    :param gaussian: гауссово окно
+    :param sigma: sigma гауссова окна
+    :param data_range: диапазон значений
+    :return: MS-SSIM в [0, 1] (отрицательные cs обрезаются нулём)
+    """
+    x = x.astype(np.float32)
+    y = y.astype(np.float32)
+    levels = len(weights)
+    while levels > 1 and min(x.shape[:2]) < win * (1 << (levels - 1)):
+        levels -= 1
+    weights = np.asarray(weights[:levels], dtype=np.float64)
+    weights /= weights.sum()
+
+    result = 1.0
+    for i in range(levels):
+        lum, cs = _ssim_terms(x, y, win, gaussian, sigma, data_range)
+        if i == levels - 1:
+            result *= max(float(np.mean(lum * cs)), 0.0) ** weights[i]
+        else:
+            result *= max(float(np.mean(cs)), 0.0) ** weights[i]
+            x = cv2.pyrDown(x)
+            y = cv2.pyrDown(y)
+    return float(result)
+
+
+def _expand(box: Box, pad: int, h: int, w: int) -> Box:
+    """Расширяет бокс на pad с обрезкой по кадру."""
+    x, y, bw, bh = box
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(w, x + bw + pad), min(h, y + bh + pad)
+    return x0, y0, x1 - x0, y1 - y0
@@ -0,0 +1,117 @@
+"""
+Пороги по 256-бинным гистограммам: глобальный перцентиль и потайловый адаптивный
+"""
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# Сторона тайла для локальных порогов по умолчанию (px)
+THRESHOLD_TILE = 256
+
+
+def gray_histogram(gray: np.ndarray) -> np.ndarray:
+    """
+    Гистограмма uint8 изображения за один проход.
+
+    :param gray: одноканальное uint8 изображение
+    :return: 256 счётчиков int64
+    """
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256])
+    return hist.ravel().astype(np.int64)
+
+
+def hist_percentile(
+    gray: Optional[np.ndarray],
+    percent: float,
+    hist: Optional[np.ndarray] = None
+) -> float:
+    """
+    Перцентиль uint8 изображения по гистограмме.
+    Совпадает с np.percentile (метод linear), но без сортировки/копии кадра.
+
+    :param gray: одноканальное uint8 изображение (не нужно, если передан hist)
+    :param percent: перцентиль 0..100
+    :param hist: готовая гистограмма (gray_histogram)
+    :return: значение перцентиля
+    """
+    if hist is None:
+        hist = gray_histogram(gray)
+    cdf = np.cumsum(hist)
+    n = int(cdf[-1])
+    if n == 0:
+        raise ValueError("Пустое изображение")
+    # Та же арифметика, что у np.percentile: индекс (n - 1)·q и «lerp» с двух сторон
+    pos = (n - 1) * (float(percent) / 100.0)
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, n - 1)
+    t = pos - lo
+    # k-я порядковая статистика — первое значение, у которого cdf > k
+    a = float(np.searchsorted(cdf, lo, side='right'))
+    b = float(np.searchsorted(cdf, hi, side='right'))
+    d = b - a
+    if t >= 0.5:
+        return b - d * (1 - t)
+    return a + d * t
+
+
+def tile_thresholds(gray: np.ndarray, percent: float, tile: int = THRESHOLD_TILE) -> np.ndarray:
+    """
+    Перцентиль в каждом тайле tile×tile (по гистограмме тайла).
+
+    :param gray: одноканальное uint8 изображение
+    :param percent: перцентиль 0..100
+    :param tile: сторона тайла
+    :return: сетка порогов float32 ceil(h/tile) × ceil(w/tile)
+    """
+    h, w = gray.shape[:2]
+    ys = range(0, h, tile)
+    xs = range(0, w, tile)
+    grid = np.empty((len(ys), len(xs)), dtype=np.float32)
+    for i, y in enumerate(ys):
+        for j, x in enumerate(xs):
+            grid[i, j] = hist_percentile(gray[y:y+tile, x:x+tile], percent)
+    return grid
+
+
+def percentile_mask(
+    gray: np.ndarray,
+    percent: float,
+    tile: int = 0
+) -> np.ndarray:
+    """
+    Бинарная маска gray > порога.
+
+    При tile = 0 порог один на кадр (как np.percentile + cv2.threshold).
+    При tile > 0 пороги считаются по тайлам и билинейно интерполируются
+    между центрами тайлов, так что на стыках нет ступенек.
+
+    :param gray: одноканальное uint8 изображение
+    :param percent: перцентиль 0..100
+    :param tile: сторона тайла локальных порогов (0 — глобальный порог)
+    :return: маска 0/255
+    """
+    if tile <= 0:
+        _, mask = cv2.threshold(gray, hist_percentile(gray, percent), 255, cv2.THRESH_BINARY)
+        return mask
+    h, w = gray.shape[:2]
+    grid = tile_thresholds(gray, percent, tile)
+    gh, gw = grid.shape
+    # Координаты пикселей в сетке центров тайлов (по краям — продление)
+    gx = np.clip((np.arange(w) + 0.5) / tile - 0.5, 0, gw - 1)
+    x0 = np.floor(gx).astype(np.intp)
+    x1 = np.minimum(x0 + 1, gw - 1)
+    fx = (gx - x0).astype(np.float32)
+    rows = grid[:, x0] * (1 - fx) + grid[:, x1] * fx
+    
+    # Интерполяция по y полосами: карта порогов не строится на весь кадр
+    mask = np.empty((h, w), dtype=np.uint8)
+    for y in range(0, h, tile):
+        th = min(tile, h - y)
+        gy = np.clip((np.arange(y, y + th) + 0.5) / tile - 0.5, 0, gh - 1)
+        y0 = np.floor(gy).astype(np.intp)
+        y1 = np.minimum(y0 + 1, gh - 1)
+        fy = (gy - y0).astype(np.float32)[:, None]
+        thr = rows[y0] * (1 - fy) + rows[y1] * fy
+        cv2.compare(gray[y:y+th].astype(np.float32), thr, cv2.CMP_GT, dst=mask[y:y+th])
+    return mask
@@ -0,0 +1,191 @@
+"""
+Кэш миниатюр для превью (без Qt).
+
+Миниатюра ищется в памяти (LRU), затем на диске, и только потом
+декодируется из исходника — сразу в уменьшенном разрешении
+(io.imread_reduced). Ключ — путь, размер и mtime файла и сторона
+миниатюры, поэтому изменённый файл получает новую миниатюру.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+from .encoder import atomic_write, encode_image
+from .io import imread_reduced, safe_imread
+
+# Сторона миниатюры по умолчанию (превью таблицы файлов)
+THUMB_SIDE = 400
+# Миниатюр в памяти
+THUMB_MEMORY_ITEMS = 256
+# Предел дискового кэша миниатюр (256 МиБ)
+THUMB_DISK_BYTES = 256 << 20
+# Проверка размера дискового кэша — раз в столько записей
+_TRIM_EVERY = 64
+
+
+class ThumbnailCache:
+    """
+    Миниатюры изображений: LRU в памяти + каталог на диске.
+
+    Потокобезопасен: load можно вызывать из фоновых потоков.
+    """
+
+    def __init__(
+        self,
+        max_side: int = THUMB_SIDE,
+        max_items: int = THUMB_MEMORY_ITEMS,
+        cache_dir=None,
+        max_disk_bytes: int = THUMB_DISK_BYTES
+    ):
+        """
+        :param max_side: большая сторона миниатюры
+        :param max_items: миниатюр в памяти
+        :param cache_dir: каталог дискового кэша (None — только память)
+        :param max_disk_bytes: предел размера каталога (старые файлы удаляются)
+        """
+        self.max_side = int(max_side)
+        self.max_items = max(1, int(max_items))
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_disk_bytes = int(max_disk_bytes)
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._writes = 0
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def key(self, path) -> Optional[str]:
+        """
+        Ключ миниатюры.
+
+        :param path: путь к изображению
+        :return: hex-ключ по (путь, размер, mtime, сторона) или None, если файла нет
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        raw = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{self.max_side}"
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, path, disk: bool = True) -> Optional[np.ndarray]:
+        """
+        Готовая миниатюра без декодирования исходника.
+
+        :param path: путь к изображению
+        :param disk: искать и в дисковом кэше (иначе только память)
+        :return: BGR миниатюра или None
+        """
+        key = self.key(path)
+        return self._lookup(key, disk) if key else None
+
+    def load(self, path) -> Optional[np.ndarray]:
+        """
+        Миниатюра из кэша или из исходника (с сохранением в кэш).
+
+        :param path: путь к изображению
+        :return: BGR миниатюра (большая сторона не больше max_side) или None
+        """
+        key = self.key(path)
+        if key is None:
+            return None
+        thumb = self._lookup(key, True)
+        if thumb is not None:
+            return thumb
+        img = imread_reduced(path, self.max_side)
+        if img is None:
+            return None
+        thumb = _fit(img, self.max_side)
+        with self._lock:
+            self._stats['misses'] += 1
+            self._remember(key, thumb)
+        self._store(key, thumb)
+        return thumb
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Счётчики кэша.
+
+        :return: словарь: memory_hits, disk_hits, misses, memory_items
+        """
+        with self._lock:
+            return dict(self._stats, memory_items=len(self._memory))
+
+    def clear(self) -> None:
+        """Очищает память (дисковый кэш не трогается)."""
+        with self._lock:
+            self._memory.clear()
+
+    def _lookup(self, key: str, disk: bool) -> Optional[np.ndarray]:
+        with self._lock:
+            thumb = self._memory.get(key)
+            if thumb is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return thumb
+        if not disk or self.cache_dir is None:
+            return None
+        thumb = safe_imread(str(self.cache_dir / f"{key}.png"))
+        if thumb is None:
+            return None
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._remember(key, thumb)
+        return thumb
+
+    def _remember(self, key: str, thumb: np.ndarray) -> None:
+        """Кладёт миниатюру в LRU (вызывается под блокировкой)."""
+        self._memory[key] = thumb
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _store(self, key: str, thumb: np.ndarray) -> None:
+        if self.cache_dir is None:
+            return
+        try:
+            # Миниатюру можно пересоздать — fsync не нужен
+            atomic_write(self.cache_dir / f"{key}.png",
+                         encode_image(thumb, '.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]), durable=False)
+        except OSError:
+            return
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % _TRIM_EVERY == 0
+        if trim:
+            self.trim_disk()
+
+    def trim_disk(self) -> None:
+        """Удаляет самые старые миниатюры, пока каталог больше max_disk_bytes."""
+        if self.cache_dir is None or not self.cache_dir.is_dir():
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.png'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def _fit(img: np.ndarray, max_side: int) -> np.ndarray:
+    """Уменьшает изображение до max_side по большой стороне (INTER_AREA)."""
+    h, w = img.shape[:2]
+    if max(h, w) <= max_side:
+        return img
+    scale = max_side / float(max(h, w))
+    return cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,125 @@
+"""
+Потайловая (streaming) обработка больших изображений
+"""
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+from .colors import bgr_simple_diff, bgr_to_lab_diff
+from .morph import denoise_mask
+from .workspace import DiffWorkspace, scratch
+
+# Размер тайла по умолчанию (сторона, px)
+TILE_SIZE = 1024
+
+# Радиус влияния шумоподавления diff_mask_fast:
+# medianBlur 3×3 (1 px) + MORPH_OPEN 3×3 (erode 1 px + dilate 1 px)
+NOISE_HALO = 3
+
+Box = Tuple[int, int, int, int]
+
+
+def iter_tiles(
+    height: int,
+    width: int,
+    tile_size: int = TILE_SIZE,
+    halo: int = 0
+) -> Iterator[Tuple[Box, Box]]:
+    """
+    Обходит кадр тайлами построчно (row-major).
+
+    :param height: высота кадра
+    :param width: ширина кадра
+    :param tile_size: сторона тайла
+    :param halo: перекрытие тайлов (обрезается по границе кадра)
+    :return: итератор пар (inner, outer) боксов (x, y, w, h):
+             inner — область, за которую отвечает тайл,
+             outer — inner, расширенный на halo
+    """
+    if tile_size <= 0:
+        raise ValueError("tile_size должен быть > 0")
+    for y in range(0, height, tile_size):
+        h = min(tile_size, height - y)
+        y0 = max(0, y - halo)
+        y1 = min(height, y + h + halo)
+        for x in range(0, width, tile_size):
+            w = min(tile_size, width - x)
+            x0 = max(0, x - halo)
+            x1 = min(width, x + w + halo)
+            yield (x, y, w, h), (x0, y0, x1 - x0, y1 - y0)
+
+
+def diff_mask_tiled(
+    a: np.ndarray,
+    b: np.ndarray,
+    fuzz: int = 10,
+    use_lab: bool = True,
+    noise_filter: bool = True,
+    tile_size: int = TILE_SIZE,
+    out: Optional[np.ndarray] = None,
+    workspace: Optional[DiffWorkspace] = None,
+    out_add: Optional[np.ndarray] = None,
+    out_del: Optional[np.ndarray] = None,
+    bits: Optional[Tuple[int, int, int]] = None
+) -> np.ndarray:
+    """
+    Потайловый аналог diff_mask_fast: тот же результат бит-в-бит,
+    но пиковая память временных буферов ограничена размером тайла.
+
+    Тайлы перекрываются на NOISE_HALO px, поэтому медиана и MORPH_OPEN
+    на стыках считаются так же, как на целом кадре.
+
+    :param a: BGR изображение A
+    :param b: BGR изображение B
+    :param fuzz: порог различия (Lab: 5-12, BGR: 10-30)
+    :param use_lab: использовать перцептуальное Lab пространство
+    :param noise_filter: применять фильтрацию шума
+    :param tile_size: сторона тайла
+    :param out: готовый буфер маски HxW uint8 (например, np.memmap)
+    :param workspace: буферы тайла; при повторном использовании
+                      обработка тайлов не выделяет память
+    :param out_add: буфер HxW для маски «появилось» (только Lab, вместе с out_del)
+    :param out_del: буфер HxW для маски «исчезло»
+    :param bits: биты (общая, add, del) — out становится меткой: три маски
+                 пишутся в один буфер HxW (только Lab)
+    :return: бинарная маска различий 0/255 или метка при bits
+    """
+    # Импорт здесь: diff импортирует tiled
+    from .diff import diff_masks_split
+
+    h, w = a.shape[:2]
+    if out is None:
+        out = np.zeros((h, w), dtype=np.uint8)
+    split = bits is not None or (out_add is not None and out_del is not None)
+    if split and not use_lab:
+        raise ValueError("Маски add/del поддерживаются только для Lab")
+    halo = NOISE_HALO if noise_filter else 0
+
+    for (x, y, tw, th), (ox, oy, ow, oh) in iter_tiles(h, w, tile_size, halo):
+        ta = a[oy:oy+oh, ox:ox+ow]
+        tb = b[oy:oy+oh, ox:ox+ow]
+        if split:
+            # Общая маска и add/del за одну конверсию тайла в Lab
+            masks = diff_masks_split(ta, tb, fuzz=fuzz, noise_filter=noise_filter, workspace=workspace)
+            crops = [m[y-oy:y-oy+th, x-ox:x-ox+tw] for m in masks]
+            if bits is not None:
+                # Маски 0/255: AND с битом даёт 0/бит
+                dst = out[y:y+th, x:x+tw]
+                np.bitwise_and(crops[0], np.uint8(bits[0]), out=dst)
+                for bit, m in zip(bits[1:], crops[1:]):
+                    dst |= m & np.uint8(bit)
+                continue
+            for dst, m in zip((out, out_add, out_del), crops):
+                dst[y:y+th, x:x+tw] = m
+            continue
+        tile = scratch(workspace, "mask_tile", (oh, ow))
+        raw = scratch(workspace, "mask_raw", (oh, ow)) if noise_filter else tile
+        if use_lab:
+            m = bgr_to_lab_diff(ta, tb, fuzz=fuzz, workspace=workspace, dst=raw)
+        else:
+            m = bgr_simple_diff(ta, tb, fuzz=fuzz, workspace=workspace, dst=raw)
+        if noise_filter:
+            m = denoise_mask(m, workspace=workspace, dst=tile)
+        out[y:y+th, x:x+tw] = m[y-oy:y-oy+th, x-ox:x-ox+tw]
+
+    return out
@@ -0,0 +1,107 @@
+"""
+Переиспользуемые буферы для ядра сравнения (без аллокаций на каждый вызов)
+"""
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# Лимит кэшируемых буферов на один workspace; более крупные запросы
+# обслуживаются временными массивами, чтобы поток не держал гигабайты.
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class DiffWorkspace:
+    """
+    Набор растущих scratch-буферов, которые функции imgdiff.core передают
+    в OpenCV как dst=. Буфер с данным именем выделяется один раз под
+    наибольший запрошенный размер и далее переиспользуется.
+
+    Не потокобезопасен: один workspace — один поток (см. thread_workspace).
+    Возвращаемые функциями маски никогда не лежат в буферах workspace.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._buffers: Dict[Tuple[str, str], np.ndarray] = {}
+
+    def buffer(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """
+        Непрерывный массив формы shape из буфера name.
+        Содержимое не инициализируется.
+
+        :param name: имя буфера (разные имена не пересекаются)
+        :param shape: форма результата
+        :param dtype: тип элементов
+        :return: view на буфер
+        """
+        dt = np.dtype(dtype)
+        size = int(np.prod(shape))
+        key = (name, dt.str)
+        buf = self._buffers.get(key)
+        if buf is None or buf.size < size:
+            if (size * dt.itemsize) + self.nbytes - (buf.nbytes if buf is not None else 0) > self.max_bytes:
+                return np.empty(shape, dtype=dt)
+            buf = np.empty(size, dtype=dt)
+            self._buffers[key] = buf
+        return buf[:size].reshape(shape)
+
+    def reserve(self, shape: Tuple[int, ...]):
+        """
+        Заранее выделяет буферы ядра под изображение/тайл формы (h, w, 3).
+
+        :param shape: форма наибольшего ожидаемого входа
+        """
+        h, w = shape[:2]
+        for name in ("lab_a", "lab_b", "absdiff"):
+            self.buffer(name, (h, w, 3))
+        self.buffer("sq", (h, w, 3), np.float32)
+        self.buffer("sum", (h, w), np.float32)
+        for name in ("mask_raw", "mask_median", "mask_tile"):
+            self.buffer(name, (h, w))
+
+    @property
+    def nbytes(self) -> int:
+        """Суммарный размер удерживаемых буферов (байт)"""
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def clear(self):
+        """Освобождает все буферы"""
+        self._buffers.clear()
+
+
+def scratch(
+    workspace: Optional[DiffWorkspace],
+    name: str,
+    shape: Tuple[int, ...],
+    dtype=np.uint8
+) -> Optional[np.ndarray]:
+    """
+    Буфер для dst= OpenCV или None (OpenCV выделит память сам).
+
+    :param workspace: DiffWorkspace или None
+    :param name: имя буфера
+    :param shape: форма
+    :param dtype: тип элементов
+    :return: view на буфер workspace либо None
+    """
+    if workspace is None:
+        return None
+    return workspace.buffer(name, shape, dtype)
+
+
+_local = threading.local()
+
+
+def thread_workspace(max_bytes: Optional[int] = None) -> DiffWorkspace:
+    """
+    Workspace текущего потока (создаётся при первом обращении).
+
+    :param max_bytes: лимит буферов для нового workspace
+    :return: DiffWorkspace, принадлежащий вызывающему потоку
+    """
+    ws = getattr(_local, "workspace", None)
+    if ws is None:
+        ws = DiffWorkspace(max_bytes if max_bytes is not None else DEFAULT_MAX_BYTES)
+        _local.workspace = ws
+    return ws
@@ -6,9 +6,37 @@ import numpy as np
 import cv2
 
 from imgdiff.core.colors import bgr_to_lab_diff, bgr_simple_diff
-from imgdiff.core.diff import diff_mask_fast, coarse_to_fine
-from imgdiff.core.morph import bboxes_from_mask, filter_small_components, dilate_mask
+from imgdiff.core.diff import (
+    diff_mask_fast, coarse_to_fine, rois_to_mask, hierarchical_diff, diff_masks_split, ssim_mask
+)
+from imgdiff.core.morph import bboxes_from_mask, filter_small_components, dilate_mask, merge_boxes
 from imgdiff.core.overlay import draw_diff_overlay, create_heatmap
+from imgdiff.core.tiled import iter_tiles, diff_mask_tiled
+from imgdiff.core.blockhash import BlockHashIndex, diff_mask_blocks
+from imgdiff.core.pyramid import diff_strength, strength_threshold, max_pool, block_counts
+from imgdiff.core.workspace import DiffWorkspace, thread_workspace
+from imgdiff.core.equality import StageTimer, files_identical, pixels_identical
+from imgdiff.core.check import check_images
+from imgdiff.core import io as imgio
+from imgdiff.core.io import (
+    FingerprintIndex, MaskCache, ResultCache, compute_file_digest, compute_file_hash, compute_settings_hash,
+    file_view, image_header_size, imread_reduced, reduction_factor, safe_imread
+)
+from imgdiff.core.components import Components, fill_holes, filter_components
+from imgdiff.core.threshold import hist_percentile, percentile_mask
+from imgdiff.core.ssim import ssim_map, ssim_map_tiled, ssim_candidate_boxes, ms_ssim
+from imgdiff.core import backends
+from imgdiff.core.backends import NUMBA_AVAILABLE, get_backend
+from imgdiff.core.pipeline import job_params, shutdown_executor, worker_init
+from imgdiff.core.shm import SharedImagePool
+from imgdiff.core.encoder import EncoderPool, encode_image
+from imgdiff.core.thumbs import ThumbnailCache
+from imgdiff.core.batch import BatchJob, BatchPipeline, CacheProbe, in_order
+from imgdiff.core.pipeline import OutlineComparator, outline_masks, outline_overlay, unpack_masks
+from imgdiff.cli import (
+    ContourComparator, batch_executor, batch_jobs, check_pair, compare_images_core, format_check,
+    format_regions, region_report, split_cached_jobs, stop_executor,
+)
 
 
 @pytest.fixture
@@ -93,6 +121,491 @@ def test_coarse_to_fine(test_images):
         assert all(isinstance(v, int) for v in box)
 
 
+def test_coarse_to_fine_return_masks(test_images):
+    """Тест режима с готовыми масками ROI"""
+    img_a, img_b = test_images
+    rois = coarse_to_fine(img_a, img_b, fuzz=10, scale=0.5, return_masks=True)
+    
+    assert len(rois) >= 1
+    for (x, y, w, h), m in rois:
+        assert m.shape == (h, w)
+        assert np.array_equal(m, diff_mask_fast(img_a[y:y+h, x:x+w], img_b[y:y+h, x:x+w], fuzz=10))
+    
+    mask = rois_to_mask(img_a.shape, rois)
+    assert mask.shape == img_a.shape[:2]
+    assert cv2.countNonZero(mask) > 0
+
+
+def test_coarse_to_fine_maxpool_keeps_thin_lines():
+    """Тест что max-pooling грубый проход не теряет тонкие линии"""
+    img_a = np.full((400, 400, 3), 255, dtype=np.uint8)
+    img_b = img_a.copy()
+    img_b[100:103, 50:350] = 100  # линия 3 px (INTER_AREA-даунскейл «усреднял» её ниже порога)
+    
+    rois = coarse_to_fine(img_a, img_b, fuzz=10, scale=0.15, return_masks=True)
+    assert np.array_equal(rois_to_mask(img_a.shape, rois), diff_mask_fast(img_a, img_b, fuzz=10))
+    assert coarse_to_fine(img_a, img_b, fuzz=10, scale=0.15) == [box for box, _ in rois]
+    
+    # CLI по умолчанию (use_coarse) видит ту же линию, что и прямое сравнение
+    mask = compare_images_core(img_a, img_b, fuzz=10)
+    assert cv2.countNonZero(mask) > 0
+    assert np.array_equal(mask, compare_images_core(img_a, img_b, fuzz=10, use_coarse=False))
+
+
+def test_hierarchical_diff_matches_full():
+    """Тест иерархического уточнения: маска как у полного кадра + статистика уровней"""
+    img_a = np.full((300, 260, 3), 255, dtype=np.uint8)
+    img_b = img_a.copy()
+    img_b[20:23, 10:200] = 0
+    img_b[200:260, 150:240] = (0, 0, 255)
+    
+    rois, stats = hierarchical_diff(img_a, img_b, fuzz=10, levels=3, leaf=8)
+    
+    assert np.array_equal(rois_to_mask(img_a.shape, rois), diff_mask_fast(img_a, img_b, fuzz=10))
+    assert [st['level'] for st in stats] == [2, 1, 0]
+    assert stats[0]['pruned_fraction'] > 0.0
+    assert all(st['flagged'] <= st['examined'] for st in stats)
+
+
+def test_hierarchical_diff_identical(identical_images):
+    """Тест что на одинаковых изображениях спуск останавливается на верхнем уровне"""
+    img_a, img_b = identical_images
+    rois, stats = hierarchical_diff(img_a, img_b, fuzz=10, levels=4, leaf=8)
+    
+    assert rois == []
+    assert len(stats) == 1
+    assert stats[0]['pruned_fraction'] == pytest.approx(1.0)
+
+
+def test_diff_strength_bounds_lab_delta():
+    """Тест что diff_strength — верхняя оценка ΔE в Lab"""
+    rng = np.random.default_rng(1)
+    img_a = rng.integers(0, 256, (200, 200, 3), dtype=np.uint8)
+    img_b = np.clip(img_a.astype(np.int16) + rng.integers(-6, 7, img_a.shape), 0, 255).astype(np.uint8)
+    
+    lab_a = cv2.cvtColor(img_a, cv2.COLOR_BGR2LAB).astype(np.float32)
+    lab_b = cv2.cvtColor(img_b, cv2.COLOR_BGR2LAB).astype(np.float32)
+    delta = np.sqrt(((lab_a - lab_b) ** 2).sum(axis=-1))
+    strength = diff_strength(img_a, img_b)
+    for fuzz in (1, 3, 5, 10):
+        assert not ((delta >= fuzz) & (strength < strength_threshold(fuzz))).any()
+
+
+def test_max_pool_and_block_counts():
+    """Тест max-pooling и счётчиков по блокам"""
+    m = np.zeros((37, 53), dtype=np.uint8)
+    m[0, 0] = 7
+    m[36, 52] = 9
+    m[20:24, 20:24] = 255
+    
+    pooled = max_pool(m, 8)
+    assert pooled.shape == (5, 7)
+    assert pooled[0, 0] == 7 and pooled[-1, -1] == 9 and pooled[2, 2] == 255
+    
+    counts = block_counts(m, 8)
+    assert counts.shape == (5, 7)
+    assert counts.sum() == cv2.countNonZero(m)
+    assert counts[2, 2] == 16
+
+
+def test_merge_boxes():
+    """Тест слияния пересекающихся и соседних боксов"""
+    boxes = [(0, 0, 10, 10), (5, 5, 10, 10), (15, 0, 5, 5), (50, 50, 5, 5)]
+    merged = merge_boxes(boxes)
+    
+    assert sorted(merged) == [(0, 0, 20, 15), (50, 50, 5, 5)]
+    assert merge_boxes([]) == []
+
+
+def test_diff_masks_split(test_images):
+    """Тест совмещённого ядра: общая маска + «появилось»/«исчезло»"""
+    img_a, img_b = test_images
+    total, add, dele = diff_masks_split(img_a, img_b, fuzz=10)
+    
+    assert np.array_equal(total, diff_mask_fast(img_a, img_b, fuzz=10))
+    # Обе части лежат внутри общей маски и вместе её покрывают
+    assert not np.any((add | dele) & ~total)
+    assert cv2.countNonZero(add | dele) == cv2.countNonZero(total)
+    
+    # ROI с split и потайловый проход дают те же маски
+    rois, _ = hierarchical_diff(img_a, img_b, fuzz=10, split=True)
+    assert np.array_equal(rois_to_mask(img_a.shape, rois), total)
+    out_add = np.zeros_like(total)
+    out_del = np.zeros_like(total)
+    diff_mask_tiled(img_a, img_b, fuzz=10, tile_size=32, out_add=out_add, out_del=out_del)
+    assert np.array_equal(out_add, add) and np.array_equal(out_del, dele)
+    # Одна метка вместо трёх масок
+    label = diff_mask_tiled(img_a, img_b, fuzz=10, tile_size=32, bits=(1, 2, 4))
+    assert np.array_equal(label, (total & 1) | (add & 2) | (dele & 4))
+
+
+def test_tiled_path_filters_in_strips():
+    """Тест что потайловый путь (фильтр и расширение полосами) совпадает с полнокадровым"""
+    rng = np.random.default_rng(1)
+    img_a = rng.integers(0, 256, (150, 170, 3), dtype=np.uint8)
+    img_b = img_a.copy()
+    img_b[20:60, 30:90] = 255
+    cv2.rectangle(img_b, (100, 70), (160, 140), (0, 255, 0), 2)
+    noise = rng.random((150, 170)) < 0.02
+    img_b[noise] = rng.integers(0, 256, (int(noise.sum()), 3), dtype=np.uint8)
+    
+    full = compare_images_core(img_a, img_b, fuzz=10, use_coarse=False, min_area=20, thickness=3)
+    tiled = compare_images_core(img_a, img_b, fuzz=10, min_area=20, thickness=3, tile_size=37)
+    assert cv2.countNonZero(full) > 0
+    assert np.array_equal(full, tiled)
+    
+    mask = diff_mask_fast(img_a, img_b, fuzz=10)
+    expected = dilate_mask(mask, thickness=3)
+    for strip in (1, 2, 16):
+        inplace = mask.copy()
+        dilate_mask(inplace, thickness=3, strip=strip, dst=inplace)
+        assert np.array_equal(inplace, expected)
+    
+    # outline_masks: общая маска, add и del — биты одной метки
+    total, add, dele = diff_masks_split(img_a, img_b, fuzz=10)
+    total = filter_small_components(total, min_area=20)
+    label = outline_masks(img_a, img_b, 10, 20, 37)
+    assert np.array_equal(label, (total & 1) | (add & 2) | (dele & 4))
+
+def test_iter_tiles_covers_frame():
+    """Тест что тайлы покрывают кадр ровно один раз"""
+    cover = np.zeros((70, 130), dtype=np.int32)
+    for (x, y, w, h), (ox, oy, ow, oh) in iter_tiles(70, 130, tile_size=32, halo=3):
+        cover[y:y+h, x:x+w] += 1
+        assert ox <= x and oy <= y
+        assert ox + ow >= x + w and oy + oh >= y + h
+    assert (cover == 1).all()
+
+
+def test_diff_mask_tiled_matches_full():
+    """Тест что потайловая маска совпадает с полнокадровой бит-в-бит"""
+    rng = np.random.default_rng(0)
+    img_a = rng.integers(0, 256, (150, 170, 3), dtype=np.uint8)
+    img_b = img_a.copy()
+    noise = rng.random((150, 170)) < 0.3
+    img_b[noise] = rng.integers(0, 256, (int(noise.sum()), 3), dtype=np.uint8)
+    
+    for use_lab in (True, False):
+        full = diff_mask_fast(img_a, img_b, fuzz=10, use_lab=use_lab)
+        tiled = diff_mask_tiled(img_a, img_b, fuzz=10, use_lab=use_lab, tile_size=37)
+        assert np.array_equal(full, tiled)
+
+
+def test_block_hash_index_changed():
+    """Тест индекса хэшей блоков"""
+    img_a = np.full((100, 150, 3), 200, dtype=np.uint8)
+    img_b = img_a.copy()
+    img_b[70, 140] = (0, 0, 0)  # неполный крайний блок
+    
+    index_a = BlockHashIndex.from_image(img_a, block=32)
+    index_b = BlockHashIndex.from_image(img_b, block=32)
+    changed = index_a.changed(index_b)
+    
+    assert changed.shape == (4, 5)
+    assert changed.sum() == 1 and changed[2, 4]
+    assert index_a.changed_boxes(index_b) == [(128, 64, 22, 32)]
+    
+    with pytest.raises(ValueError):
+        index_a.changed(BlockHashIndex.from_image(img_a[:50], block=32))
+
+
+def test_diff_mask_blocks_matches_full(test_images):
+    """Тест что маска по изменённым блокам совпадает с полнокадровой"""
+    img_a, img_b = test_images
+    index_a = BlockHashIndex.from_image(img_a, block=16)
+    
+    mask = diff_mask_blocks(img_a, img_b, fuzz=10, index_a=index_a)
+    assert np.array_equal(mask, diff_mask_fast(img_a, img_b, fuzz=10))
+
+
+def test_workspace_buffer_reuse():
+    """Тест что буферы workspace переиспользуются и ограничены лимитом"""
+    ws = DiffWorkspace(max_bytes=1000)
+    buf = ws.buffer("x", (10, 20))
+    small = ws.buffer("x", (5, 5))
+    assert small.shape == (5, 5)
+    assert np.shares_memory(buf, small)
+    assert ws.nbytes == 200
+    
+    # Больше лимита — временный массив, кэш не растёт
+    big = ws.buffer("y", (40, 40))
+    assert big.shape == (40, 40)
+    assert ws.nbytes == 200
+    
+    ws.clear()
+    assert ws.nbytes == 0
+    assert thread_workspace() is thread_workspace()
+
+
+def test_workspace_same_result():
+    """Тест что ядро с workspace даёт тот же результат и не отдаёт свои буферы"""
+    rng = np.random.default_rng(1)
+    img_a = rng.integers(0, 256, (120, 90, 3), dtype=np.uint8)
+    img_b = img_a.copy()
+    noise = rng.random((120, 90)) < 0.05
+    img_b[noise] = rng.integers(0, 256, (int(noise.sum()), 3), dtype=np.uint8)
+    ws = DiffWorkspace()
+    
+    for use_lab in (True, False):
+        full = diff_mask_fast(img_a, img_b, fuzz=10, use_lab=use_lab)
+        first = diff_mask_fast(img_a, img_b, fuzz=10, use_lab=use_lab, workspace=ws)
+        diff_mask_fast(img_b, img_a[::-1].copy(), fuzz=10, use_lab=use_lab, workspace=ws)
+        assert np.array_equal(first, full)
+        
+        tiled = diff_mask_tiled(img_a, img_b, fuzz=10, use_lab=use_lab, tile_size=37, workspace=ws)
+        assert np.array_equal(tiled, full)
+        rois, _ = hierarchical_diff(img_a, img_b, fuzz=10, use_lab=use_lab, workspace=ws)
+        assert np.array_equal(rois_to_mask(img_a.shape, rois), full)
+
+
+def test_files_identical(tmp_path):
+    """Тест побайтного сравнения файлов"""
+    a = tmp_path / "a.bin"
+    b = tmp_path / "b.bin"
+    c = tmp_path / "c.bin"
+    a.write_bytes(b"x" * 5000)
+    b.write_bytes(b"x" * 5000)
+    c.write_bytes(b"x" * 4999 + b"y")
+    
+    assert files_identical(str(a), str(b), chunk_size=1024)
+    assert not files_identical(str(a), str(c), chunk_size=1024)
+    assert not files_identical(str(a), str(tmp_path / "a.bin"), hash_a="1", hash_b="2")
+    
+    c.write_bytes(b"x" * 10)
+    assert not files_identical(str(a), str(c))
+
+
+def test_pixels_identical(test_images, identical_images):
+    """Тест полосового сравнения пикселей"""
+    assert pixels_identical(*identical_images, rows=7)
+    assert not pixels_identical(*test_images, rows=7)
+    img_a, _ = identical_images
+    assert not pixels_identical(img_a, img_a[:50])
+    
+    timer = StageTimer()
+    with timer.stage("pixels"):
+        pass
+    with timer.stage("pixels"):
+        pass
+    assert list(timer.timings) == ["pixels"]
+
+
+def test_check_images(test_images, identical_images):
+    """Тест режима проверки с ранним выходом"""
+    img_a, img_b = test_images
+    full = cv2.countNonZero(diff_mask_fast(img_a, img_b, fuzz=10))
+    
+    result = check_images(img_a, img_b, fuzz=10, max_diff_percent=100, tile_size=32)
+    assert result['exact'] and not result['different']
+    assert result['diff_pixels'] == full
+    assert result['tiles_skipped'] > 0  # тайлы без изменений не конвертируются
+    
+    result = check_images(img_a, img_b, fuzz=10, tile_size=32)
+    assert result['different'] and not result['exact']
+    assert 0 < result['diff_pixels'] < full
+    
+    result = check_images(*identical_images, tile_size=32)
+    assert not result['different'] and result['tiles_scanned'] == 0
+
+
+def test_check_pair_size_mismatch(tmp_path):
+    """Тест отчёта --check при разных размерах: точный результат, без процента"""
+    cv2.imwrite(str(tmp_path / "a.png"), np.zeros((20, 30, 3), dtype=np.uint8))
+    cv2.imwrite(str(tmp_path / "b.png"), np.zeros((20, 31, 3), dtype=np.uint8))
+    result = check_pair(str(tmp_path / "a.png"), str(tmp_path / "b.png"))
+    assert result['different'] and result['exact']
+    report = format_check(result, 0.0)
+    assert report.startswith("FAIL: размеры не совпадают")
+    assert "%" not in report
+
+
+def test_safe_imread_file_view(tmp_path, test_images, monkeypatch):
+    """Тест чтения через file_view: кириллица, буфер потока и mmap дают одно и то же"""
+    img_a, img_b = test_images
+    path = tmp_path / "папка" / "изображение.png"
+    path.parent.mkdir()
+    cv2.imencode(".png", img_b)[1].tofile(str(path))
+    assert np.array_equal(safe_imread(str(path)), img_b)
+    with file_view(path) as outer, file_view(path) as inner:
+        # Вложенное чтение не затирает буфер потока
+        assert outer.ctypes.data != inner.ctypes.data
+        assert np.array_equal(outer, inner) and not outer.flags.writeable
+    monkeypatch.setattr(imgio, "MMAP_THRESHOLD", 1)
+    assert np.array_equal(safe_imread(str(path)), img_b)
+    assert safe_imread(str(tmp_path / "missing.png")) is None
+    (tmp_path / "empty.png").write_bytes(b"")
+    assert safe_imread(str(tmp_path / "empty.png")) is None
+
+
+def test_imread_reduced(tmp_path):
+    """Тест чтения с уменьшением: размер по заголовку, JPEG 1/N, fallback для PNG"""
+    img = cv2.GaussianBlur(np.random.default_rng(18).integers(0, 256, (600, 801, 3), dtype=np.uint8), (9, 9), 3)
+    for ext in (".jpg", ".png", ".bmp"):
+        cv2.imwrite(str(tmp_path / f"a{ext}"), img)
+        assert image_header_size(np.fromfile(str(tmp_path / f"a{ext}"), dtype=np.uint8)) == (801, 600)
+    assert image_header_size(b"not an image") is None
+    assert [reduction_factor((801, 600), s) for s in (1000, 400, 200, 100, 50)] == [1, 2, 4, 8, 8]
+
+    small = imread_reduced(tmp_path / "a.jpg", 200)
+    assert small.shape == (150, 201, 3)
+    full = cv2.resize(cv2.imread(str(tmp_path / "a.jpg")), (201, 150), interpolation=cv2.INTER_AREA)
+    assert cv2.absdiff(small, full).mean() < 3
+    assert imread_reduced(tmp_path / "a.png", 200).shape == img.shape
+    assert imread_reduced(tmp_path / "a.jpg", 200, cv2.IMREAD_GRAYSCALE).shape == (150, 201)
+    assert imread_reduced(tmp_path / "missing.jpg", 200) is None
+
+
+def test_result_cache(tmp_path):
+    """Тест кэша результатов: пачки, LRU, ttl, несколько экземпляров, перенос JSON"""
+    import json
+
+    # Старый формат: index.json + файл на ключ
+    (tmp_path / "old.json").write_text(json.dumps({"code": 0}, indent=2))
+    (tmp_path / "index.json").write_text(json.dumps({"old": {"file": "old.json", "timestamp": "1.0"}}))
+
+    with ResultCache(tmp_path, max_entries=3, commit_every=100) as cache:
+        assert not (tmp_path / "index.json").exists() and not (tmp_path / "old.json").exists()
+        assert cache.get("old") == {"code": 0}
+        for i in range(3):
+            cache.put(f"k{i}", {"code": 1, "i": i})
+        # Видно до записи пачки в базу
+        assert cache.get("k0") == {"code": 1, "i": 0}
+        other = ResultCache(tmp_path)
+        assert other.get("k1") is None
+        cache.flush()
+        # Вытеснен давно не читанный ключ
+        assert other.get("k1") == {"code": 1, "i": 1} and other.get("old") is None
+        other.close()
+
+    with ResultCache(tmp_path, max_bytes=40) as cache:
+        assert len(cache) == 2 and cache.stats()['bytes'] <= 40
+        cache.clear()
+        assert len(cache) == 0
+
+    with ResultCache(tmp_path, ttl=-1) as cache:
+        cache.put("t", {"code": 1})
+        assert cache.get("t") is None
+
+    # Поздние обращения потоков пакета после close — промах, запись отбрасывается
+    cache = MaskCache(tmp_path)
+    cache.put("m", b"\x01")
+    cache.close()
+    assert cache.get("m") is None
+    cache.put("m", b"\x02")
+    cache.flush()
+    cache.close()
+    assert cache.stats()['entries'] == 0
+
+
+def test_fingerprint_index(tmp_path, monkeypatch):
+    """Тест индекса отпечатков: неизменённый файл не перечитывается"""
+    import os
+    import time
+
+    path = tmp_path / "a.bin"
+    path.write_bytes(b"x" * 1000)
+    past = time.time_ns() - 10 ** 10
+    os.utime(path, ns=(past, past))
+    cache_dir = tmp_path / "cache"
+
+    with FingerprintIndex(cache_dir) as index:
+        assert index.digest(path) == compute_file_digest(path)
+    with FingerprintIndex(cache_dir) as index:
+        monkeypatch.setattr(imgio, "compute_file_digest", lambda p: pytest.fail("файл перечитан"))
+        assert index.digest(path) == compute_file_digest(path)
+        monkeypatch.undo()
+        # Новая подпись — новый хэш
+        path.write_bytes(b"y" * 1000)
+        os.utime(path, ns=(past, past + 1))
+        assert index.digest(path) == compute_file_digest(path)
+        assert index.stats() == {'entries': 2, 'hits': 1, 'hashed': 1}
+        # Только что изменённый файл хэшируется, но не запоминается
+        fresh = tmp_path / "fresh.bin"
+        fresh.write_bytes(b"z")
+        index.digest(fresh)
+        assert index.stats()['entries'] == 2
+    # После close хэш считается, но не запоминается
+    assert index.digest(path) == compute_file_digest(path)
+
+
+def test_thumbnail_cache(tmp_path):
+    """Тест кэша миниатюр: память, диск, смена mtime, LRU"""
+    import os
+
+    img = cv2.GaussianBlur(np.random.default_rng(20).integers(0, 256, (900, 1200, 3), dtype=np.uint8), (9, 9), 3)
+    src = tmp_path / "scan.jpg"
+    cv2.imwrite(str(src), img)
+    cache_dir = tmp_path / "thumbs"
+
+    cache = ThumbnailCache(max_side=300, max_items=2, cache_dir=cache_dir)
+    assert cache.get(src) is None
+    thumb = cache.load(src)
+    assert max(thumb.shape[:2]) == 300
+    assert cache.load(src) is thumb
+    assert cache.stats()['misses'] == 1 and cache.stats()['memory_hits'] == 1
+
+    # Новый экземпляр берёт миниатюру с диска
+    other = ThumbnailCache(max_side=300, cache_dir=cache_dir)
+    assert np.array_equal(other.get(src), thumb)
+    assert other.stats()['disk_hits'] == 1
+
+    # Изменённый файл — новый ключ
+    st = os.stat(src)
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert other.get(src) is None
+
+    for i in range(3):
+        cv2.imwrite(str(tmp_path / f"{i}.png"), img[:100, :100])
+        cache.load(tmp_path / f"{i}.png")
+    assert cache.stats()['memory_items'] == 2
+    assert cache.load(tmp_path / "missing.png") is None
+
+    cache.max_disk_bytes = 0
+    cache.trim_disk()
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_ssim_map_reference():
+    """Тест SSIM против прямого расчёта по окну (выборочная ковариация)"""
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 256, (12, 14)).astype(np.uint8)
+    y = np.clip(x.astype(int) + rng.integers(-40, 40, x.shape), 0, 255).astype(np.uint8)
+    s = ssim_map(x, y, win=7)
+    
+    # Центральный пиксель: окно целиком внутри кадра
+    a = x[3:10, 4:11].astype(np.float64).ravel()
+    b = y[3:10, 4:11].astype(np.float64).ravel()
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    cov = np.cov(a, b)
+    expected = ((2 * a.mean() * b.mean() + c1) * (2 * cov[0, 1] + c2) /
+                ((a.mean() ** 2 + b.mean() ** 2 + c1) * (cov[0, 0] + cov[1, 1] + c2)))
+    assert s[6, 7] == pytest.approx(expected, abs=1e-5)
+    assert np.allclose(ssim_map(x, x), 1.0)
+
+
+def test_ssim_tiled_and_candidates():
+    """Тест SSIM по тайлам и только в кандидатных боксах"""
+    rng = np.random.default_rng(1)
+    x = rng.integers(0, 256, (150, 170)).astype(np.uint8)
+    y = x.copy()
+    y[40:60, 100:130] = 0
+    full = ssim_map(x, y)
+    
+    assert np.allclose(ssim_map_tiled(x, y, tile_size=40), full, atol=1e-5)
+    boxes = ssim_candidate_boxes(x, y, block=16)
+    assert np.allclose(ssim_map_tiled(x, y, boxes=boxes), full, atol=1e-5)
+    
+    assert ms_ssim(x, x) == pytest.approx(1.0)
+    assert ms_ssim(x, y) < 1.0
+
+
+def test_ssim_mask(test_images, identical_images):
+    """Тест SSIM-маски без scikit-image"""
+    img_a, img_b = test_images
+    assert cv2.countNonZero(ssim_mask(img_a, img_b)) > 0
+    assert cv2.countNonZero(ssim_mask(*identical_images)) == 0
+
+
 def test_bboxes_from_mask():
     """Тест извлечения боксов из маски"""
     # Создаём маску с двумя компонентами
@@ -121,6 +634,142 @@ def test_filter_small_components():
     assert len(boxes) == 1
 
 
+def test_filter_small_components_fills_holes():
+    """Тест что у оставшихся компонент заливаются дыры (как у внешних контуров)"""
+    mask = np.zeros((100, 100), dtype=np.uint8)
+    cv2.rectangle(mask, (10, 10), (60, 60), 255, 2)  # рамка с дырой
+    mask[80:83, 80:83] = 255                          # 9 px
+    
+    filtered = filter_small_components(mask, min_area=20)
+    assert filtered[35, 35] == 255
+    assert filtered[81, 81] == 0
+    assert np.array_equal(fill_holes(mask)[8:64, 8:64], filtered[8:64, 8:64])
+
+
+def test_filter_small_components_area_boundary():
+    """Тест что площадь — число пикселей компоненты с дырами, а не площадь контура"""
+    mask = np.zeros((40, 40), dtype=np.uint8)
+    mask[5:9, 5:10] = 255     # 4x5 = 20 px (contourArea = 12)
+    mask[20:24, 20:25] = 255  # 4x5 без угла = 19 px
+    mask[20, 20] = 0
+    mask[30:35, 30:35] = 255  # рамка 5x5 с дырой: 16 px + 9 px дыры
+    mask[31:34, 31:34] = 0
+    
+    filtered = filter_small_components(mask, min_area=20)
+    assert cv2.countNonZero(filtered[5:9, 5:10]) == 20
+    assert cv2.countNonZero(filtered[20:24, 20:25]) == 0
+    assert cv2.countNonZero(filtered[30:35, 30:35]) == 25
+    
+    filtered = filter_small_components(mask, min_area=21)
+    assert cv2.countNonZero(filtered[5:9, 5:10]) == 0
+    assert cv2.countNonZero(filtered[30:35, 30:35]) == 25
+
+
+
+def test_filter_components_strips():
+    """Тест что полосовая фильтрация совпадает с заливкой и разметкой всего кадра"""
+    def reference(mask, min_area):
+        h, w = mask.shape
+        flood = np.zeros((h + 2, w + 2), dtype=np.uint8)
+        flood[1:-1, 1:-1] = mask
+        cv2.floodFill(flood, None, (0, 0), 255, flags=4)
+        filled = cv2.bitwise_or(mask, cv2.bitwise_not(flood[1:-1, 1:-1]))
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(filled, connectivity=8)
+        keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+        keep[0] = False
+        return np.where(keep[labels], 255, 0).astype(np.uint8)
+    
+    rng = np.random.default_rng(3)
+    masks = [(rng.random((40, 50)) < p).astype(np.uint8) * 255 for p in (0.2, 0.45, 0.6)]
+    # Вложенные рамки: дыры и острова, пересекающие швы полос
+    rings = np.zeros((90, 90), dtype=np.uint8)
+    for k in range(0, 40, 8):
+        cv2.rectangle(rings, (k, k), (89 - k, 89 - k), 255, 2)
+    rings[45, 45] = 255
+    masks.append(rings)
+    for mask in masks:
+        for min_area in (0, 5, 40, 2000):
+            expected = reference(mask, min_area)
+            for strip in (1, 3, 7, 1000):
+                assert np.array_equal(filter_small_components(mask, min_area, strip=strip), expected)
+    
+    # Отдельный бит метки: остальные биты не трогаются, можно писать на место
+    label = (masks[1] > 0).astype(np.uint8) | ((rng.random((40, 50)) < 0.5) * 6).astype(np.uint8)
+    before = label.copy()
+    filter_components(label, 5, fill=True, strip=4, bit=1, dst=label)
+    assert np.array_equal(label & 6, before & 6)
+    assert np.array_equal((label & 1) * 255, reference(masks[1], 5))
+
+def test_cli_region_report():
+    """Тест отчёта по регионам различий в CLI"""
+    a = np.zeros((60, 80, 3), dtype=np.uint8)
+    b = a.copy()
+    b[10:30, 10:40] = 100   # 600 px
+    b[45:50, 60:65] = 200   # 25 px
+    mask = cv2.inRange(cv2.absdiff(a, b), (1, 1, 1), (255, 255, 255))
+    
+    regions = region_report(a, b, mask, use_lab=False)
+    assert [r['bbox'] for r in regions] == [(10, 10, 30, 20), (60, 45, 5, 5)]
+    assert [r['area'] for r in regions] == [600, 25]
+    assert regions[0]['mean_delta'] == pytest.approx(100.0)
+    assert regions[1]['max_delta'] == pytest.approx(200.0)
+    
+    assert len(region_report(a, b, mask, use_lab=False, limit=1)) == 1
+    text = format_regions(regions)
+    assert len(text.splitlines()) == 2
+    assert "x=10 y=10 30x20" in text
+
+
+def test_components_region_table():
+    """Тест таблицы регионов"""
+    mask = np.zeros((50, 60), dtype=np.uint8)
+    mask[5:15, 5:25] = 255   # 200 px
+    mask[30:32, 40:42] = 255  # 4 px
+    delta = np.zeros(mask.shape, dtype=np.float32)
+    delta[5:15, 5:15] = 10
+    delta[5:15, 15:25] = 20
+    mask_add = np.zeros_like(mask)
+    mask_add[5:15, 5:10] = 255
+    
+    comps = Components.from_mask(mask, min_area=10)
+    assert len(comps) == 1
+    assert comps.boxes() == [(5, 5, 20, 10)]
+    assert cv2.countNonZero(comps.to_mask()) == 200
+    
+    table = comps.region_table(delta=delta, mask_add=mask_add, mask_del=np.zeros_like(mask))
+    assert table['area'][0] == 200
+    assert table['mean_delta'][0] == pytest.approx(15.0)
+    assert table['max_delta'][0] == pytest.approx(20.0)
+    assert table['add_share'][0] == pytest.approx(0.25)
+    assert table['del_share'][0] == 0
+    assert comps.regions()[0]['bbox'] == (5, 5, 20, 10)
+
+
+def test_hist_percentile_matches_numpy():
+    """Тест что перцентиль по гистограмме совпадает с np.percentile"""
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        gray = rng.integers(0, 256, (int(rng.integers(1, 40)), 37), dtype=np.uint8)
+        gray[rng.random(gray.shape) < 0.8] = 0
+        for percent in (0, 50, 90, 97.5, 99, 100):
+            assert hist_percentile(gray, percent) == np.percentile(gray, percent)
+
+
+def test_percentile_mask_tiles():
+    """Тест потайловых порогов: локальное изменение на светлом фоне не теряется"""
+    gray = np.zeros((128, 128), dtype=np.uint8)
+    gray[:, 64:] = 200          # крупная «затенённая» область справа
+    gray[20:24, 20:24] = 60     # слабое локальное изменение слева
+    
+    global_mask = percentile_mask(gray, 90)
+    _, expected = cv2.threshold(gray, np.percentile(gray, 90), 255, cv2.THRESH_BINARY)
+    assert np.array_equal(global_mask, expected)
+    assert global_mask[21, 21] == 0
+    
+    local_mask = percentile_mask(gray, 90, tile=32)
+    assert local_mask[21, 21] == 255
+
+
 def test_dilate_mask():
     """Тест расширения маски"""
     mask = np.zeros((100, 100), dtype=np.uint8)
@@ -153,6 +802,391 @@ def test_create_heatmap(test_images):
     assert heatmap.dtype == np.uint8
 
 
+
+def test_backend_auto_fallback(monkeypatch):
+    """Тест выбора бэкенда: auto без Numba — OpenCV, неизвестное имя — ошибка"""
+    monkeypatch.setattr(backends, "NUMBA_AVAILABLE", False)
+    assert get_backend("auto").name == "opencv"
+    assert backends.available_backends() == ("opencv",)
+    with pytest.raises(ValueError):
+        get_backend("cuda")
+
+
+@pytest.mark.skipif(not NUMBA_AVAILABLE, reason="numba not installed")
+def test_backends_identical():
+    """Тест бэкендов: слитное ядро Numba побитово совпадает с OpenCV"""
+    rng = np.random.default_rng(13)
+    a = rng.integers(0, 256, (97, 131, 3), dtype=np.uint8)
+    b = a.copy()
+    b[rng.random((97, 131)) < 0.3] = (40, 200, 90)
+    for fuzz in (0, 3, 10):
+        for noise_filter in (True, False):
+            expected = diff_masks_split(a, b, fuzz=fuzz, noise_filter=noise_filter, backend="opencv")
+            result = diff_masks_split(
+                a, b, fuzz=fuzz, noise_filter=noise_filter, workspace=DiffWorkspace(), backend="numba"
+            )
+            for m_exp, m_res in zip(expected, result):
+                assert np.array_equal(m_exp, m_res)
+
+
+@pytest.mark.skipif(not NUMBA_AVAILABLE, reason="numba not installed")
+def test_numba_backend_thread_exit():
+    """Тест что ядро Numba из рабочего потока не мешает завершению процесса"""
+    import os
+    import subprocess
+    import sys
+
+    code = (
+        "import threading, numpy as np\n"
+        "from imgdiff.core.backends import get_backend\n"
+        "a = np.zeros((40, 50, 3), np.uint8); b = a.copy(); b[5:9] = 200\n"
+        "t = threading.Thread(target=get_backend('numba').split_lab, args=(a, b)); t.start(); t.join()\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, "-c", code], cwd=root, timeout=60, capture_output=True)
+    assert proc.returncode == 0, proc.stderr.decode(errors="replace")
+
+
+def _job_params(tmp_path, **overrides):
+    params = {
+        'fuzz': 10, 'thick': 3, 'del_color_bgr': (0, 0, 255), 'add_color_bgr': (255, 0, 0),
+        'match_tolerance': 0, 'match_color_bgr': (0, 255, 0), 'gamma': 1.0, 'morph_open': True,
+        'min_area': 20, 'debug': False, 'use_ssim': False, 'output_dir': str(tmp_path),
+        'cancel_fn': (lambda: False),
+    }
+    params.update(overrides)
+    return params
+
+
+def test_shutdown_executor(monkeypatch):
+    """Тест остановки пула: cancel_futures только там, где он есть (Python 3.9+)"""
+    from imgdiff.core import pipeline
+
+    class Executor:
+        def shutdown(self, wait=True, **kwargs):
+            self.kwargs = dict(kwargs, wait=wait)
+
+    executor = Executor()
+    shutdown_executor(executor, wait=False)
+    assert executor.kwargs == {'wait': False, 'cancel_futures': True}
+    monkeypatch.setattr(pipeline.sys, 'version_info', (3, 8, 18))
+    shutdown_executor(executor)
+    assert executor.kwargs == {'wait': True}
+
+
+def test_shared_image_pool():
+    """Тест пула разделяемой памяти: счётчик ссылок, переиспользование, заполненность"""
+    import pickle
+
+    with SharedImagePool(max_bytes=8 << 20, granule=1 << 16) as pool:
+        img = np.arange(100 * 120 * 3, dtype=np.uint32).reshape(100, 120, 3).astype(np.uint8)
+        h = pool.put(img)
+        # Дескриптор сериализуется без пикселей и читает тот же сегмент
+        copy = pickle.loads(pickle.dumps(h))
+        assert len(pickle.dumps(h)) < 200
+        assert np.array_equal(copy.array(), img)
+        copy.close()
+
+        pool.retain(h)
+        pool.release(h)
+        occ = pool.occupancy()
+        assert (occ['in_use'], occ['free'], occ['misses']) == (1, 0, 1)
+
+        pool.release(h)
+        assert pool.occupancy()['free'] == 1
+        with pytest.raises(ValueError):
+            pool.release(h)
+
+        # Кадр близкого размера получает тот же сегмент
+        h2 = pool.acquire((90, 120, 3))
+        occ = pool.occupancy()
+        assert h2.name == h.name
+        assert (occ['segments'], occ['hits']) == (1, 1)
+        pool.release(h2)
+    assert pool.occupancy()['segments'] == 0
+
+
+def test_encoder_pool(tmp_path):
+    """Тест отложенной записи: бюджет байтов, атомарная запись, ошибки"""
+    import threading
+
+    img = np.zeros((64, 64, 3), dtype=np.uint8)
+    img[10:20, 10:20] = 255
+    gate = threading.Event()
+
+    def held(image):
+        gate.wait(10)
+        return encode_image(image)
+
+    with EncoderPool(workers=2, max_bytes=img.nbytes) as encoder:
+        first = encoder.submit(img, tmp_path / "sub" / "0.png", held)
+        # Второе изображение не влезает в бюджет, пока первое не записано
+        second = threading.Thread(target=encoder.submit, args=(img, tmp_path / "sub" / "1.png", encode_image))
+        second.start()
+        second.join(0.2)
+        assert second.is_alive() and encoder.occupancy()['pending'] == 1
+        gate.set()
+        second.join(10)
+        assert first.result(10) == str(tmp_path / "sub" / "0.png")
+        encoder.drain()
+        assert encoder.occupancy()['written'] == 2
+
+        (tmp_path / "file").write_bytes(b"")
+        failed = encoder.submit(img, tmp_path / "file" / "x.png", encode_image)
+        with pytest.raises(OSError):
+            failed.result(10)
+        assert encoder.occupancy()['failed'] == 1
+
+    assert sorted(p.name for p in (tmp_path / "sub").iterdir()) == ["0.png", "1.png"]
+    assert np.array_equal(cv2.imread(str(tmp_path / "sub" / "1.png")), img)
+
+
+def _write_pairs(tmp_path, n=6):
+    """Пары a{i}/b{i}: равные, с отличиями и побайтно одинаковые"""
+    rng = np.random.default_rng(16)
+    (tmp_path / "A").mkdir()
+    (tmp_path / "B").mkdir()
+    for i in range(n):
+        a = rng.integers(0, 256, (80 + i, 96, 3), dtype=np.uint8)
+        b = a.copy()
+        if i % 2:
+            b[10:40, 20:60] = (0, 0, 255)
+        cv2.imwrite(str(tmp_path / "A" / f"{i}.png"), a)
+        cv2.imwrite(str(tmp_path / "B" / f"{i}.png"), b)
+
+
+def test_batch_pipeline(tmp_path):
+    """Тест конвейера пакета: коды и файлы как у outline_overlay, потоки и процессы; ошибки, отмена"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    _write_pairs(tmp_path)
+    params = _job_params(tmp_path)
+    assert 'cancel_fn' not in job_params(params)
+    comparator = OutlineComparator(params)
+
+    def jobs(tag):
+        return [BatchJob(i, tmp_path / "A" / f"{i}.png", tmp_path / "B" / f"{i}.png", tmp_path / f"{tag}{i}.png")
+                for i in range(6)]
+
+    # Пары с нечётным номером различаются (см. _write_pairs)
+    expected = {i: i % 2 for i in range(6)}
+    done = {job.index: job for job in BatchPipeline(comparator, prefetch=2, compare_workers=2).run(jobs("t"))}
+    assert {i: job.code for i, job in done.items()} == expected
+    assert 'read' in done[1].timings and 'encode' in done[1].timings
+    assert 'bytes' in done[0].timings and 'compare' in done[1].timings and done[1].duration > 0
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=2, mp_context=ctx, initializer=worker_init) as executor:
+        done = {job.index: job.code for job in BatchPipeline(comparator, executor=executor).run(jobs("p"))}
+    assert done == expected
+
+    p = params
+    for i, code in expected.items():
+        assert (tmp_path / f"t{i}.png").exists() == bool(code)
+        if code:
+            old = cv2.imread(str(tmp_path / "A" / f"{i}.png"))
+            new = cv2.imread(str(tmp_path / "B" / f"{i}.png"))
+            _, overlay, _ = outline_overlay(
+                old, new, p['fuzz'], p['thick'], p['del_color_bgr'], p['add_color_bgr'], p['match_tolerance'],
+                p['match_color_bgr'], p['gamma'], p['morph_open'], p['min_area'], p['debug'], p['use_ssim'],
+                p['output_dir'], True, True, 1, False, 0,
+            )
+            for tag in ("t", "p"):
+                np.testing.assert_array_equal(
+                    cv2.imread(str(tmp_path / f"{tag}{i}.png"), cv2.IMREAD_UNCHANGED), overlay)
+
+    missing = list(BatchPipeline(comparator).run([BatchJob(0, tmp_path / "A" / "0.png", tmp_path / "none.png",
+                                                           tmp_path / "m.png")]))
+    assert missing[0].code == -1 and missing[0].error
+
+    cancelled = list(BatchPipeline(comparator, cancel_fn=lambda: True).run(jobs("c")))
+    assert len(cancelled) == 6
+    assert all(job.code == -1 and job.error == "Cancelled" for job in cancelled)
+
+
+def test_mask_cache_render(tmp_path):
+    """Тест кэша масок: смена цвета и толщины не требует A и повторного сравнения"""
+    _write_pairs(tmp_path)
+    params = _job_params(tmp_path)
+    restyled = _job_params(tmp_path, thick=6, add_color_bgr=(0, 200, 200))
+
+    jobs = [BatchJob(i, tmp_path / "A" / f"{i}.png", tmp_path / "B" / f"{i}.png", tmp_path / f"m{i}.png",
+                     analysis_key=f"k{i}") for i in range(4)]
+    with MaskCache(tmp_path / "cache") as cache:
+        for job in BatchPipeline(OutlineComparator(params)).run(jobs):
+            assert job.analysis_out is not None and bool(job.analysis_out) == bool(job.code)
+            cache.put(job.analysis_key, job.analysis_out)
+    with MaskCache(tmp_path / "cache") as cache:
+        masks = {i: cache.get(f"k{i}") for i in range(4)}
+    assert masks[0] == b"" and unpack_masks(masks[1]).shape == (81, 96)
+    with pytest.raises(ValueError):
+        unpack_masks(b"not a png")
+
+    # A больше не нужен: результат собирается по маскам и B
+    jobs = [BatchJob(i, tmp_path / "missing.png", tmp_path / "B" / f"{i}.png", tmp_path / f"r{i}.png",
+                     analysis=masks[i]) for i in range(4)]
+    done = {job.index: job for job in BatchPipeline(OutlineComparator(restyled)).run(jobs)}
+    assert {i: job.code for i, job in done.items()} == {0: 0, 1: 1, 2: 0, 3: 1}
+    assert 'render' in done[1].timings and 'compare' not in done[1].timings
+
+    for i in (1, 3):
+        old = cv2.imread(str(tmp_path / "A" / f"{i}.png"))
+        new = cv2.imread(str(tmp_path / "B" / f"{i}.png"))
+        p = restyled
+        code, overlay, _ = outline_overlay(
+            old, new, p['fuzz'], p['thick'], p['del_color_bgr'], p['add_color_bgr'], p['match_tolerance'],
+            p['match_color_bgr'], p['gamma'], p['morph_open'], p['min_area'], p['debug'], p['use_ssim'],
+            p['output_dir'], True, True, 1, False, 0,
+        )
+        assert code == 1
+        np.testing.assert_array_equal(cv2.imread(str(tmp_path / f"r{i}.png"), cv2.IMREAD_UNCHANGED), overlay)
+
+
+def test_batch_cache_probe(tmp_path):
+    """Тест стадии probe: хэши и кэш в потоках конвейера, попадания без чтения пар"""
+    _write_pairs(tmp_path)
+    comparator = OutlineComparator(_job_params(tmp_path))
+
+    def jobs():
+        return [BatchJob(i, tmp_path / "A" / f"{i}.png", tmp_path / "B" / f"{i}.png", tmp_path / f"o{i}.png")
+                for i in range(6)]
+
+    with ResultCache(tmp_path / "cache") as results, FingerprintIndex(tmp_path / "cache") as fingerprints, \
+            MaskCache(tmp_path / "cache") as masks:
+        probe = CacheProbe(fingerprints, results, "s1", masks, "a1")
+        first = {}
+        for job in BatchPipeline(comparator, probe=probe).run(jobs()):
+            probe.store(job)
+            first[job.index] = job
+        assert not any(job.cached for job in first.values())
+        assert all('probe' in job.timings and job.file_hashes for job in first.values())
+        assert len(results) == 6 and len(masks) == 6
+
+        (tmp_path / "o1.png").unlink()
+        second = {job.index: job for job in BatchPipeline(comparator, probe=probe).run(jobs())}
+        assert {i: job.code for i, job in second.items()} == {i: job.code for i, job in first.items()}
+        # Результат с отличиями без файла пересобирается по маскам
+        assert not second[1].cached and second[1].analysis and (tmp_path / "o1.png").exists()
+        assert all(job.cached and 'read' not in job.timings for i, job in second.items() if i != 1)
+
+
+
+def test_batch_cache_probe_legacy_keys(tmp_path):
+    """Тест что записи, перенесённые из index.json, находятся по ключам probe"""
+    import hashlib
+    import json
+
+    _write_pairs(tmp_path, n=2)
+    job = BatchJob(1, tmp_path / "A" / "1.png", tmp_path / "B" / "1.png", tmp_path / "o1.png")
+    settings_hash = compute_settings_hash({'fuzz': 10, 'thick': 3})
+    # Ключ старой версии: SHA256 файлов + хэш настроек
+    combined = f"{compute_file_hash(job.left)}_{compute_file_hash(job.right)}_{settings_hash}"
+    key = hashlib.sha256(combined.encode()).hexdigest()
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    (cache_dir / f"{key}.json").write_text(json.dumps({"code": 0}))
+    (cache_dir / "index.json").write_text(json.dumps({key: {"timestamp": 1.0}}))
+
+    with ResultCache(cache_dir) as results, FingerprintIndex(cache_dir) as fingerprints:
+        assert CacheProbe(fingerprints, results, settings_hash)(job) == 0
+        assert job.cache_key == key
+
+def test_cli_batch_jobs(tmp_path):
+    """Тест пар CLI batch на конвейере: результат для каждой пары"""
+    _write_pairs(tmp_path, n=3)
+    (tmp_path / "A" / "extra.png").write_bytes((tmp_path / "A" / "0.png").read_bytes())
+    out = tmp_path / "out"
+    out.mkdir()
+    jobs, missing = batch_jobs(tmp_path / "A", tmp_path / "B", out)
+    assert missing == ["extra.png"]
+    done = list(BatchPipeline(ContourComparator(fuzz=10)).run(jobs))
+    assert sorted(job.code for job in done) == [1, 1, 1]
+    assert sorted(p.name for p in out.iterdir()) == ["0.png", "1.png", "2.png"]
+
+    # Кэш: при повторном запуске пары с готовым результатом пропускаются
+    settings = {'fuzz': 10}
+    with ResultCache(tmp_path / "cache") as cache, FingerprintIndex(tmp_path / "cache") as fingerprints:
+        todo, cached, keys = split_cached_jobs(batch_jobs(tmp_path / "A", tmp_path / "B", out)[0],
+                                               cache, fingerprints, settings)
+        assert (len(todo), cached) == (3, [])
+        for job in todo[:2]:
+            cache.put(keys[job.index], {'code': 1})
+        (out / todo[1].name).unlink()
+        todo, cached, _ = split_cached_jobs(batch_jobs(tmp_path / "A", tmp_path / "B", out)[0],
+                                            cache, fingerprints, settings)
+        assert [job.name for job in cached] == ["0.png"] and cached[0].code == 1
+        assert [job.name for job in todo] == ["1.png", "2.png"]
+
+
+
+class _SlowComparator(ContourComparator):
+    """Сравнение, которое зависает на кадрах высотой 81 (пара 1 из _write_pairs), остальные — по 0.6 с"""
+
+    def __call__(self, img_a, img_b, timer, out=None):
+        import time
+        time.sleep(5 if img_a.shape[0] == 81 else 0.6)
+        return super().__call__(img_a, img_b, timer, out)
+
+
+def test_cli_batch_parallel(tmp_path):
+    """Тест параллельного batch: пул процессов, таймаут пары, вывод по порядку"""
+    _write_pairs(tmp_path, n=6)
+    out = tmp_path / "out"
+    out.mkdir()
+    jobs, _ = batch_jobs(tmp_path / "A", tmp_path / "B", out)
+
+    assert batch_executor(1) is None
+    # Пока пара 1 висит, остальные идут через один процесс и ждут в очереди пула
+    # дольше таймаута — ожидание не должно засчитываться им в таймаут
+    executor = batch_executor(2, threads_per_job=1, timeout=1.0)
+    try:
+        pipeline = BatchPipeline(_SlowComparator(fuzz=10), compare_workers=2, executor=executor, timeout=1.0)
+        done = list(in_order(pipeline.run(jobs), [job.index for job in jobs]))
+    finally:
+        stop_executor(executor, kill=True)
+    assert [job.index for job in done] == [0, 1, 2, 3, 4, 5]
+    assert [job.code for job in done] == [1, -1, 1, 1, 1, 1] and done[1].error.startswith("Timeout")
+    assert sorted(p.name for p in out.iterdir()) == ["0.png", "2.png", "3.png", "4.png", "5.png"]
+
+    # Единственный процесс завис — следующая пара не ждёт его бесконечно
+    hanging = [BatchJob(i, jobs[1].left, jobs[1].right, out / f"h{i}.png") for i in range(2)]
+    executor = batch_executor(1, timeout=1.0)
+    try:
+        pipeline = BatchPipeline(_SlowComparator(fuzz=10), executor=executor, timeout=1.0)
+        errors = sorted(job.error for job in pipeline.run(hanging))
+    finally:
+        stop_executor(executor, kill=True)
+    assert errors == ["Timeout (1 s)", "Timeout: все процессы пула заняты зависшими парами"]
+
+    reordered = [BatchJob(i, "a", "b", "o") for i in (2, 0, 3, 1)]
+    assert [job.index for job in in_order(reordered, [0, 1, 2, 3])] == [0, 1, 2, 3]
+
+
+def test_batch_pipeline_pool_error(tmp_path):
+    """Тест что ошибка пула (сериализация задачи) возвращает слот и сегменты"""
+    import threading
+
+    _write_pairs(tmp_path, n=4)
+    jobs, _ = batch_jobs(tmp_path / "A", tmp_path / "B", tmp_path)
+    comparator = ContourComparator(fuzz=10)
+    comparator.unpicklable = lambda: None
+    executor = batch_executor(1, timeout=5.0)
+    done = []
+    try:
+        with SharedImagePool() as pool:
+            # Слотов таймаута два — без возврата третья пара ждала бы слот вечно
+            pipeline = BatchPipeline(comparator, executor=executor, timeout=5.0, pool=pool)
+            runner = threading.Thread(target=lambda: done.extend(pipeline.run(jobs)), daemon=True)
+            runner.start()
+            runner.join(60)
+            assert not runner.is_alive()
+            assert pool.occupancy()['in_use'] == 0
+    finally:
+        stop_executor(executor, kill=True)
+    assert sorted(job.index for job in done) == [0, 1, 2, 3]
+    assert all(job.code == -1 and job.error for job in done)
+
 # Бенчмарки (требуют pytest-benchmark)
 try:
     import pytest_benchmark
@@ -186,3 +1220,19 @@ def test_benchmark_coarse_to_fine(benchmark, test_images):
     result = benchmark(coarse_to_fine, img_a, img_b, fuzz=10, scale=0.25)
     assert result is not None
 
+
+
+@pytest.mark.skipif(not HAS_BENCHMARK, reason="pytest-benchmark not installed")
+@pytest.mark.benchmark(group="backends")
+@pytest.mark.parametrize("name", ["opencv", "numba"])
+def test_benchmark_backends(benchmark, name):
+    """Бенчмарк бэкендов разделения add/del на одном кадре"""
+    if name not in backends.available_backends():
+        pytest.skip(f"{name} backend not available")
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 256, (1024, 1024, 3), dtype=np.uint8)
+    b = a.copy()
+    b[200:600, 300:900] = (0, 0, 255)
+    ws = DiffWorkspace()
+    result = benchmark(diff_masks_split, a, b, fuzz=10, workspace=ws, backend=name)
+    assert result[0].any()
@@ -33,4 +33,31 @@ def test_noise():
     img2 = np.clip(img2.astype(np.int16) + noise, 0, 255).astype(np.uint8)
     overlay, meta = diff_two_color(img1, img2, sens=1.0, blur=3, morph_open=True)
     # Должно быть мало diff-пикселей, если фильтры работают
-    assert meta['diff_percent'] < 5.0 
\ No newline at end of file
+    assert meta['diff_percent'] < 5.0
+
+def test_block_index_same_result():
+    img1 = make_img((200, 300, 3))
+    img2 = img1.copy()
+    img2[40:60, 250:280] = (0, 0, 0)
+    img2[150:152, 10:100] = (0, 0, 255)
+    overlay, meta = diff_two_color(img1, img2, sens=1.0)
+    overlay_b, meta_b = diff_two_color(img1, img2, sens=1.0, block_index=True)
+    assert np.array_equal(overlay, overlay_b)
+    assert meta == meta_b
+
+def test_threshold_tile():
+    img1 = make_img((200, 300, 3))
+    img2 = img1.copy()
+    img2[40:60, 250:280] = (0, 0, 0)
+    overlay, meta = diff_two_color(img1, img2, sens=1.0, threshold_tile=64)
+    assert meta['diff_pixels'] > 0
+    assert overlay.shape == (200, 300, 4)
+
+def test_use_ssim():
+    img1 = make_img((120, 160, 3))
+    img2 = img1.copy()
+    img2[30:36, 40:46] = (0, 0, 0)
+    overlay, meta = diff_two_color(img1, img2, sens=1.0, use_ssim=True)
+    assert meta['diff_pixels'] > 0
+    overlay, meta = diff_two_color(img1, img1.copy(), use_ssim=True)
+    assert meta['diff_pixels'] == 0